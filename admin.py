@@ -1,5 +1,139 @@
 from django.contrib import admin
-from tagging.models import Tag, TaggedItem
+from django.contrib.admin.views.main import ChangeList
+from django.db import connection
+from django.utils.translation import ugettext_lazy as _, ungettext
 
-admin.site.register(TaggedItem)
-admin.site.register(Tag)
+from tagging import cleanup, db
+from tagging.generic import fetch_content_objects
+from tagging.models import Tag, TaggedItem, TaggedItemOwner
+from tagging.routers import reads_from_primary
+
+qn = connection.ops.quote_name
+
+def _count_sql(table, column, outer_table):
+    """
+    Returns a subquery counting the rows of ``table`` whose ``column``
+    refers to the current row of ``outer_table``.
+    """
+    return '(SELECT COUNT(*) FROM %s WHERE %s.%s = %s.id)' % (
+        qn(table), qn(table), qn(column), qn(outer_table))
+
+class TagAdmin(admin.ModelAdmin):
+    """
+    Tags with their item and owner counts. Owners are picked by id
+    rather than from a list of every user, and the merge and delete
+    actions work on the selected tags with set-based queries.
+    """
+    list_display = ('name', 'item_count', 'owner_count')
+    search_fields = ('name',)
+    raw_id_fields = ('owners',)
+    actions = ['merge_tags', 'delete_tags']
+
+    def queryset(self, request):
+        tag_owners, tag_column, owner_column = db.m2m_table(Tag, 'owners')
+        return super(TagAdmin, self).queryset(request).extra(select={
+            'item_count': _count_sql(TaggedItem._meta.db_table,
+                                     TaggedItem._meta.get_field('tag').column, Tag._meta.db_table),
+            'owner_count': _count_sql(tag_owners, tag_column, Tag._meta.db_table),
+        })
+
+    def get_actions(self, request):
+        actions = super(TagAdmin, self).get_actions(request)
+        # Replaced by delete_tags, which doesn't load the related rows.
+        actions.pop('delete_selected', None)
+        return actions
+
+    def item_count(self, tag):
+        return tag.item_count
+    item_count.short_description = _('items')
+
+    def owner_count(self, tag):
+        return tag.owner_count
+    owner_count.short_description = _('owners')
+
+    def merge_tags(self, request, queryset):
+        tags = list(queryset)
+        if len(tags) < 2:
+            self.message_user(request, _('Select at least two tags to merge.'))
+            return
+        # The most used tag absorbs the others.
+        tags.sort(key=lambda tag: (-tag.item_count, tag.pk))
+        target = tags[0]
+        Tag.objects.merge(tags[1:], target)
+        self.message_user(request, ungettext('Merged %(count)d tag into "%(target)s".',
+                                             'Merged %(count)d tags into "%(target)s".',
+                                             len(tags) - 1) % {
+            'count': len(tags) - 1, 'target': target.name})
+    merge_tags = reads_from_primary(merge_tags)
+    merge_tags.short_description = _('Merge selected tags into the most used one')
+
+    def delete_tags(self, request, queryset):
+        tags = list(queryset)
+        cleanup.delete_tags(tags)
+        self.message_user(request, ungettext('Deleted %(count)d tag.', 'Deleted %(count)d tags.',
+                                             len(tags)) % {'count': len(tags)})
+    delete_tags = reads_from_primary(delete_tags)
+    delete_tags.short_description = _('Delete selected tags')
+
+class TaggedItemOwnerInline(admin.TabularInline):
+    model = TaggedItemOwner
+    raw_id_fields = ('owner',)
+    extra = 0
+
+class TaggedItemChangeList(ChangeList):
+    """
+    Fetches the tagged objects of a page in one query per content type.
+    """
+    def get_results(self, request):
+        super(TaggedItemChangeList, self).get_results(request)
+        fetch_content_objects(self.result_list)
+
+class TaggedItemAdmin(admin.ModelAdmin):
+    """
+    Tagged items with their objects fetched in bulk and their owner
+    counts; owners are edited inline and picked by id.
+    """
+    list_display = ('__unicode__', 'tag', 'content_type', 'object_id', 'popular', 'score',
+                    'owner_count')
+    list_filter = ('popular',)
+    list_select_related = True
+    raw_id_fields = ('tag',)
+    inlines = [TaggedItemOwnerInline]
+    actions = ['delete_items']
+
+    def queryset(self, request):
+        item_owners, item_column, owner_column = db.m2m_table(TaggedItem, 'owners')
+        return super(TaggedItemAdmin, self).queryset(request).extra(select={
+            'owner_count': _count_sql(item_owners, item_column, TaggedItem._meta.db_table),
+        })
+
+    def get_changelist(self, request, **kwargs):
+        return TaggedItemChangeList
+
+    def get_actions(self, request):
+        actions = super(TaggedItemAdmin, self).get_actions(request)
+        # Replaced by delete_items, which doesn't load the related rows.
+        actions.pop('delete_selected', None)
+        return actions
+
+    def owner_count(self, item):
+        return item.owner_count
+    owner_count.short_description = _('owners')
+
+    def delete_items(self, request, queryset):
+        object_ids = {}
+        item_ids = []
+        for pk, content_type_id, object_id in queryset.values_list('pk', 'content_type', 'object_id'):
+            item_ids.append(pk)
+            object_ids.setdefault(content_type_id, set()).add(object_id)
+        cleanup.delete_items(item_ids)
+        for content_type_id, ids in object_ids.items():
+            TaggedItem.refresh_popular_many(content_type_id, list(ids))
+        self.message_user(request, ungettext('Deleted %(count)d tagged item.',
+                                             'Deleted %(count)d tagged items.',
+                                             len(item_ids)) % {'count': len(item_ids)})
+    delete_items = reads_from_primary(delete_items)
+    delete_items.short_description = _('Delete selected tagged items')
+
+admin.site.register(TaggedItem, TaggedItemAdmin)
+admin.site.register(Tag, TagAdmin)
@@ -0,0 +1,308 @@
+"""
+Garbage collection for tagging data.
+
+``TaggedItem`` refers to its object through a generic foreign key, so
+deleting a tagged object leaves its items behind unless the model was
+registered with ``register``. ``collect_garbage``, also available as
+``manage.py tagging_gc``, finds and removes that debris in batches.
+
+Each collector works on one database, the default one unless ``using``
+is given; ``collect_garbage`` covers the shards of ``tagging.shards``
+too.
+"""
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+from django.db.models import signals
+
+from tagging import db, outbox, settings, shards, similarity, sketches, trending, versions
+from tagging.models import Tag, TaggedItem, TrendBucket
+from tagging.routers import reads_from_primary
+from tagging.utils import get_tag_list
+
+qn = connection.ops.quote_name
+
+def _delete_in(table, column, ids, cursor):
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+        qn(table), qn(column), ', '.join(['%s'] * len(ids))), list(ids))
+
+def delete_items(item_ids, cursor=None, using=None):
+    """
+    Deletes the given tagged items and their owner rows.
+    """
+    if not item_ids:
+        return
+    using = using or DEFAULT_DB_ALIAS
+    cursor = cursor or connections[using].cursor()
+    outbox.append_items(outbox.DELETE, item_ids, using=using)
+    table, item_column, owner_column = db.m2m_table(TaggedItem, 'owners')
+    _delete_in(table, item_column, item_ids, cursor)
+    _delete_in(TaggedItem._meta.db_table, TaggedItem._meta.pk.column, item_ids, cursor)
+    transaction.commit_unless_managed(using=using)
+
+def _batches(sql, params, batch_size, cursor):
+    """
+    Yields lists of ids selected by ``sql``, which must select a single
+    id column greater than a trailing ``%s`` parameter, in order.
+    """
+    last = 0
+    while True:
+        cursor.execute('%s ORDER BY 1 LIMIT %d' % (sql, batch_size), list(params) + [last])
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
+def _delete_orphans_elsewhere(model, ctype_id, batch_size, cursor, using):
+    """
+    Deletes the items of ``model`` in the database ``using``, which
+    doesn't hold the model's table, whose object no longer exists.
+    """
+    opts = TaggedItem._meta
+    sql = 'SELECT i.id, i.%s FROM %s i WHERE i.%s = %%s AND i.id > %%s ORDER BY 1 LIMIT %d' % (
+        qn(opts.get_field('object_id').column), qn(opts.db_table),
+        qn(opts.get_field('content_type').column), batch_size)
+    deleted, last = 0, 0
+    while True:
+        cursor.execute(sql, [ctype_id, last])
+        rows = cursor.fetchall()
+        if not rows:
+            return deleted
+        existing = set(model._default_manager.filter(pk__in=set([row[1] for row in rows])) \
+                                             .values_list('pk', flat=True))
+        ids = [item_id for item_id, object_id in rows if object_id not in existing]
+        delete_items(ids, cursor, using)
+        deleted += len(ids)
+        last = rows[-1][0]
+
+def delete_orphaned_items(batch_size=1000, using=None):
+    """
+    Deletes the tagged items whose object no longer exists, using an
+    anti-join against each tagged model's table. Returns the number of
+    items deleted.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    cursor = connections[using].cursor()
+    opts = TaggedItem._meta
+    items = qn(opts.db_table)
+    content_type_column = qn(opts.get_field('content_type').column)
+    object_id_column = qn(opts.get_field('object_id').column)
+    deleted = 0
+    for ctype_id in TaggedItem._default_manager.using(using) \
+                              .values_list('content_type', flat=True).distinct():
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+        if model is not None and using != DEFAULT_DB_ALIAS:
+            # The model's table is in another database; no anti-join.
+            deleted += _delete_orphans_elsewhere(model, ctype_id, batch_size, cursor, using)
+            continue
+        if model is None:
+            # The model itself is gone
+            sql = 'SELECT i.id FROM %s i WHERE i.%s = %%s AND i.id > %%s' % (
+                items, content_type_column)
+        else:
+            sql = ('SELECT i.id FROM %s i LEFT OUTER JOIN %s o ON o.%s = i.%s '
+                   'WHERE i.%s = %%s AND o.%s IS NULL AND i.id > %%s') % (
+                items, qn(model._meta.db_table), qn(model._meta.pk.column), object_id_column,
+                content_type_column, qn(model._meta.pk.column))
+        # Deleting moves the keyset forward by itself; the ids already
+        # seen are gone.
+        for ids in _batches(sql, [ctype_id], batch_size, cursor):
+            delete_items(ids, cursor, using)
+            deleted += len(ids)
+    return deleted
+
+def delete_ownerless_items(batch_size=1000, using=None):
+    """
+    Deletes the tagged items nobody owns and refreshes the popularity
+    of their objects. Returns the number of items deleted.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    cursor = connections[using].cursor()
+    opts = TaggedItem._meta
+    table, item_column, owner_column = db.m2m_table(TaggedItem, 'owners')
+    sql = ('SELECT i.id FROM %s i WHERE NOT EXISTS '
+           '(SELECT 1 FROM %s o WHERE o.%s = i.id) AND i.id > %%s') % (
+        qn(opts.db_table), qn(table), qn(item_column))
+    deleted = 0
+    for ids in _batches(sql, [], batch_size, cursor):
+        objects = {}
+        for ctype_id, object_id in TaggedItem._default_manager.using(using).filter(pk__in=ids) \
+                                              .values_list('content_type', 'object_id'):
+            objects.setdefault(ctype_id, set()).add(object_id)
+        delete_items(ids, cursor, using)
+        for ctype_id, object_ids in objects.items():
+            TaggedItem.refresh_popular_many(ctype_id, list(object_ids))
+        deleted += len(ids)
+    return deleted
+
+def delete_stale_tag_owners(batch_size=1000, using=None):
+    """
+    Removes owners from the tags they no longer have on any item.
+    Returns the number of rows deleted.
+
+    The owner rows of tags are walked by id, ``batch_size`` at a time,
+    each batch deleted and committed on its own. The delete checks the
+    rows are still stale itself, so an owner putting the tag back
+    meanwhile keeps it.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    cursor = connections[using].cursor()
+    tag_owners, tag_column, tag_owner_column = db.m2m_table(Tag, 'owners')
+    item_owners, item_column, item_owner_column = db.m2m_table(TaggedItem, 'owners')
+    names = {
+        'tag_owners': qn(tag_owners),
+        'pk': qn(Tag._meta.get_field('owners').rel.through._meta.pk.column),
+        'tag_column': qn(tag_column),
+        'tag_owner_column': qn(tag_owner_column),
+        'items': qn(TaggedItem._meta.db_table),
+        'item_tag': qn(TaggedItem._meta.get_field('tag').column),
+        'item_owners': qn(item_owners),
+        'item_column': qn(item_column),
+        'item_owner_column': qn(item_owner_column),
+    }
+    delete_sql = ('DELETE FROM %(tag_owners)s WHERE %(pk)s BETWEEN %%s AND %%s AND NOT EXISTS '
+                  '(SELECT 1 FROM %(items)s i INNER JOIN %(item_owners)s o ON o.%(item_column)s = i.id '
+                  'WHERE i.%(item_tag)s = %(tag_owners)s.%(tag_column)s '
+                  'AND o.%(item_owner_column)s = %(tag_owners)s.%(tag_owner_column)s)') % names
+    deleted = 0
+    for ids in _batches('SELECT %(pk)s FROM %(tag_owners)s WHERE %(pk)s > %%s' % names, [],
+                        batch_size, cursor):
+        cursor.execute(delete_sql, [ids[0], ids[-1]])
+        deleted += cursor.rowcount
+        transaction.commit_unless_managed(using=using)
+    return deleted
+
+def delete_unused_tags(batch_size=1000, using=None):
+    """
+    Deletes the tags which aren't on any item. Returns the number of
+    tags deleted.
+
+    In a shard this only removes the shard's copies; in the default
+    database, tags still used in a shard are kept.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    cursor = connections[using].cursor()
+    tag_owners, tag_column, tag_owner_column = db.m2m_table(Tag, 'owners')
+    sql = ('SELECT t.id FROM %s t WHERE NOT EXISTS '
+           '(SELECT 1 FROM %s i WHERE i.%s = t.id) AND t.id > %%s') % (
+        qn(Tag._meta.db_table), qn(TaggedItem._meta.db_table),
+        qn(TaggedItem._meta.get_field('tag').column))
+    deleted = 0
+    for ids in _batches(sql, [], batch_size, cursor):
+        if using == DEFAULT_DB_ALIAS:
+            for shard in shards.databases():
+                used = set(TaggedItem._default_manager.using(shard).filter(tag__in=ids) \
+                                                      .values_list('tag', flat=True))
+                ids = [tag_id for tag_id in ids if tag_id not in used]
+            if not ids:
+                continue
+        _delete_in(tag_owners, tag_column, ids, cursor)
+        _delete_in(TrendBucket._meta.db_table, TrendBucket._meta.get_field('tag').column, ids, cursor)
+        sketches.delete(ids, using)
+        _delete_in(Tag._meta.db_table, Tag._meta.pk.column, ids, cursor)
+        transaction.commit_unless_managed(using=using)
+        deleted += len(ids)
+    return deleted
+
+def delete_expired_buckets(using=None):
+    """
+    Deletes the trend buckets older than ``TAGGING_TREND_RETENTION``.
+    Returns the number of buckets deleted.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    cursor = connections[using].cursor()
+    opts = TrendBucket._meta
+    cursor.execute('DELETE FROM %s WHERE %s < %%s' % (
+        qn(opts.db_table), qn(opts.get_field('bucket').column)),
+        [trending.bucket_for(time.time() - settings.TAGGING_TREND_RETENTION)])
+    deleted = cursor.rowcount
+    transaction.commit_unless_managed(using=using)
+    return deleted
+
+@reads_from_primary
+def collect_garbage(batch_size=1000):
+    """
+    Runs every collector in dependency order, in the default database
+    and then in each shard, and returns a dict of how many rows each
+    removed.
+    """
+    deleted = {
+        'orphaned_items': 0,
+        'ownerless_items': 0,
+        'stale_tag_owners': 0,
+        'unused_tags': 0,
+        'expired_buckets': 0,
+    }
+    # Shards first, so that tags they stop using can go from the default
+    # database in the same run.
+    for using in shards.databases() + [DEFAULT_DB_ALIAS]:
+        deleted['orphaned_items'] += delete_orphaned_items(batch_size, using)
+        deleted['ownerless_items'] += delete_ownerless_items(batch_size, using)
+        deleted['stale_tag_owners'] += delete_stale_tag_owners(batch_size, using)
+        deleted['unused_tags'] += delete_unused_tags(batch_size, using)
+        deleted['expired_buckets'] += delete_expired_buckets(using)
+    versions.bump_all()
+    return deleted
+
+@reads_from_primary
+def delete_tags(tags, batch_size=1000):
+    """
+    Deletes ``tags`` (anything ``get_tag_list`` accepts) with their
+    items, owner rows, trend counts and owner sketches, in every
+    database, then refreshes the popularity of the objects which lost
+    tags. Returns the number of items deleted.
+
+    Rows are deleted by id, ``batch_size`` items at a time, rather than
+    through the cascade of ``Tag.delete``, which loads every related row.
+    """
+    tag_ids = [tag.pk for tag in get_tag_list(tags)]
+    if not tag_ids:
+        return 0
+    tag_owners, tag_column, tag_owner_column = db.m2m_table(Tag, 'owners')
+    opts = TaggedItem._meta
+    sql = 'SELECT %s FROM %s WHERE %s IN (%s) AND %s > %%s' % (
+        qn(opts.pk.column), qn(opts.db_table), qn(opts.get_field('tag').column),
+        ', '.join(['%s'] * len(tag_ids)), qn(opts.pk.column))
+    deleted = 0
+    for using in shards.databases() + [DEFAULT_DB_ALIAS]:
+        cursor = connections[using].cursor()
+        affected = {}
+        for ids in _batches(sql, tag_ids, batch_size, cursor):
+            for content_type_id, object_id in TaggedItem._default_manager.using(using) \
+                    .filter(pk__in=ids).values_list('content_type', 'object_id'):
+                affected.setdefault(content_type_id, set()).add(object_id)
+            delete_items(ids, cursor, using)
+            deleted += len(ids)
+        _delete_in(tag_owners, tag_column, tag_ids, cursor)
+        _delete_in(TrendBucket._meta.db_table, TrendBucket._meta.get_field('tag').column, tag_ids, cursor)
+        sketches.delete(tag_ids, using)
+        _delete_in(Tag._meta.db_table, Tag._meta.pk.column, tag_ids, cursor)
+        transaction.commit_unless_managed(using=using)
+        for content_type_id, object_ids in affected.items():
+            object_ids = list(object_ids)
+            for i in range(0, len(object_ids), batch_size):
+                TaggedItem.refresh_popular_many(content_type_id, object_ids[i:i + batch_size])
+    versions.bump_all()
+    return deleted
+
+_registered = set()
+
+def _delete_tagging(sender, instance, **kwargs):
+    ctype = ContentType.objects.get_for_model(instance)
+    using = shards.database_for(ctype)
+    delete_items(list(TaggedItem._default_manager.using(using or DEFAULT_DB_ALIAS) \
+                          .filter(content_type=ctype, object_id=instance.pk) \
+                          .values_list('pk', flat=True)), using=using)
+    versions.bump(ctype.pk, [instance.pk])
+    similarity.changed(ctype, [instance.pk])
+
+def register(model):
+    """
+    Deletes the tagged items of instances of ``model`` as soon as the
+    instances are deleted, so they never become orphans.
+    """
+    if model not in _registered:
+        _registered.add(model)
+        signals.post_delete.connect(_delete_tagging, sender=model)
@@ -0,0 +1,76 @@
+"""
+The owner on whose behalf implicit tag writes - those made by saving a
+``TagField`` or assigning through a ``TagDescriptor`` - are made.
+"""
+import threading
+
+from django.utils.translation import ugettext as _
+
+_state = threading.local()
+
+def _blocks():
+    if not hasattr(_state, 'blocks'):
+        _state.blocks = []
+    return _state.blocks
+
+def get_current_owner():
+    """
+    Returns the owner set by the innermost active ``tagging_owner``
+    block on this thread, or ``None``.
+    """
+    blocks = _blocks()
+    if blocks:
+        return blocks[-1].owner
+    return None
+
+def queue_tag_write(obj, tag_names):
+    """
+    Queues ``tag_names`` to replace the current owner's tags on ``obj``
+    when the innermost ``tagging_owner`` block is flushed.
+    """
+    blocks = _blocks()
+    if not blocks:
+        raise AttributeError(_('Assigning tags requires an owner; use tagging_owner().'))
+    blocks[-1].pending.append((obj, tag_names))
+
+class tagging_owner(object):
+    """
+    A context manager which makes ``owner`` the owner of implicit tag
+    writes within its block::
+
+       with tagging_owner(request.user):
+           link.tags = 'django python'
+           link.save()
+
+    Tags assigned through a ``TagDescriptor`` inside the block are
+    queued and written together by ``TagManager.update_tags_many`` when
+    the block exits without an exception, or when ``flush`` is called.
+
+    Blocks may be nested; the innermost owner wins.
+    """
+    def __init__(self, owner):
+        self.owner = owner
+        self.pending = []
+
+    def __enter__(self):
+        _blocks().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            _blocks().remove(self)
+            self.pending = []
+
+    def flush(self):
+        """
+        Writes the tags queued so far.
+        """
+        from tagging.models import Tag
+        pending, self.pending = self.pending, []
+        if pending:
+            Tag.objects.update_tags_many(pending, self.owner)
+            for obj, tag_names in pending:
+                obj._tag_cache = None
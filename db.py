@@ -0,0 +1,180 @@
+"""
+Backend specific SQL helpers used by the tagging write paths.
+"""
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, transaction
+
+def get_vendor(using=None):
+    """
+    Returns the name of the database backend behind the ``using``
+    alias: ``'postgresql'``, ``'sqlite'``, ``'mysql'`` or whatever the
+    engine calls itself.
+    """
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    vendor = getattr(connection, 'vendor', None)
+    if vendor is None:
+        engine = connection.settings_dict['ENGINE'].split('.')[-1]
+        if engine.startswith('postgresql'):
+            vendor = 'postgresql'
+        elif engine.startswith('sqlite'):
+            vendor = 'sqlite'
+        else:
+            vendor = engine
+    return vendor
+
+def supports_returning(using=None):
+    """
+    Returns whether the backend behind ``using`` takes a ``RETURNING``
+    clause on ``INSERT`` and ``DELETE``.
+    """
+    vendor = get_vendor(using)
+    if vendor == 'sqlite':
+        from django.db.backends.sqlite3.base import Database
+        return Database.sqlite_version_info >= (3, 35, 0)
+    return vendor == 'postgresql'
+
+# Statement templates which silently skip rows violating a unique
+# constraint, keyed by vendor. ``rows`` is a ``VALUES`` list or a
+# ``SELECT``.
+INSERT_IGNORE_SQL = {
+    'postgresql': 'INSERT INTO %(table)s (%(columns)s) %(rows)s ON CONFLICT DO NOTHING',
+    'sqlite': 'INSERT OR IGNORE INTO %(table)s (%(columns)s) %(rows)s',
+    'mysql': 'INSERT IGNORE INTO %(table)s (%(columns)s) %(rows)s',
+}
+
+# Keep statements well below the bound parameter limits of every backend
+# (999 for older SQLite builds).
+INSERT_BATCH_SIZE = 100
+
+def insert_ignore(table, columns, rows, using=None):
+    """
+    Inserts ``rows`` (sequences of values matching ``columns``) into
+    ``table``, skipping any row which would violate a unique constraint
+    rather than raising ``IntegrityError``.
+
+    Uses ``INSERT ... ON CONFLICT DO NOTHING`` or the backend's
+    equivalent where available. Elsewhere each row is inserted inside
+    its own savepoint, which is rolled back if the row already exists.
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    sql = INSERT_IGNORE_SQL.get(get_vendor(using))
+    row_sql = '(%s)' % ', '.join(['%s'] * len(columns))
+    params = {
+        'table': qn(table),
+        'columns': ', '.join([qn(column) for column in columns]),
+    }
+
+    if sql is not None:
+        for i in range(0, len(rows), INSERT_BATCH_SIZE):
+            batch = rows[i:i + INSERT_BATCH_SIZE]
+            params['rows'] = 'VALUES ' + ', '.join([row_sql] * len(batch))
+            cursor.execute(sql % params, [value for row in batch for value in row])
+    else:
+        params['rows'] = 'VALUES ' + row_sql
+        sql = 'INSERT INTO %(table)s (%(columns)s) %(rows)s' % params
+        for row in rows:
+            sid = transaction.savepoint(using=using)
+            try:
+                cursor.execute(sql, list(row))
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, using=using)
+            else:
+                transaction.savepoint_commit(sid, using=using)
+    transaction.commit_unless_managed(using=using)
+
+def insert_ignore_select(table, columns, select, params, using=None, returning=None):
+    """
+    Inserts the rows the ``SELECT`` statement ``select`` returns for
+    ``params`` into ``table``, skipping any row which would violate a
+    unique constraint, in one statement where the backend allows it.
+    Elsewhere the rows are read first and inserted one at a time.
+
+    If ``returning`` names a column of ``table``, returns its values for
+    the rows actually inserted, leaving out those skipped.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    sql = INSERT_IGNORE_SQL.get(get_vendor(using))
+    names = {
+        'table': qn(table),
+        'columns': ', '.join([qn(column) for column in columns]),
+        'rows': select,
+    }
+    if sql is not None and (returning is None or supports_returning(using)):
+        sql = sql % names
+        if returning is not None:
+            sql += ' RETURNING %s' % qn(returning)
+        cursor.execute(sql, params)
+        inserted = None
+        if returning is not None:
+            inserted = [row[0] for row in cursor.fetchall()]
+        transaction.commit_unless_managed(using=using)
+        return inserted
+
+    cursor.execute(select, params)
+    rows = cursor.fetchall()
+    if returning is None:
+        insert_ignore(table, columns, rows, using=using)
+        return None
+    index = list(columns).index(returning)
+    names['rows'] = 'VALUES (%s)' % ', '.join(['%s'] * len(columns))
+    inserted = []
+    for row in rows:
+        if sql is not None:
+            cursor.execute(sql % names, list(row))
+            if cursor.rowcount:
+                inserted.append(row[index])
+            continue
+        sid = transaction.savepoint(using=using)
+        try:
+            cursor.execute('INSERT INTO %(table)s (%(columns)s) %(rows)s' % names, list(row))
+        except IntegrityError:
+            transaction.savepoint_rollback(sid, using=using)
+        else:
+            transaction.savepoint_commit(sid, using=using)
+            inserted.append(row[index])
+    transaction.commit_unless_managed(using=using)
+    return inserted
+
+def delete_returning(table, where, params, column, using=None):
+    """
+    Deletes the rows of ``table`` matching the condition ``where`` and
+    returns the values of ``column``, which must tell the matching rows
+    apart, for the rows this call deleted, leaving out any a concurrent
+    writer deleted first.
+
+    Uses ``DELETE ... RETURNING`` where available. Elsewhere the
+    matching rows are read first and deleted one at a time.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    if supports_returning(using):
+        cursor.execute('DELETE FROM %s WHERE %s RETURNING %s' % (qn(table), where, qn(column)), params)
+        deleted = [row[0] for row in cursor.fetchall()]
+    else:
+        cursor.execute('SELECT %s FROM %s WHERE %s' % (qn(column), qn(table), where), params)
+        deleted = []
+        for value, in cursor.fetchall():
+            cursor.execute('DELETE FROM %s WHERE (%s) AND %s = %%s' % (qn(table), where, qn(column)),
+                           list(params) + [value])
+            if cursor.rowcount:
+                deleted.append(value)
+    transaction.commit_unless_managed(using=using)
+    return deleted
+
+def m2m_table(model, field_name):
+    """
+    Returns ``(table, source_column, target_column)`` for the join table
+    behind the many-to-many field ``field_name`` of ``model``.
+    """
+    field = model._meta.get_field(field_name)
+    return field.m2m_db_table(), field.m2m_column_name(), field.m2m_reverse_name()
@@ -0,0 +1,97 @@
+"""
+A bounded thread pool for running tagging queries off the caller's
+thread.
+
+Django's ORM has no non-blocking interface, so the ``a``-prefixed
+manager methods (``Tag.objects.aupdate_tags`` and friends) submit the
+blocking call to this pool and hand back a ``concurrent.futures.Future``.
+Under an event loop the future can be awaited with
+``asyncio.wrap_future``.
+
+Requires ``concurrent.futures`` (the ``futures`` backport on Python 2).
+"""
+import threading
+
+try:
+    from concurrent.futures import Future, ThreadPoolExecutor
+except ImportError:
+    Future = ThreadPoolExecutor = None
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+
+from tagging import settings
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """
+    Returns the shared executor, creating it on first use.
+    """
+    global _executor
+    if ThreadPoolExecutor is None:
+        raise ImproperlyConfigured('The non-blocking tagging API requires the concurrent.futures module.')
+    if _executor is None:
+        _executor_lock.acquire()
+        try:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=settings.ASYNC_TAGGING_WORKERS)
+        finally:
+            _executor_lock.release()
+    return _executor
+
+def _run(func, args, kwargs):
+    # Each worker thread gets its own connections, to the replica and
+    # shards too; close them once the job is done so idle workers don't
+    # pin database connections.
+    try:
+        return func(*args, **kwargs)
+    finally:
+        for alias in connections:
+            connections[alias].close()
+
+def submit(func, *args, **kwargs):
+    """
+    Runs ``func(*args, **kwargs)`` on the tagging thread pool and
+    returns a ``Future`` for its result.
+    """
+    return get_executor().submit(_run, func, args, kwargs)
+
+def gather(futures):
+    """
+    Returns a ``Future`` which resolves to a list of the results of the
+    given futures, in order, once all of them have completed. The first
+    exception raised by any of them is propagated instead.
+    """
+    get_executor()
+    futures = list(futures)
+    result = Future()
+    results = [None] * len(futures)
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    if not futures:
+        result.set_result(results)
+        return result
+
+    def make_callback(index):
+        def callback(future):
+            lock.acquire()
+            try:
+                if result.done():
+                    return
+                if future.exception() is not None:
+                    result.set_exception(future.exception())
+                    return
+                results[index] = future.result()
+                remaining[0] -= 1
+                if not remaining[0]:
+                    result.set_result(results)
+            finally:
+                lock.release()
+        return callback
+
+    for index, future in enumerate(futures):
+        future.add_done_callback(make_callback(index))
+    return result
@@ -3,22 +3,30 @@ A custom Model Field for tagging.
 """
 from django.db.models import signals
 from django.db.models.fields import CharField
-from django.utils.translation import ugettext_lazy as _
+from django.utils.translation import ugettext as _
 
 from tagging import settings
+from tagging.context import get_current_owner
 from tagging.models import Tag
-from tagging.utils import edit_string_for_tags
+from tagging.utils import canonicalize_tag_name, edit_string_for_tags, parse_tag_input
 
 
-class TagFieldOld(CharField):
+class TagField(CharField):
     """
     A "special" character field that actually works as a relationship to tags
     "under the hood". This exposes a space-separated string of tags, but does
     the splitting/reordering/etc. under the hood.
+
+    The string is also stored in the field's own column, so loading an
+    instance costs no tagging queries. Tags are only written back on
+    save if the set of tags in the string has changed since the instance
+    was loaded or last saved, on behalf of the owner set with
+    ``tagging.context.tagging_owner``.
     """
     def __init__(self, *args, **kwargs):
         kwargs['max_length'] = kwargs.get('max_length', 255)
         kwargs['blank'] = kwargs.get('blank', True)
+        kwargs['null'] = kwargs.get('null', True)
         super(TagField, self).__init__(*args, **kwargs)
 
     def contribute_to_class(self, cls, name):
@@ -27,7 +35,9 @@ class TagFieldOld(CharField):
         # Make this object the descriptor for field access.
         setattr(cls, self.name, self)
 
-        # Save tags back to the database post-save
+        # Remember what was loaded, and save tags back to the database
+        # post-save if that changed.
+        signals.post_init.connect(self._init, cls, True)
         signals.post_save.connect(self._save, cls, True)
 
     def __get__(self, instance, owner=None):
@@ -48,19 +58,22 @@ class TagFieldOld(CharField):
            >>> Link.tags
            'tag1 tag2 tag3 tag4'
 
+        Rows saved before the column was filled in hold ``NULL``; their
+        tags are looked up the first time they are accessed.
         """
         # Handle access on the model (i.e. Link.tags)
         if instance is None:
-            return edit_string_for_tags(Tag.objects.usage_for_model(owner))
+            return edit_string_for_tags(Tag.objects.get_for_model(owner))
 
         tags = self._get_instance_tag_cache(instance)
         if tags is None:
             if instance.pk is None:
-                self._set_instance_tag_cache(instance, '')
+                tags = ''
             else:
-                self._set_instance_tag_cache(
-                    instance, edit_string_for_tags(Tag.objects.get_for_object(instance)))
-        return self._get_instance_tag_cache(instance)
+                tags = edit_string_for_tags(Tag.objects.get_for_object(instance))
+                self._set_original(instance, tags)
+            self._set_instance_tag_cache(instance, tags)
+        return tags
 
     def __set__(self, instance, value):
         """
@@ -72,20 +85,51 @@ class TagFieldOld(CharField):
             value = value.lower()
         self._set_instance_tag_cache(instance, value)
 
+    def __delete__(self, instance):
+        """
+        Clear all of an object's tags.
+        """
+        self._set_instance_tag_cache(instance, '')
+
+    def pre_save(self, model_instance, add):
+        # Refuse changes nobody owns before the row is written, and store
+        # whatever we hold without triggering a lookup.
+        if self._has_changed(model_instance) and get_current_owner() is None:
+            raise AttributeError(_('Saving changed tags requires an owner; use tagging_owner().'))
+        return self._get_instance_tag_cache(model_instance)
+
+    def _init(self, **kwargs):
+        """
+        Record the value an instance was loaded with. New instances have
+        no original value, so any tags they are given get saved.
+        """
+        instance = kwargs['instance']
+        if instance.pk is None:
+            if self._get_instance_tag_cache(instance) is None:
+                self._set_instance_tag_cache(instance, '')
+            self._set_original(instance, None)
+        else:
+            self._set_original(instance, self._get_instance_tag_cache(instance))
+
     def _save(self, **kwargs): #signal, sender, instance):
         """
-        Save tags back to the database
+        Save tags back to the database if they changed.
         """
-        from django.contrib.auth.models import User
-        tags = self._get_instance_tag_cache(kwargs['instance'])
-        if tags is not None:
-            Tag.objects.update_tags(kwargs['instance'], tags, User.objects.all()[0])
+        instance = kwargs['instance']
+        if self._has_changed(instance):
+            tags = self._get_instance_tag_cache(instance)
+            Tag.objects.update_tags(instance, tags, get_current_owner())
+            self._set_original(instance, tags)
 
-    def __delete__(self, instance):
+    def _has_changed(self, instance):
         """
-        Clear all of an object's tags.
+        Whether the set of tags held differs from the one loaded or last
+        saved.
         """
-        self._set_instance_tag_cache(instance, '')
+        tags = self._get_instance_tag_cache(instance)
+        if tags is None:
+            return False
+        return _tag_set(self._get_original(instance)) != _tag_set(tags)
 
     def _get_instance_tag_cache(self, instance):
         """
@@ -99,6 +143,18 @@ class TagFieldOld(CharField):
         """
         setattr(instance, '_%s_cache' % self.attname, tags)
 
+    def _get_original(self, instance):
+        """
+        Helper: get the tags an instance was loaded or last saved with.
+        """
+        return getattr(instance, '_%s_original' % self.attname, None)
+
+    def _set_original(self, instance, tags):
+        """
+        Helper: set the tags an instance was loaded or last saved with.
+        """
+        setattr(instance, '_%s_original' % self.attname, tags)
+
     def get_internal_type(self):
         return 'CharField'
 
@@ -107,3 +163,6 @@ class TagFieldOld(CharField):
         defaults = {'form_class': forms.TagField}
         defaults.update(kwargs)
         return super(TagField, self).formfield(**defaults)
+
+def _tag_set(tags):
+    return set([canonicalize_tag_name(name) for name in parse_tag_input(tags)])
@@ -6,7 +6,7 @@ from django.utils.translation import ugettext as _
 
 from tagging import settings
 from tagging.models import Tag
-from tagging.utils import parse_tag_input
+from tagging.utils import canonicalize_tag_name, parse_tag_input
 
 class AdminTagForm(forms.ModelForm):
     class Meta:
@@ -21,6 +21,11 @@ class AdminTagForm(forms.ModelForm):
             raise forms.ValidationError(
                 _('A tag may be no more than %s characters long.') %
                     settings.MAX_TAG_LENGTH)
+        duplicates = Tag.objects.filter(canonical=canonicalize_tag_name(tag_names[0])) \
+                                .exclude(pk=self.instance.pk)
+        if duplicates:
+            raise forms.ValidationError(
+                _('A tag named "%s" already exists.') % duplicates[0].name)
         return value
 
 class TagField(forms.CharField):
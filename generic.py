@@ -1,6 +1,6 @@
 from django.contrib.contenttypes.models import ContentType
 
-def fetch_content_objects(tagged_items, select_related_for=None):
+def fetch_content_objects(tagged_items, select_related_for=None, hints=None):
     """
     Retrieves ``ContentType`` and content objects for the given list of
     ``TaggedItems``, grouping the retrieval of content objects by model
@@ -14,8 +14,15 @@ def fetch_content_objects(tagged_items, select_related_for=None):
     of model names (corresponding to the ``model`` field of a
     ``ContentType``) for which ``select_related`` should be used when
     retrieving model instances.
+
+    ``hints`` can map model names to a dict of ``select_related`` and
+    ``only`` argument lists to use when retrieving their instances.
+
+    Items whose content object no longer exists get ``None`` as their
+    ``object``.
     """
     if select_related_for is None: select_related_for = []
+    if hints is None: hints = {}
 
     # Group content object pks by their content type pks
     objects = {}
@@ -25,16 +32,21 @@ def fetch_content_objects(tagged_items, select_related_for=None):
     # Retrieve content types and content objects in bulk
     content_types = ContentType._default_manager.in_bulk(objects.keys())
     for content_type_pk, object_pks in objects.iteritems():
-        model = content_types[content_type_pk].model_class()
-        if content_types[content_type_pk].model in select_related_for:
-            objects[content_type_pk] = model._default_manager.select_related().in_bulk(object_pks)
-        else:
-            objects[content_type_pk] = model._default_manager.in_bulk(object_pks)
+        content_type = content_types[content_type_pk]
+        queryset = content_type.model_class()._default_manager.all()
+        if content_type.model in select_related_for:
+            queryset = queryset.select_related()
+        model_hints = hints.get(content_type.model, {})
+        if model_hints.get('select_related'):
+            queryset = queryset.select_related(*model_hints['select_related'])
+        if model_hints.get('only'):
+            queryset = queryset.only(*model_hints['only'])
+        objects[content_type_pk] = queryset.in_bulk(object_pks)
 
     # Set content types and content objects in the appropriate cache
     # attributes, so accessing the 'content_type' and 'object'
     # attributes on each tagged item won't result in further database
     # hits.
     for item in tagged_items:
-        item._object_cache = objects[item.content_type_id][item.object_id]
+        item._object_cache = objects[item.content_type_id].get(item.object_id)
         item._content_type_cache = content_types[item.content_type_id]
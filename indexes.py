@@ -0,0 +1,121 @@
+"""
+Composite indexes backing the tagging query patterns.
+
+Models can only declare single column indexes, so these are created
+after ``syncdb`` by the handler in ``tagging.management`` and can be
+added to an existing database with ``manage.py tagging_indexes``.
+"""
+import sys
+
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+
+from tagging import db
+
+# Backends which support ``CREATE INDEX ... WHERE`` in a way the ORM's
+# queries can use. SQLite has partial indexes, but can't match them
+# against the bound parameter Django passes for ``popular=True``.
+PARTIAL_INDEX_VENDORS = ('postgresql',)
+
+# Backends which support ``CREATE INDEX IF NOT EXISTS``.
+IF_NOT_EXISTS_VENDORS = ('postgresql', 'sqlite')
+
+class Index(object):
+    """
+    An index over ``columns`` of ``table``.
+
+    ``where`` names a boolean column the index is restricted to, where
+    the backend supports partial indexes; elsewhere that column is put
+    in the key after the leading ``partial_prefix`` columns instead.
+    Trailing key columns which only serve to cover a query are listed
+    last, since no backend we target has a portable ``INCLUDE``.
+    """
+    def __init__(self, name, table, columns, where=None, partial_prefix=0):
+        self.name = name
+        self.table = table
+        self.columns = list(columns)
+        self.where = where
+        self.partial_prefix = partial_prefix
+
+    def sql(self, using=None):
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        qn = connection.ops.quote_name
+        vendor = db.get_vendor(using)
+        columns = self.columns
+        where = ''
+        if self.where is not None:
+            if vendor in PARTIAL_INDEX_VENDORS:
+                where = ' WHERE %s' % qn(self.where)
+            else:
+                columns = columns[:self.partial_prefix] + [self.where] + \
+                          columns[self.partial_prefix:]
+        if vendor in IF_NOT_EXISTS_VENDORS:
+            create = 'CREATE INDEX IF NOT EXISTS'
+        else:
+            create = 'CREATE INDEX'
+        return '%s %s ON %s (%s)%s' % (create, qn(self.name), qn(self.table),
+                                       ', '.join([qn(column) for column in columns]),
+                                       where)
+
+def get_indexes():
+    """
+    Returns the ``Index`` instances the tagging tables should have.
+    """
+    from tagging.models import Tag, TaggedItem, TagSignatureBand, TrendBucket
+
+    opts = TaggedItem._meta
+    tag, content_type, object_id, popular = [opts.get_field(name).column for name in \
+                                             ('tag', 'content_type', 'object_id', 'popular')]
+    item_owners, item_column, item_owner_column = db.m2m_table(TaggedItem, 'owners')
+    tag_owners, tag_column, tag_owner_column = db.m2m_table(Tag, 'owners')
+
+    return [
+        # get_for_object and refresh_popular look items up by object;
+        # tag and popular make the index covering for both.
+        Index('tagging_taggeditem_object', opts.db_table,
+              (content_type, object_id, tag, popular)),
+        # get_for_object(..., top=k) reads an object's items by score.
+        Index('tagging_taggeditem_score', opts.db_table,
+              (content_type, object_id, opts.get_field('score').column, tag)),
+        # Listings of the objects a tag is popular on, per content type.
+        Index('tagging_taggeditem_popular', opts.db_table,
+              (content_type, tag, object_id), where=popular, partial_prefix=2),
+        # The ``is_own`` subquery and per-owner lookups go from the owner
+        # to the item; the unique index only covers the other direction.
+        Index('tagging_taggeditem_owners_owner', item_owners,
+              (item_owner_column, item_column)),
+        Index('tagging_tag_owners_owner', tag_owners,
+              (tag_owner_column, tag_column)),
+        # Tag.objects.trending reads a window of buckets per content type;
+        # the unique index leads with the tag instead.
+        Index('tagging_trendbucket_window', TrendBucket._meta.db_table,
+              [TrendBucket._meta.get_field(name).column for name in \
+               ('content_type', 'bucket', 'tag', 'count')]),
+        # Updating a signature replaces the bands of its object; the
+        # unique index serves the lookups by band hash.
+        Index('tagging_tagsignatureband_object', TagSignatureBand._meta.db_table,
+              [TagSignatureBand._meta.get_field(name).column for name in \
+               ('content_type', 'object_id')]),
+    ]
+
+def create_indexes(using=None, verbosity=1):
+    """
+    Creates any of the tagging indexes which don't exist yet.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    cursor = connections[using].cursor()
+    check_exists = db.get_vendor(using) not in IF_NOT_EXISTS_VENDORS
+    for index in get_indexes():
+        if verbosity >= 1:
+            sys.stdout.write('Installing index %s on %s\n' % (index.name, index.table))
+        if check_exists:
+            # No IF NOT EXISTS: let the backend refuse duplicates.
+            sid = transaction.savepoint(using=using)
+            try:
+                cursor.execute(index.sql(using))
+            except DatabaseError:
+                transaction.savepoint_rollback(sid, using=using)
+            else:
+                transaction.savepoint_commit(sid, using=using)
+        else:
+            cursor.execute(index.sql(using))
+    transaction.commit_unless_managed(using=using)
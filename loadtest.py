@@ -0,0 +1,255 @@
+"""
+A load generator running a mix of concurrent tagging reads and writes.
+
+Microbenchmarks of single calls miss the contention between writers and
+readers of the same objects, such as ``update_tags`` and the
+``refresh_popular`` updates it makes. ``run`` starts a number of workers,
+threads or processes, each picking operations at random in the
+proportions of a mix, and objects, tags and owners with a Zipfian
+distribution so that a few hot ones get most of the traffic. The
+operations are:
+
+- ``add_tag``: an owner adds a tag to an object;
+- ``update_tags``: an owner replaces their tags on an object;
+- ``get_for_object``: the tags of an object, marking the owner's;
+- ``match_all``: the objects having two tags;
+- ``cloud``: the tag cloud of the model.
+
+An operation failing with a lock error, such as a deadlock or a
+serialization failure, is rolled back and retried up to ``retries``
+times. ``summarize`` reports the throughput, the latency percentiles and
+the retries and failures of each operation.
+
+The writes are real: run it against a copy of the data.
+"""
+import bisect
+import random
+import sys
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.db import DatabaseError, connections, transaction
+
+from tagging.models import Tag, TaggedItem
+from tagging.utils import calculate_cloud, get_tag_list
+
+OPERATIONS = ('add_tag', 'update_tags', 'get_for_object', 'match_all', 'cloud')
+
+DEFAULT_MIX = {
+    'add_tag': 1,
+    'update_tags': 1,
+    'get_for_object': 6,
+    'match_all': 1,
+    'cloud': 1,
+}
+
+# Fragments of the messages of the errors worth retrying, across the
+# supported backends.
+LOCK_ERRORS = ('deadlock', 'lock wait timeout', 'database is locked',
+               'could not serialize', 'lock timeout')
+
+class Zipf(object):
+    """
+    Draws ranks from 0 to ``n - 1``, rank ``k`` having a probability
+    proportional to ``1 / (k + 1) ** s``.
+    """
+    def __init__(self, n, s=1.0):
+        self.cumulative = []
+        total = 0.0
+        for k in range(n):
+            total += 1.0 / (k + 1) ** s
+            self.cumulative.append(total)
+
+    def draw(self, rng):
+        return bisect.bisect_left(self.cumulative, rng.random() * self.cumulative[-1])
+
+class Workload(object):
+    """
+    The objects, tags and owners a run picks from, and the operations
+    on them.
+    """
+    def __init__(self, model, object_ids, tag_names, owner_ids, mix=None, s=1.0, retries=3):
+        if not object_ids or not tag_names or not owner_ids:
+            raise ValueError('A load test needs objects, tags and owners.')
+        self.model = model
+        self.object_ids = object_ids
+        self.tag_names = tag_names
+        self.owner_ids = owner_ids
+        self.mix = mix or DEFAULT_MIX
+        self.retries = retries
+        self.objects = Zipf(len(object_ids), s)
+        self.tags = Zipf(len(tag_names), s)
+        self.owners = Zipf(len(owner_ids), s)
+        self.operations = []
+        self.weights = []
+        total = 0
+        for name in OPERATIONS:
+            if self.mix.get(name):
+                total += self.mix[name]
+                self.operations.append(name)
+                self.weights.append(total)
+
+    def pick_operation(self, rng):
+        return self.operations[bisect.bisect_right(self.weights, rng.random() * self.weights[-1])]
+
+    def pick_object(self, rng):
+        return self.model(pk=self.object_ids[self.objects.draw(rng)])
+
+    def pick_tag(self, rng):
+        return self.tag_names[self.tags.draw(rng)]
+
+    def pick_owner(self, rng):
+        return User(pk=self.owner_ids[self.owners.draw(rng)])
+
+    def add_tag(self, rng):
+        Tag.objects.add_tag(self.pick_object(rng), self.pick_tag(rng), self.pick_owner(rng))
+
+    def update_tags(self, rng):
+        tag_names = set([self.pick_tag(rng) for i in range(rng.randint(1, 5))])
+        Tag.objects.update_tags(self.pick_object(rng), ' '.join(tag_names), self.pick_owner(rng))
+
+    def get_for_object(self, rng):
+        list(Tag.objects.get_for_object(self.pick_object(rng), self.pick_owner(rng), records=True))
+
+    def match_all(self, rng):
+        tags = get_tag_list([self.pick_tag(rng), self.pick_tag(rng)])
+        list(TaggedItem.objects.match_all(self.model, tags)[:100])
+
+    def cloud(self, rng):
+        calculate_cloud(Tag.objects.usage_for_model(self.model, counts=True, records=True))
+
+def _is_lock_error(error):
+    message = str(error).lower()
+    for fragment in LOCK_ERRORS:
+        if fragment in message:
+            return True
+    return False
+
+def _rollback():
+    for alias in connections:
+        transaction.rollback_unless_managed(using=alias)
+
+def new_stats():
+    return dict([(name, {'latencies': [], 'retries': 0, 'errors': 0}) for name in OPERATIONS])
+
+def merge_stats(stats, other):
+    for name, values in other.items():
+        stats[name]['latencies'].extend(values['latencies'])
+        stats[name]['retries'] += values['retries']
+        stats[name]['errors'] += values['errors']
+    return stats
+
+def work(workload, seed, deadline=None, operations=None):
+    """
+    Runs operations of ``workload`` until ``deadline``, a ``time.time()``
+    value, or until ``operations`` have been run, and returns their
+    stats: for each operation, the latencies in seconds of those which
+    succeeded and the numbers of retries and of failures.
+    """
+    rng = random.Random(seed)
+    stats = new_stats()
+    done = 0
+    while (deadline is None or time.time() < deadline) and \
+          (operations is None or done < operations):
+        name = workload.pick_operation(rng)
+        operation = getattr(workload, name)
+        attempt = 0
+        start = time.time()
+        while True:
+            try:
+                operation(rng)
+            except DatabaseError:
+                _rollback()
+                if _is_lock_error(sys.exc_info()[1]) and attempt < workload.retries:
+                    attempt += 1
+                    stats[name]['retries'] += 1
+                    continue
+                stats[name]['errors'] += 1
+            else:
+                stats[name]['latencies'].append(time.time() - start)
+            break
+        done += 1
+    return stats
+
+def _work_and_close(args):
+    try:
+        return work(*args)
+    finally:
+        for alias in connections:
+            connections[alias].close()
+
+def run(workload, workers=4, duration=30, operations=None, processes=False, seed=None):
+    """
+    Runs ``workload`` on ``workers`` threads, or processes if
+    ``processes`` is true, for ``duration`` seconds or until each worker
+    has run ``operations`` operations. A single worker runs in this
+    thread. Returns the merged stats and the time taken in seconds.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 31)
+    deadline = duration is not None and time.time() + duration or None
+    jobs = [(workload, seed + i, deadline, operations) for i in range(workers)]
+    stats = new_stats()
+    start = time.time()
+
+    if workers == 1:
+        merge_stats(stats, work(*jobs[0]))
+    elif processes:
+        from multiprocessing import Pool
+
+        # Forked workers must not share the parent's connections.
+        for alias in connections:
+            connections[alias].close()
+        pool = Pool(workers)
+        try:
+            for result in pool.imap_unordered(_work_and_close, jobs):
+                merge_stats(stats, result)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+        def target(job):
+            results.append(_work_and_close(job))
+        threads = [threading.Thread(target=target, args=(job,)) for job in jobs]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for result in results:
+            merge_stats(stats, result)
+    return stats, time.time() - start
+
+def percentile(values, p):
+    """
+    Returns the ``p``th percentile of the sorted ``values``, by nearest
+    rank, or ``None`` if there are none.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+def summarize(stats, elapsed):
+    """
+    Returns a dictionary per operation run with its ``count`` of
+    successes, ``throughput`` per second, ``p50``, ``p95`` and ``p99``
+    latencies in milliseconds, ``retries`` and ``errors``.
+    """
+    summary = {}
+    for name in OPERATIONS:
+        values = stats[name]
+        latencies = sorted(values['latencies'])
+        if not latencies and not values['errors']:
+            continue
+        row = {
+            'count': len(latencies),
+            'throughput': elapsed and len(latencies) / elapsed or 0.0,
+            'retries': values['retries'],
+            'errors': values['errors'],
+        }
+        for p in (50, 95, 99):
+            value = percentile(latencies, p)
+            row['p%d' % p] = value is not None and value * 1000 or None
+        summary[name] = row
+    return summary
@@ -0,0 +1,14 @@
+"""
+Creates the tagging indexes once ``syncdb`` has created the tables.
+"""
+from django.db.models import signals
+
+from tagging import indexes, models as tagging_app
+from tagging.models import TaggedItem, TagSignatureBand, TrendBucket
+
+def create_indexes(sender, created_models, verbosity=1, db=None, **kwargs):
+    if TaggedItem in created_models or TrendBucket in created_models or \
+            TagSignatureBand in created_models:
+        indexes.create_indexes(using=db, verbosity=verbosity)
+
+signals.post_syncdb.connect(create_indexes, sender=tagging_app)
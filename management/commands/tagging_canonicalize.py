@@ -0,0 +1,109 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from tagging import shards
+from tagging.models import Tag, TaggedItem
+from tagging.utils import canonicalize_tag_name
+
+class Command(NoArgsCommand):
+    help = ('Fills in canonical tag names, adding the column if needed, and merges '
+            'tags whose names only differ in case, width or spacing.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to canonicalize.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='How many tags to read or update per statement.'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options.get('database')
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+        # Shards keep copies of the tags, with the ids of the default
+        # database, and their own items.
+        databases = [using]
+        if using == DEFAULT_DB_ALIAS:
+            databases.extend(shards.databases())
+        self.added_columns = set()
+        for alias in databases:
+            self.add_column(alias)
+
+        # One pass over the tags in primary key order: the first tag seen
+        # with a canonical name keeps it, later ones get merged into it.
+        seen, mapping, updates = {}, {}, []
+        last_pk = 0
+        while True:
+            rows = list(Tag.objects.using(using).filter(pk__gt=last_pk).order_by('pk') \
+                        .values_list('pk', 'name', 'canonical')[:batch_size])
+            if not rows:
+                break
+            for pk, name, current in rows:
+                canonical = canonicalize_tag_name(name)
+                target = seen.setdefault(canonical, pk)
+                if target != pk:
+                    mapping[pk] = target
+                elif current != canonical:
+                    updates.append((canonical, pk))
+            last_pk = rows[-1][0]
+
+        targets = list(Tag.objects.using(using).filter(pk__in=set(mapping.values())))
+        affected = []
+        for alias in databases:
+            if alias != using:
+                shards.copy_tags(targets, alias)
+            affected.extend(Tag.objects._merge(mapping, using=alias))
+            self.update_canonical(updates, batch_size, alias)
+
+        object_ids = {}
+        for content_type_id, object_id in set(affected):
+            object_ids.setdefault(content_type_id, []).append(object_id)
+        for content_type_id, ids in object_ids.items():
+            for i in range(0, len(ids), batch_size):
+                TaggedItem.refresh_popular_many(content_type_id, ids[i:i + batch_size])
+
+        if verbosity >= 1:
+            sys.stdout.write('Canonicalized %d tags, merged %d duplicates into %d tags.\n' % (
+                len(updates), len(mapping), len(set(mapping.values()))))
+
+    def add_column(self, using):
+        """
+        Adds the canonical name column to the tags of the database
+        ``using`` if it is missing, without its unique index, which
+        ``update_canonical`` creates once the names are filled in.
+        """
+        connection = connections[using]
+        cursor = connection.cursor()
+        opts = Tag._meta
+        field = opts.get_field('canonical')
+        columns = [row[0] for row in \
+                   connection.introspection.get_table_description(cursor, opts.db_table)]
+        if field.column not in columns:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s varchar(%d) NULL' % (
+                connection.ops.quote_name(opts.db_table), connection.ops.quote_name(field.column),
+                field.max_length))
+            transaction.commit_unless_managed(using=using)
+            self.added_columns.add(using)
+
+    def update_canonical(self, updates, batch_size, using):
+        """
+        Sets the canonical names of the ``(canonical, pk)`` pairs
+        ``updates`` in the database ``using``, and creates the unique
+        index on them if ``add_column`` added the column.
+        """
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        opts = Tag._meta
+        field = opts.get_field('canonical')
+        sql = 'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+            qn(opts.db_table), qn(field.column), qn(opts.pk.column))
+        for i in range(0, len(updates), batch_size):
+            cursor.executemany(sql, updates[i:i + batch_size])
+        if using in self.added_columns:
+            cursor.execute('CREATE UNIQUE INDEX %s ON %s (%s)' % (
+                qn('%s_%s' % (opts.db_table, field.column)), qn(opts.db_table), qn(field.column)))
+        transaction.commit_unless_managed(using=using)
@@ -0,0 +1,35 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from tagging.transfer import export
+
+class Command(NoArgsCommand):
+    help = ('Writes every tag and tagged item, with their owners, as NDJSON, reading the '
+            'tables in batches.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', action='store', dest='output',
+            default=None, help='Nominates a file to write to instead of standard output.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='How many rows to read per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        output = options.get('output')
+        verbosity = int(options.get('verbosity', 1))
+        def progress(tags, items):
+            if verbosity >= 2:
+                sys.stderr.write('Exported %d tags and %d items.\n' % (tags, items))
+        if output:
+            stream = open(output, 'w')
+        else:
+            stream = sys.stdout
+        try:
+            tags, items = export(stream, options.get('batch_size'), progress)
+        finally:
+            if output:
+                stream.close()
+        if verbosity >= 1:
+            sys.stderr.write('Exported %d tags and %d items.\n' % (tags, items))
@@ -0,0 +1,22 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from tagging.cleanup import collect_garbage
+
+class Command(NoArgsCommand):
+    help = ('Deletes tagged items whose object or owners are gone, owners of tags '
+            'they no longer use, tags which are on no item and expired trend counts.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='How many rows to delete per statement.'),
+    )
+
+    def handle_noargs(self, **options):
+        deleted = collect_garbage(options.get('batch_size'))
+        if int(options.get('verbosity', 1)) >= 1:
+            for name in ('orphaned_items', 'ownerless_items', 'stale_tag_owners', 'unused_tags',
+                         'expired_buckets'):
+                sys.stdout.write('Deleted %d %s.\n' % (deleted[name], name.replace('_', ' ')))
@@ -0,0 +1,35 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tagging.transfer import load
+
+class Command(BaseCommand):
+    help = ('Loads tags and tagged items written by tagging_export, in batches, then '
+            'recomputes their popularity.')
+    args = '<file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='How many records to insert per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Enter the file to import, or - for standard input.')
+        verbosity = int(options.get('verbosity', 1))
+        def progress(tags, items):
+            if verbosity >= 2:
+                sys.stdout.write('Imported %d tags and %d items.\n' % (tags, items))
+        if args[0] == '-':
+            stream = sys.stdin
+        else:
+            stream = open(args[0])
+        try:
+            tags, items = load(stream, options.get('batch_size'), progress)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        if verbosity >= 1:
+            sys.stdout.write('Imported %d tags and %d items.\n' % (tags, items))
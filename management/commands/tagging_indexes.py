@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from tagging import indexes
+
+class Command(NoArgsCommand):
+    help = 'Creates the composite tagging indexes missing from an existing database.'
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to create the indexes in.'),
+        make_option('--sql', action='store_true', dest='sql', default=False,
+            help='Print the CREATE INDEX statements instead of running them.'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options.get('database')
+        if options.get('sql'):
+            return '\n'.join(['%s;' % index.sql(using) for index in indexes.get_indexes()])
+        indexes.create_indexes(using=using, verbosity=int(options.get('verbosity', 1)))
@@ -0,0 +1,91 @@
+import sys
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from tagging import loadtest
+from tagging.models import Tag
+
+class Command(BaseCommand):
+    help = ('Runs a mix of concurrent tagging reads and writes on the objects of a model, '
+            'and reports the throughput, latency percentiles and retries of each operation. '
+            'The writes are real: run it against a copy of the data.')
+    args = '<app_label.model>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', action='store', type='int', dest='workers',
+            default=4, help='How many workers to run concurrently.'),
+        make_option('--processes', action='store_true', dest='processes',
+            default=False, help='Runs the workers as processes rather than threads.'),
+        make_option('--duration', action='store', type='float', dest='duration',
+            default=30, help='How many seconds to run for.'),
+        make_option('--mix', action='store', dest='mix', default=None,
+            help='The weights of the operations, as in '
+                 'add_tag=1,update_tags=1,get_for_object=6,match_all=1,cloud=1.'),
+        make_option('--objects', action='store', type='int', dest='objects',
+            default=1000, help='How many objects to pick from.'),
+        make_option('--tags', action='store', type='int', dest='tags',
+            default=200, help='How many tag names to pick from.'),
+        make_option('--owners', action='store', type='int', dest='owners',
+            default=100, help='How many users to pick from.'),
+        make_option('--zipf', action='store', type='float', dest='zipf',
+            default=1.0, help='The exponent of the Zipfian distributions.'),
+        make_option('--retries', action='store', type='int', dest='retries',
+            default=3, help='How many times to retry an operation failing with a lock error.'),
+        make_option('--seed', action='store', type='int', dest='seed', default=None,
+            help='Seeds the random choices of the workers.'),
+    )
+
+    def parse_mix(self, value):
+        mix = {}
+        for part in value.split(','):
+            name, sep, weight = part.partition('=')
+            name = name.strip()
+            if name not in loadtest.OPERATIONS:
+                raise CommandError('Unknown operation "%s", expected one of %s.' % (
+                    name, ', '.join(loadtest.OPERATIONS)))
+            try:
+                mix[name] = int(weight)
+            except ValueError:
+                raise CommandError('Enter a whole weight for "%s".' % name)
+        return mix
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or '.' not in args[0]:
+            raise CommandError('Enter the model to load, as app_label.model.')
+        model = get_model(*args[0].split('.', 1))
+        if model is None:
+            raise CommandError('Unknown model "%s".' % args[0])
+        mix = options.get('mix') and self.parse_mix(options['mix']) or None
+
+        object_ids = list(model._default_manager.order_by('pk') \
+                               .values_list('pk', flat=True)[:options.get('objects')])
+        tag_names = list(Tag.objects.order_by('pk').values_list('name', flat=True)[:options.get('tags')])
+        tag_names.extend(['loadtest%d' % i for i in range(options.get('tags') - len(tag_names))])
+        owner_ids = list(User.objects.order_by('pk').values_list('pk', flat=True)[:options.get('owners')])
+        try:
+            workload = loadtest.Workload(model, object_ids, tag_names, owner_ids, mix,
+                                         options.get('zipf'), options.get('retries'))
+        except ValueError:
+            raise CommandError(str(sys.exc_info()[1]))
+
+        stats, elapsed = loadtest.run(workload, options.get('workers'), options.get('duration'),
+                                      processes=options.get('processes'), seed=options.get('seed'))
+        summary = loadtest.summarize(stats, elapsed)
+        sys.stdout.write('%-16s %8s %8s %9s %9s %9s %8s %7s\n' % (
+            'operation', 'count', 'ops/s', 'p50 ms', 'p95 ms', 'p99 ms', 'retries', 'errors'))
+        for name in loadtest.OPERATIONS:
+            if name not in summary:
+                continue
+            row = summary[name]
+            sys.stdout.write('%-16s %8d %8.1f %9s %9s %9s %8d %7d\n' % (
+                name, row['count'], row['throughput'],
+                self.format_latency(row['p50']), self.format_latency(row['p95']),
+                self.format_latency(row['p99']), row['retries'], row['errors']))
+
+    def format_latency(self, value):
+        if value is None:
+            return '-'
+        return '%.1f' % value
@@ -0,0 +1,40 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import get_model
+
+from tagging.shards import move_items
+
+class Command(BaseCommand):
+    help = ('Moves the tagged items of a model, with their owners, from one database '
+            'to another in batches.')
+    args = '<app_label.model> <database>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--from', action='store', dest='source',
+            default=DEFAULT_DB_ALIAS, help='Nominates the database to move the items from.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='How many items to move per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Enter a model as app_label.model and a database to move to.')
+        try:
+            app_label, model_name = args[0].split('.')
+        except ValueError:
+            raise CommandError('Enter the model as app_label.model.')
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise CommandError('Unknown model: %s' % args[0])
+
+        verbosity = int(options.get('verbosity', 1))
+        def progress(moved):
+            if verbosity >= 2:
+                sys.stdout.write('Moved %d items.\n' % moved)
+        moved = move_items(model, args[1], options.get('source'),
+                           options.get('batch_size'), progress)
+        if verbosity >= 1:
+            sys.stdout.write('Moved %d items of %s to %s.\n' % (moved, args[0], args[1]))
@@ -0,0 +1,27 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from tagging import outbox, settings
+
+class Command(NoArgsCommand):
+    help = ('Deletes the tagging change events up to a sequence number, and those older '
+            'than the retention period.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to compact the outbox of.'),
+        make_option('--before', action='store', type='int', dest='before',
+            default=None, help='Deletes the events up to this sequence number.'),
+        make_option('--older-than', action='store', type='int', dest='older_than',
+            default=settings.TAGGING_OUTBOX_RETENTION,
+            help='Deletes the events older than this many seconds.'),
+    )
+
+    def handle_noargs(self, **options):
+        deleted = outbox.compact(options.get('before'), options.get('older_than'),
+                                 options.get('database'))
+        if int(options.get('verbosity', 1)) >= 1:
+            sys.stdout.write('Deleted %d events.\n' % deleted)
@@ -0,0 +1,35 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from tagging import rebuild
+
+class Command(NoArgsCommand):
+    help = ('Recomputes the popularity and scores of every tagged item, in chunks of '
+            'objects spread over a pool of processes.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', action='store', type='int', dest='processes',
+            default=1, help='How many processes to rebuild with.'),
+        make_option('--chunk-size', action='store', type='int', dest='chunk_size',
+            default=10000, help='How many object ids each chunk spans.'),
+        make_option('--state', action='store', dest='state',
+            default=None, help='Records the chunks done in this file, to resume from it.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Counts the differences without correcting them.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        def progress(done, total):
+            if verbosity >= 2:
+                sys.stdout.write('Rebuilt %d of %d chunks.\n' % (done, total))
+        dry_run = options.get('dry_run')
+        popular, scores = rebuild.run(options.get('processes'), options.get('chunk_size'),
+                                      dry_run, options.get('state'), progress)
+        if verbosity >= 1:
+            if dry_run:
+                sys.stdout.write('%d popular flags and %d scores differ.\n' % (popular, scores))
+            else:
+                sys.stdout.write('Corrected %d popular flags and %d scores.\n' % (popular, scores))
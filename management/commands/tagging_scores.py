@@ -0,0 +1,54 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from tagging.models import TaggedItem
+
+class Command(NoArgsCommand):
+    help = ('Adds the score column of tagged items if needed and recomputes the '
+            'popularity and score of every tagged object.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to score.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=500, help='How many objects to refresh at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options.get('database')
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+
+        opts = TaggedItem._meta
+        field = opts.get_field('score')
+        columns = [row[0] for row in \
+                   connection.introspection.get_table_description(cursor, opts.db_table)]
+        if field.column not in columns:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT 0' % (
+                qn(opts.db_table), qn(field.column), field.db_type(connection=connection)))
+            transaction.commit_unless_managed(using=using)
+            if verbosity >= 1:
+                sys.stdout.write('Added %s.%s.\n' % (opts.db_table, field.column))
+
+        items = TaggedItem.objects.using(using)
+        refreshed = 0
+        for content_type_id in items.values_list('content_type', flat=True).distinct():
+            last = 0
+            while True:
+                ids = list(items.filter(content_type=content_type_id, object_id__gt=last) \
+                                .order_by('object_id').values_list('object_id', flat=True) \
+                                .distinct()[:batch_size])
+                if not ids:
+                    break
+                TaggedItem.refresh_popular_many(content_type_id, ids)
+                refreshed += len(ids)
+                last = ids[-1]
+
+        if verbosity >= 1:
+            sys.stdout.write('Scored the tags of %d objects.\n' % refreshed)
@@ -0,0 +1,40 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import get_model
+
+from tagging.similarity import rebuild
+
+class Command(BaseCommand):
+    help = ('Builds the MinHash signatures used by similar_to for every tagged object '
+            'of the given models, in batches.')
+    args = '<app_label.model app_label.model ...>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=500, help='How many objects to build the signatures of per batch.'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Enter at least one model as app_label.model.')
+        models = []
+        for label in args:
+            try:
+                app_label, model_name = label.split('.')
+            except ValueError:
+                raise CommandError('Enter the model as app_label.model.')
+            model = get_model(app_label, model_name)
+            if model is None:
+                raise CommandError('Unknown model: %s' % label)
+            models.append((label, model))
+
+        verbosity = int(options.get('verbosity', 1))
+        def progress(done):
+            if verbosity >= 2:
+                sys.stdout.write('Built %d signatures.\n' % done)
+        for label, model in models:
+            done = rebuild(model, options.get('batch_size'), progress)
+            if verbosity >= 1:
+                sys.stdout.write('Built %d signatures of %s.\n' % (done, label))
@@ -0,0 +1,24 @@
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from tagging.sketches import rebuild
+
+class Command(NoArgsCommand):
+    help = ('Rebuilds the HyperLogLog sketches of the owners of every tag from the owner '
+            'tables, in batches of tags.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='How many tags to rebuild the sketches of per batch.'),
+    )
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        def progress(done):
+            if verbosity >= 2:
+                sys.stdout.write('Rebuilt the sketches of %d tags.\n' % done)
+        written = rebuild(options.get('batch_size'), progress)
+        if verbosity >= 1:
+            sys.stdout.write('Wrote %d sketches.\n' % written)
@@ -0,0 +1,66 @@
+import datetime
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from tagging import settings, trending
+from tagging.models import TaggedItem, TaggedItemOwner, TrendBucket
+
+class Command(NoArgsCommand):
+    help = ('Adds the timestamp columns of tagged items and their owners if needed, '
+            'and rebuilds the trend counts from the owners\' timestamps.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+            default=DEFAULT_DB_ALIAS, help='Nominates a database to rebuild the trends of.'),
+        make_option('--batch-size', action='store', type='int', dest='batch_size',
+            default=1000, help='How many owner rows to read per query.'),
+    )
+
+    def handle_noargs(self, **options):
+        using = options.get('database')
+        batch_size = options.get('batch_size')
+        verbosity = int(options.get('verbosity', 1))
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+
+        for model in (TaggedItem, TaggedItemOwner):
+            opts = model._meta
+            field = opts.get_field('created')
+            columns = [row[0] for row in \
+                       connection.introspection.get_table_description(cursor, opts.db_table)]
+            if field.column not in columns:
+                # Existing rows keep a NULL timestamp.
+                cursor.execute('ALTER TABLE %s ADD COLUMN %s %s NULL' % (
+                    qn(opts.db_table), qn(field.column), field.db_type(connection=connection)))
+                if verbosity >= 1:
+                    sys.stdout.write('Added %s.%s.\n' % (opts.db_table, field.column))
+        transaction.commit_unless_managed(using=using)
+
+        # One pass over the owner rows within the retention period, by
+        # primary key, counting per content type, tag and bucket.
+        since = time.time() - settings.TAGGING_TREND_RETENTION
+        links = TaggedItemOwner._default_manager.using(using) \
+                    .filter(created__gte=datetime.datetime.fromtimestamp(since))
+        counts, last_pk = {}, 0
+        while True:
+            rows = list(links.filter(pk__gt=last_pk).order_by('pk') \
+                             .values_list('pk', 'taggeditem__content_type', 'taggeditem__tag',
+                                          'created')[:batch_size])
+            if not rows:
+                break
+            for pk, content_type_id, tag_id, created in rows:
+                key = (content_type_id, tag_id, trending.bucket_for(time.mktime(created.timetuple())))
+                counts[key] = counts.get(key, 0) + 1
+            last_pk = rows[-1][0]
+
+        cursor.execute('DELETE FROM %s' % qn(TrendBucket._meta.db_table))
+        transaction.commit_unless_managed(using=using)
+        trending.add(counts, using)
+
+        if verbosity >= 1:
+            sys.stdout.write('Rebuilt %d trend buckets.\n' % len(counts))
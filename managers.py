@@ -5,6 +5,8 @@ application.
 from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
+from tagging import similarity
+from tagging.context import queue_tag_write
 from tagging.models import Tag, TaggedItem
 
 class ModelTagManager(models.Manager):
@@ -13,7 +15,7 @@ class ModelTagManager(models.Manager):
     """
     def get_query_set(self):
         ctype = ContentType.objects.get_for_model(self.model)
-        return Tag.objects.filter(
+        return Tag.objects.for_content_type(ctype).filter(
             items__content_type__pk=ctype.pk).distinct()
 
     def cloud(self, *args, **kwargs):
@@ -35,22 +37,32 @@ class ModelTaggedItemManager(models.Manager):
     def with_any(self, tags, filter_function=None):
         return TaggedItem.objects.match_any(self.model, tags, filter_function)
 
+    def similar_to(self, obj, k=10):
+        return similarity.similar_to(obj, k)
+
 class TagDescriptor(object):
     """
     A descriptor which provides access to a ``ModelTagManager`` for
     model classes and simple retrieval, updating and deletion of tags
     for model instances.
+
+    Instance access returns a list of tags, cached on the instance and
+    filled in bulk by ``Tag.objects.prefetch_tags``. Assignment and
+    deletion are queued on the enclosing ``tagging_owner`` block and
+    written on behalf of its owner when the block exits.
     """
     def __get__(self, instance, owner):
         if not instance:
             tag_manager = ModelTagManager()
             tag_manager.model = owner
             return tag_manager
-        else:
-            return Tag.objects.get_for_object(instance)
+        tags = getattr(instance, '_tag_cache', None)
+        if tags is None:
+            tags = instance._tag_cache = list(Tag.objects.get_for_object(instance))
+        return tags
 
     def __set__(self, instance, value):
-        Tag.objects.update_tags(instance, value)
+        queue_tag_write(instance, value)
 
     def __delete__(self, instance):
-        Tag.objects.update_tags(instance, None)
+        queue_tag_write(instance, None)
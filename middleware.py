@@ -0,0 +1,40 @@
+"""
+Tagging middleware.
+"""
+from tagging import membership, routers
+
+class ReplicaPinningMiddleware(object):
+    """
+    Makes the authenticated user the current reader for
+    ``tagging.routers.TaggingRouter``, so their tagging reads stay on the
+    primary for a while after they tag something. Must come after
+    ``AuthenticationMiddleware``.
+    """
+    def process_request(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            routers.set_current_reader(user)
+        else:
+            routers.set_current_reader(None)
+
+    def process_response(self, request, response):
+        routers.set_current_reader(None)
+        return response
+
+class OwnerMembershipMiddleware(object):
+    """
+    Activates a ``tagging.membership.OwnerMembership`` of the
+    authenticated user for the request, so the tags marked with
+    ``is_own`` for them are marked without further queries. Must come
+    after ``AuthenticationMiddleware``.
+    """
+    def process_request(self, request):
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated():
+            membership.activate(user)
+        else:
+            membership.deactivate()
+
+    def process_response(self, request, response):
+        membership.deactivate()
+        return response
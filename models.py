@@ -7,16 +7,21 @@ try:
 except NameError:
     from sets import Set as set
 
+import datetime
+
 from django.conf import settings
 from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection, models
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, models, router, transaction
 from django.db.models.query import QuerySet
 from django.utils.translation import ugettext_lazy as _
 
-from tagging import settings
-from tagging.utils import calculate_cloud, get_tag_list, get_queryset_and_model, parse_tag_input
-from tagging.utils import LOGARITHMIC, unique_from_iter
+from tagging import db, executor, membership, outbox, routers, settings, shards, similarity, sketches, trending, versions
+from tagging.records import from_queryset as tag_records
+from tagging.routers import reads_from_primary
+from tagging.utils import calculate_cloud, canonicalize_tag_name, get_tag, get_tag_list, get_queryset_and_model, parse_tag_input
+from tagging.utils import CANONICAL_MAX_LENGTH, LOGARITHMIC, unique_from_iter
 
 if hasattr(settings, 'OWNER_MODEL') and settings.OWNER_MODEL:
     OWNER_MODEL = settings.OWNER_MODEL
@@ -29,60 +34,112 @@ qn = connection.ops.quote_name
 
 
 
+class OwnerMarkedQuerySet(QuerySet):
+    """
+    A queryset of tags selecting the ``item_id`` of each, which sets
+    ``is_own`` on the tags it yields with the ``owns`` function given
+    by ``tagging.membership.lookup``.
+    """
+    owns = None
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('owns', self.owns)
+        return super(OwnerMarkedQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def iterator(self):
+        for tag in super(OwnerMarkedQuerySet, self).iterator():
+            tag.is_own = self.owns(tag.item_id)
+            yield tag
+
 ############
 # Managers #
 ############
 
 class TagManager(models.Manager):
 
+    def for_content_type(self, content_type):
+        """
+        Returns this manager bound to the database holding the tagged
+        items of ``content_type``, see ``tagging.shards``.
+        """
+        return shards.manager_for(self, content_type)
+
     def update_tags(self, obj, tag_names, owner):
         """
         Update tags associated with an object.
         """
-        ctype = ContentType.objects.get_for_model(obj)
-        current_tags = list(self.filter(items__content_type__pk=ctype.pk,
-                                        items__owners=owner,
-                                        items__object_id=obj.pk))
-        updated_tag_names = parse_tag_input(tag_names)
-        if settings.FORCE_LOWERCASE_TAGS:
-            updated_tag_names = [t.lower() for t in updated_tag_names]
-
-        # Remove tags which no longer apply
-        tags_for_removal = [tag for tag in current_tags \
-                            if tag.name not in updated_tag_names]
-        if len(tags_for_removal):
-            items = TaggedItem._default_manager.filter(content_type__pk=ctype.pk,
-                                                       object_id=obj.pk,
-                                                       tag__in=tags_for_removal)
-            for tag in tags_for_removal:
-                if TaggedItem._default_manager.filter(owners=owner, content_type=ctype, object_id=tag.pk).count() <= 1:
-                    tag.owners.remove(owner)
-                    tag.save()
-
-            for item in items:
-                # remove the owner from the list
-                item.owners.remove(owner)
-                # if no one is using this tag anymore, remove it
-                if item.owners.all().count():
-                    item.save()
-                else:
-                    item.delete()
-
-        # Add new tags
-        current_tag_names = [tag.name for tag in current_tags]
-        for tag_name in updated_tag_names:
-            if tag_name not in current_tag_names:
-                tag, created = self.get_or_create(name=tag_name)
-
-                if owner not in tag.owners.all():
-                    tag.owners.add(owner)
-                    tag.save()
-
-                t_item, created = TaggedItem._default_manager.get_or_create(tag=tag, object_id=obj.pk, content_type=ctype)
-                t_item.owners.add(owner)
-                t_item.save()
+        self.update_tags_many([(obj, tag_names)], owner)
+
+    @reads_from_primary
+    def update_tags_many(self, updates, owner):
+        """
+        Does what ``update_tags`` does for each ``(obj, tag_names)`` pair
+        in ``updates``, in a fixed number of queries per content type
+        rather than per object. If an object appears more than once, the
+        last tag names given for it win.
+        """
+        wanted = {}
+        object_ids = {}
+        for obj, tag_names in updates:
+            if obj.pk is None:
+                raise AttributeError(_('Objects must be saved before they are tagged.'))
+            ctype = ContentType.objects.get_for_model(obj)
+            updated_tag_names = parse_tag_input(tag_names)
+            if settings.FORCE_LOWERCASE_TAGS:
+                updated_tag_names = [t.lower() for t in updated_tag_names]
+            updated_tags = wanted[(ctype.pk, obj.pk)] = {}
+            for tag_name in updated_tag_names:
+                updated_tags.setdefault(canonicalize_tag_name(tag_name), tag_name)
+            object_ids.setdefault(ctype.pk, set()).add(obj.pk)
+
+        # The items the owner currently has on these objects
+        current = {}
+        for ctype_id, ids in object_ids.items():
+            items = TaggedItem._default_manager.for_content_type(ctype_id) \
+                                               .filter(content_type=ctype_id,
+                                                       object_id__in=list(ids),
+                                                       owners=owner)
+            for item_id, object_id, tag_id, canonical in \
+                    items.values_list('pk', 'object_id', 'tag', 'tag__canonical'):
+                current.setdefault((ctype_id, object_id), {})[canonical] = (item_id, tag_id)
 
+        removed, additions, changed = {}, [], set()
+        for key, updated_tags in wanted.items():
+            current_tags = current.get(key, {})
+            # Remove tags which no longer apply
+            for canonical, (item_id, tag_id) in current_tags.items():
+                if canonical not in updated_tags:
+                    removed_items, removed_tags = removed.setdefault(
+                        shards.database_for(key[0]), ([], set()))
+                    removed_items.append(item_id)
+                    removed_tags.add(tag_id)
+                    changed.add(key)
+            # Add new tags
+            for canonical, tag_name in updated_tags.items():
+                if canonical not in current_tags:
+                    additions.append((key, canonical, tag_name))
+                    changed.add(key)
 
+        # Tags are created first, so that a name which can't be leaves
+        # the current tags alone.
+        if additions:
+            tags = self._get_or_create_tags([tag_name for key, canonical, tag_name in additions])
+            tags = dict([(tag.canonical, tag) for tag in tags])
+        for using, (removed_items, removed_tags) in removed.items():
+            self._untag_items(removed_items, removed_tags, owner, using)
+        if additions:
+            self._tag_objects([(ctype_id, object_id, tags[canonical]) for \
+                               (ctype_id, object_id), canonical, tag_name in additions], owner)
+
+        changed_ids = {}
+        for ctype_id, object_id in changed:
+            changed_ids.setdefault(ctype_id, []).append(object_id)
+        for ctype_id, ids in changed_ids.items():
+            TaggedItem.refresh_popular_many(ctype_id, ids)
+        if changed:
+            routers.pin(owner)
+
+    @reads_from_primary
     def add_tag(self, obj, tag_name, owner):
         """
         Associates the given object with a tag.
@@ -95,29 +152,388 @@ class TagManager(models.Manager):
         tag_name = tag_names[0]
         if settings.FORCE_LOWERCASE_TAGS:
             tag_name = tag_name.lower()
-        tag, created = self.get_or_create(name=tag_name)
-        
-        if owner not in tag.owners.all():
-            tag.owners.add(owner)
-            tag.save()
 
         ctype = ContentType.objects.get_for_model(obj)
-        t_item, created = TaggedItem._default_manager.get_or_create(tag=tag, content_type=ctype, object_id=obj.pk)
-        t_item.owners.add(owner)
-        t_item.save()
+        self._tag_objects([(ctype.pk, obj.pk, tag) for tag in \
+                           self._get_or_create_tags([tag_name])], owner)
+        TaggedItem.refresh_popular(ctype, obj.pk)
+        routers.pin(owner)
 
-    def get_for_object_owner(self, obj, owner):
+    def _get_or_create_tags(self, tag_names):
+        """
+        Returns the tags with the given names, creating the missing ones.
+        Names are matched by their canonical form.
+
+        Missing tags are inserted with ``db.insert_ignore``, so a tag
+        created concurrently by another writer is picked up instead of
+        raising ``IntegrityError``. One is raised, naming the tag, if a
+        tag can neither be created nor found, as when another tag holds
+        its name under a different canonical form.
+        """
+        names = {}
+        for tag_name in tag_names:
+            names.setdefault(canonicalize_tag_name(tag_name), tag_name)
+        opts = self.model._meta
+        tags = []
+        for attempt in range(2):
+            db.insert_ignore(opts.db_table,
+                             (opts.get_field('name').column, opts.get_field('canonical').column),
+                             [(name, canonical) for canonical, name in names.items()])
+            tags = list(self.filter(canonical__in=names.keys()))
+            if len(tags) == len(names):
+                break
+            # A name skipped as a conflict may belong to a writer which
+            # hadn't committed when we looked; look once more.
+        else:
+            found = set([tag.canonical for tag in tags])
+            for canonical, name in names.items():
+                if canonical in found:
+                    continue
+                try:
+                    tags.append(self.get(canonical=canonical))
+                except self.model.DoesNotExist:
+                    raise IntegrityError(_('The tag "%s" could not be created or found.') % name)
+        return tags
+
+    @reads_from_primary
+    def merge(self, source_tags, target, chunk_size=500, progress=None):
+        """
+        Merges ``source_tags`` (anything ``get_tag_list`` accepts) into
+        the ``target`` tag: objects tagged with a source tag end up
+        tagged with the target, by the same owners, and the source tags
+        are deleted.
+
+        Popularity is then refreshed for the affected objects only,
+        ``chunk_size`` objects at a time. If given, ``progress`` is
+        called with the number of objects refreshed so far and the total
+        after each chunk.
+        """
+        target = get_tag(target)
+        if target is None:
+            raise AttributeError(_('No tag was given to merge into.'))
+        mapping = dict([(tag.pk, target.pk) for tag in get_tag_list(source_tags)])
+        affected = self._merge(mapping)
+        for using in shards.databases():
+            shards.copy_tags([target], using)
+            affected.extend(self._merge(mapping, using))
+
+        object_ids = {}
+        for content_type_id, object_id in affected:
+            object_ids.setdefault(content_type_id, []).append(object_id)
+        done = 0
+        for content_type_id, ids in object_ids.items():
+            for i in range(0, len(ids), chunk_size):
+                TaggedItem.refresh_popular_many(content_type_id, ids[i:i + chunk_size])
+                done += len(ids[i:i + chunk_size])
+                if progress is not None:
+                    progress(done, len(affected))
+        return target
+
+    def rename(self, tag, name):
+        """
+        Renames ``tag``. If another tag already has that name, ``tag`` is
+        merged into it instead. Returns the tag now carrying the name.
+        """
+        tag = get_tag(tag)
+        existing = get_tag(name)
+        if existing is not None and existing.pk != tag.pk:
+            return self.merge([tag], existing)
+        tag.name = name
+        tag.save()
+        for using in shards.databases():
+            self.db_manager(using).filter(pk=tag.pk).update(name=tag.name, canonical=tag.canonical)
+        return tag
+
+    def _merge(self, mapping, using=None):
+        """
+        Folds the tags whose ids are the keys of ``mapping`` into the
+        tags whose ids are the corresponding values, in a fixed number
+        of statements regardless of how many items are involved.
+
+        Owners and tagged items of each source tag are copied to its
+        target unless the target already has them, then the source tags
+        and everything hanging off them are deleted. Returns the
+        ``(content_type_id, object_id)`` pairs whose tags changed, which
+        need their popularity refreshing.
+        """
+        mapping = dict([(source, target) for source, target in mapping.items() \
+                        if source != target])
+        if not mapping:
+            return []
+        using = using or router.db_for_write(self.model)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+
+        opts = TaggedItem._meta
+        tag_owners, tag_column, tag_owner_column = db.m2m_table(self.model, 'owners')
+        item_owners, item_column, item_owner_column = db.m2m_table(TaggedItem, 'owners')
+        names = {
+            'map': qn('tagging_tag_merge'),
+            'tag': qn(self.model._meta.db_table),
+            'tag_owners': qn(tag_owners),
+            'tag_column': qn(tag_column),
+            'tag_owner_column': qn(tag_owner_column),
+            'items': qn(opts.db_table),
+            'item_tag': qn(opts.get_field('tag').column),
+            'content_type': qn(opts.get_field('content_type').column),
+            'object_id': qn(opts.get_field('object_id').column),
+            'popular': qn(opts.get_field('popular').column),
+            'score': qn(opts.get_field('score').column),
+            'created': qn(opts.get_field('created').column),
+            'item_owners': qn(item_owners),
+            'item_column': qn(item_column),
+            'item_owner_column': qn(item_owner_column),
+            'buckets': qn(TrendBucket._meta.db_table),
+            'bucket_tag': qn(TrendBucket._meta.get_field('tag').column),
+            'bucket_content_type': qn(TrendBucket._meta.get_field('content_type').column),
+            'bucket': qn(TrendBucket._meta.get_field('bucket').column),
+            'count': qn(TrendBucket._meta.get_field('count').column),
+            'events': qn(TagEvent._meta.db_table),
+            'event_columns': ', '.join([qn(TagEvent._meta.get_field(name).column) for name in \
+                                        ('op', 'content_type', 'object_id', 'tag_id', 'owner_id',
+                                         'created')]),
+        }
+
+        cursor.execute('CREATE TEMPORARY TABLE %(map)s '
+                       '(source_id integer NOT NULL PRIMARY KEY, target_id integer NOT NULL)' % names)
+        try:
+            db.insert_ignore('tagging_tag_merge', ('source_id', 'target_id'), mapping.items(),
+                             using=using)
+
+            cursor.execute('SELECT DISTINCT i.%(content_type)s, i.%(object_id)s '
+                           'FROM %(items)s i INNER JOIN %(map)s m ON i.%(item_tag)s = m.source_id' % names)
+            affected = [tuple(row) for row in cursor.fetchall()]
+            now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+
+            # Owners of the source tags become owners of the targets.
+            cursor.execute('INSERT INTO %(tag_owners)s (%(tag_column)s, %(tag_owner_column)s) '
+                           'SELECT DISTINCT m.target_id, o.%(tag_owner_column)s '
+                           'FROM %(tag_owners)s o INNER JOIN %(map)s m ON o.%(tag_column)s = m.source_id '
+                           'WHERE NOT EXISTS (SELECT 1 FROM %(tag_owners)s x '
+                           'WHERE x.%(tag_column)s = m.target_id '
+                           'AND x.%(tag_owner_column)s = o.%(tag_owner_column)s)' % names)
+            # Every object tagged with a source tag gets the target tag...
+            cursor.execute('INSERT INTO %(items)s (%(item_tag)s, %(content_type)s, %(object_id)s, '
+                           '%(popular)s, %(score)s, %(created)s) '
+                           'SELECT DISTINCT m.target_id, i.%(content_type)s, i.%(object_id)s, %%s, 0, %%s '
+                           'FROM %(items)s i INNER JOIN %(map)s m ON i.%(item_tag)s = m.source_id '
+                           'WHERE NOT EXISTS (SELECT 1 FROM %(items)s x '
+                           'WHERE x.%(item_tag)s = m.target_id '
+                           'AND x.%(content_type)s = i.%(content_type)s '
+                           'AND x.%(object_id)s = i.%(object_id)s)' % names, [False, now])
+            # ...with the owners of the source item.
+            cursor.execute('INSERT INTO %(item_owners)s (%(item_column)s, %(item_owner_column)s, %(created)s) '
+                           'SELECT DISTINCT t.id, o.%(item_owner_column)s, %%s '
+                           'FROM %(item_owners)s o '
+                           'INNER JOIN %(items)s i ON o.%(item_column)s = i.id '
+                           'INNER JOIN %(map)s m ON i.%(item_tag)s = m.source_id '
+                           'INNER JOIN %(items)s t ON t.%(item_tag)s = m.target_id '
+                           'AND t.%(content_type)s = i.%(content_type)s '
+                           'AND t.%(object_id)s = i.%(object_id)s '
+                           'WHERE NOT EXISTS (SELECT 1 FROM %(item_owners)s x '
+                           'WHERE x.%(item_column)s = t.id '
+                           'AND x.%(item_owner_column)s = o.%(item_owner_column)s)' % names, [now])
+
+            # Trend counts of the source tags are added to the target's.
+            cursor.execute('INSERT INTO %(buckets)s (%(bucket_content_type)s, %(bucket_tag)s, '
+                           '%(bucket)s, %(count)s) '
+                           'SELECT DISTINCT b.%(bucket_content_type)s, m.target_id, b.%(bucket)s, 0 '
+                           'FROM %(buckets)s b INNER JOIN %(map)s m ON b.%(bucket_tag)s = m.source_id '
+                           'WHERE NOT EXISTS (SELECT 1 FROM %(buckets)s x '
+                           'WHERE x.%(bucket_tag)s = m.target_id '
+                           'AND x.%(bucket_content_type)s = b.%(bucket_content_type)s '
+                           'AND x.%(bucket)s = b.%(bucket)s)' % names)
+            cursor.execute('SELECT b.%(bucket_content_type)s, m.target_id, b.%(bucket)s, SUM(b.%(count)s) '
+                           'FROM %(buckets)s b INNER JOIN %(map)s m ON b.%(bucket_tag)s = m.source_id '
+                           'GROUP BY b.%(bucket_content_type)s, m.target_id, b.%(bucket)s' % names)
+            counts = [(count, content_type_id, tag_id, bucket) for \
+                      content_type_id, tag_id, bucket, count in cursor.fetchall()]
+            if counts:
+                cursor.executemany('UPDATE %(buckets)s SET %(count)s = %(count)s + %%s '
+                                   'WHERE %(bucket_content_type)s = %%s AND %(bucket_tag)s = %%s '
+                                   'AND %(bucket)s = %%s' % names, counts)
+            cursor.execute('DELETE FROM %(buckets)s WHERE %(bucket_tag)s IN '
+                           '(SELECT source_id FROM %(map)s)' % names)
+            # So are their owner sketches.
+            sketches.merge_tags(mapping, using)
+
+            if settings.TAGGING_OUTBOX:
+                # The objects gain the targets and lose the sources.
+                cursor.execute('INSERT INTO %(events)s (%(event_columns)s) '
+                               'SELECT DISTINCT %%s, i.%(content_type)s, i.%(object_id)s, m.target_id, NULL, %%s '
+                               'FROM %(items)s i INNER JOIN %(map)s m ON i.%(item_tag)s = m.source_id' % names,
+                               [outbox.ADD, now])
+                cursor.execute('INSERT INTO %(events)s (%(event_columns)s) '
+                               'SELECT %%s, i.%(content_type)s, i.%(object_id)s, i.%(item_tag)s, NULL, %%s '
+                               'FROM %(items)s i INNER JOIN %(map)s m ON i.%(item_tag)s = m.source_id' % names,
+                               [outbox.DELETE, now])
+
+            cursor.execute('DELETE FROM %(item_owners)s WHERE %(item_column)s IN '
+                           '(SELECT i.id FROM %(items)s i INNER JOIN %(map)s m '
+                           'ON i.%(item_tag)s = m.source_id)' % names)
+            cursor.execute('DELETE FROM %(items)s WHERE %(item_tag)s IN '
+                           '(SELECT source_id FROM %(map)s)' % names)
+            cursor.execute('DELETE FROM %(tag_owners)s WHERE %(tag_column)s IN '
+                           '(SELECT source_id FROM %(map)s)' % names)
+            cursor.execute('DELETE FROM %(tag)s WHERE id IN (SELECT source_id FROM %(map)s)' % names)
+        finally:
+            cursor.execute('DROP TABLE %(map)s' % names)
+        transaction.commit_unless_managed(using=using)
+        versions.bump_all()
+        membership.forget()
+        return affected
+
+    def _tag_objects(self, taggings, owner):
+        """
+        For each ``(content_type_id, object_id, tag)`` in ``taggings``,
+        adds ``owner`` to the owners of the tag and of the
+        ``TaggedItem`` linking it to the object, creating the item as
+        needed. Rows which already exist are left alone, so concurrent
+        writers tagging the same object don't conflict.
+        """
+        by_database = {}
+        for tagging in taggings:
+            by_database.setdefault(shards.database_for(tagging[0]), []).append(tagging)
+        for using, taggings in by_database.items():
+            if using is not None:
+                shards.copy_tags([tag for ctype_id, object_id, tag in taggings], using)
+            self._tag_objects_in(taggings, owner, using)
+
+    def _tag_objects_in(self, taggings, owner, using=None):
+        using = using or router.db_for_write(TaggedItem)
+        table, tag_column, owner_column = db.m2m_table(self.model, 'owners')
+        db.insert_ignore(table, (tag_column, owner_column),
+                         set([(tag.pk, owner.pk) for ctype_id, object_id, tag in taggings]),
+                         using=using)
+
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        opts = TaggedItem._meta
+        now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+        table, item_column, owner_column = db.m2m_table(TaggedItem, 'owners')
+        pending = set([(ctype_id, object_id, tag.pk) for ctype_id, object_id, tag in taggings])
+        added = []
+        # Owner links are inserted from the rows of the items, so an item
+        # a concurrent untag deleted after we read it gets no link; it is
+        # created again on the next pass.
+        while pending:
+            db.insert_ignore(opts.db_table,
+                             [opts.get_field(name).column for name in \
+                              ('tag', 'content_type', 'object_id', 'popular', 'score', 'created')],
+                             [(tag_id, ctype_id, object_id, False, 0, now) for \
+                              ctype_id, object_id, tag_id in pending],
+                             using=using)
+            keys = self._item_keys(pending, using)
+            if not keys:
+                continue
+
+            # Only the links this insert made count towards trends and
+            # get events, not those the owner had or a concurrent writer
+            # made first.
+            inserted = db.insert_ignore_select(
+                table, (item_column, owner_column, TaggedItemOwner._meta.get_field('created').column),
+                'SELECT %s, %%s, %%s FROM %s WHERE %s IN (%s)' % (
+                    qn(opts.pk.column), qn(opts.db_table), qn(opts.pk.column),
+                    ', '.join(['%s'] * len(keys))),
+                [owner.pk, now] + list(keys), using=using, returning=item_column)
+            added.extend([keys[item_id] for item_id in inserted])
+            linked = set(TaggedItemOwner._default_manager.db_manager(using) \
+                             .filter(taggeditem__in=keys.keys(), owner=owner) \
+                             .values_list('taggeditem', flat=True))
+            pending.difference_update([key for item_id, key in keys.items() if item_id in linked])
+
+        trending.count([(ctype_id, tag_id) for ctype_id, object_id, tag_id in added], using)
+        sketches.add([(ctype_id, tag_id, owner.pk) for ctype_id, object_id, tag_id in added], using)
+        membership.forget(owner)
+        outbox.append([(outbox.ADD,) + key + (owner.pk,) for key in added], using)
+
+    def _item_keys(self, keys, using):
+        """
+        Returns a dict mapping the ids of the tagged items stored in the
+        database ``using`` for the ``(content_type_id, object_id,
+        tag_id)`` triples ``keys`` to their triple.
+        """
+        object_ids, tag_ids = {}, set()
+        for ctype_id, object_id, tag_id in keys:
+            object_ids.setdefault(ctype_id, set()).add(object_id)
+            tag_ids.add(tag_id)
+        item_keys = {}
+        for ctype_id, ids in object_ids.items():
+            items = TaggedItem._default_manager.using(using) \
+                                               .filter(content_type=ctype_id,
+                                                       object_id__in=list(ids),
+                                                       tag__in=list(tag_ids))
+            for item_id, object_id, tag_id in items.values_list('pk', 'object_id', 'tag'):
+                if (ctype_id, object_id, tag_id) in keys:
+                    item_keys[item_id] = (ctype_id, object_id, tag_id)
+        return item_keys
+
+    def _untag_items(self, item_ids, tag_ids, owner, using=None):
+        """
+        Removes ``owner`` from the owners of the given items, all stored
+        in the database ``using``, deletes the items nobody owns any more
+        and removes ``owner`` from the owners of those of ``tag_ids`` it
+        no longer uses anywhere in that database.
+        """
+        using = using or router.db_for_write(TaggedItem)
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+
+        items = TaggedItem._default_manager.using(using)
+        keys = dict([(item_id, (ctype_id, object_id, tag_id)) for \
+                     item_id, ctype_id, object_id, tag_id in items.filter(pk__in=list(item_ids)) \
+                     .values_list('pk', 'content_type', 'object_id', 'tag')])
+
+        # Events are only appended for the rows these deletes removed, so
+        # writers racing to remove the same tag don't both report it.
+        membership.forget(owner)
+        table, item_column, owner_column = db.m2m_table(TaggedItem, 'owners')
+        removed = db.delete_returning(table, '%s = %%s AND %s IN (%s)' % (
+            qn(owner_column), qn(item_column), ', '.join(['%s'] * len(item_ids))),
+            [owner.pk] + list(item_ids), item_column, using)
+        outbox.append([(outbox.REMOVE,) + keys[item_id] + (owner.pk,) for \
+                       item_id in removed if item_id in keys], using)
+
+        # If no one is using these items anymore, remove them. The check
+        # and the delete are one statement, so that an item a concurrent
+        # writer has just linked an owner to is kept.
+        opts = TaggedItem._meta
+        deleted = db.delete_returning(opts.db_table,
+            '%s IN (%s) AND NOT EXISTS (SELECT 1 FROM %s WHERE %s = %s.%s)' % (
+                qn(opts.pk.column), ', '.join(['%s'] * len(item_ids)),
+                qn(table), qn(item_column), qn(opts.db_table), qn(opts.pk.column)),
+            list(item_ids), opts.pk.column, using)
+        outbox.append([(outbox.DELETE,) + keys[item_id] + (None,) for \
+                       item_id in deleted if item_id in keys], using)
+
+        still_used = items.filter(owners=owner, tag__in=list(tag_ids)).values_list('tag', flat=True)
+        unused = list(set(tag_ids) - set(still_used))
+        if unused:
+            table, tag_column, owner_column = db.m2m_table(self.model, 'owners')
+            cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s IN (%s)' % (
+                qn(table), qn(owner_column), qn(tag_column), ', '.join(['%s'] * len(unused))),
+                [owner.pk] + unused)
+            transaction.commit_unless_managed(using=using)
+
+    def get_for_object_owner(self, obj, owner, records=False):
         """
         Create a queryset matching all tags associated with the given
         object and owner.
         """
-        return self.get_for_object(obj, owner, items__owners=owner)
+        return self.get_for_object(obj, owner, items__owners=owner, records=records)
  
     def get_for_model(self, model, owner_mark=None, *filter_args, **filter_kwargs):
         """
         Create a queryset matching the popular tags associated with the given
         object.
+
+        If a ``records`` keyword argument is true, a list of read-only
+        ``TagRecord`` instances is returned instead, see
+        ``tagging.records``.
         """
+        as_records = filter_kwargs.pop('records', False)
 
         ctype = ContentType.objects.get_for_model(model)
 
@@ -130,21 +546,220 @@ class TagManager(models.Manager):
         
         filter_kwargs['items__content_type'] = ctype
 
-        return self.select_related().filter(*filter_args, 
+        queryset = self.for_content_type(ctype).select_related().filter(*filter_args, 
                 **filter_kwargs).extra(select=extra_select, select_params=select_params).distinct()
                         # distinct is fail-safe hack for prevent wrong result when django creates 
                         # additional join when you try to make another .filter(items__ ... ) call
+        if as_records:
+            return tag_records(queryset)
+        return queryset
 
     def get_for_object(self, obj, owner_mark=None, *filter_args, **filter_kwargs):
-
+        """
+        Like ``get_for_model``, for the tags of ``obj``. If a ``top``
+        keyword argument is given, only that many tags are returned,
+        those with the highest ``score`` first.
+        """
+        top = filter_kwargs.pop('top', None)
+        as_records = filter_kwargs.pop('records', False)
         filter_kwargs['items__object_id'] = obj.pk
-        
-        return self.get_for_model(obj, owner_mark, *filter_args, **filter_kwargs)
+
+        owns = membership.lookup(owner_mark, ContentType.objects.get_for_model(obj).pk)
+        if owns is not None:
+            owner_mark = None
+        queryset = self.get_for_model(obj, owner_mark, *filter_args, **filter_kwargs)
+        if owns is not None:
+            queryset = self._mark_own(queryset, owns)
+        if top is not None:
+            queryset = queryset.extra(select={'score': 'tagging_taggeditem.score'}) \
+                               .order_by('-score', 'name')[:top]
+        if as_records:
+            return tag_records(queryset)
+        return queryset
+
+    def get_for_objects(self, objects, owner_mark=None, popular=False):
+        """
+        Returns the tags of each of ``objects``, which may be instances
+        of any mix of models, as a dict mapping ``(content_type_id, pk)``
+        to a list of tags. One query is made per content type.
+
+        ``owner_mark`` marks tags with ``is_own`` as for
+        ``get_for_model``; if ``popular`` is true, only popular tags are
+        returned.
+        """
+        object_ids = {}
+        for obj in objects:
+            ctype = ContentType.objects.get_for_model(obj)
+            object_ids.setdefault(ctype.pk, set()).add(obj.pk)
+
+        result = {}
+        for ctype_id, ids in object_ids.items():
+            for object_id in ids:
+                result[(ctype_id, object_id)] = []
+            filter_kwargs = {'items__object_id__in': list(ids)}
+            if popular:
+                filter_kwargs['items__popular'] = True
+            owns = membership.lookup(owner_mark, ctype_id)
+            tags = self.get_for_model(ContentType.objects.get_for_id(ctype_id).model_class(),
+                                      owns is None and owner_mark or None, **filter_kwargs) \
+                       .extra(select={'object_id': 'tagging_taggeditem.object_id'})
+            if owns is not None:
+                tags = self._mark_own(tags, owns)
+            for tag in tags:
+                result[(ctype_id, tag.object_id)].append(tag)
+        return result
+
+    def _mark_own(self, queryset, owns):
+        """
+        Returns ``queryset``, which must have one row per item, marking
+        ``is_own`` with ``owns`` rather than a subquery.
+        """
+        return queryset.extra(select={'item_id': 'tagging_taggeditem.id'}) \
+                       ._clone(klass=OwnerMarkedQuerySet, owns=owns)
+
+    def prefetch_tags(self, objects):
+        """
+        Loads the tags of all of ``objects`` with ``get_for_objects`` and
+        caches them on each object, where ``TagDescriptor`` looks before
+        querying.
+        """
+        objects = list(objects)
+        tags = self.get_for_objects(objects)
+        for obj in objects:
+            obj._tag_cache = tags[(ContentType.objects.get_for_model(obj).pk, obj.pk)]
+        return objects
+
+    def trending(self, model, window=24 * 3600, limit=10, half_life=None):
+        """
+        Returns up to ``limit`` of the tags put on objects of ``model``
+        during the last ``window`` (seconds or a ``timedelta``), the
+        most trending first, each with its score as ``score``.
+
+        Scores are read from the trend buckets kept by the write paths,
+        decayed so that a bucket's count halves every ``half_life``
+        (half the window unless given).
+        """
+        if isinstance(window, datetime.timedelta):
+            window = window.days * 24 * 3600 + window.seconds
+        if isinstance(half_life, datetime.timedelta):
+            half_life = half_life.days * 24 * 3600 + half_life.seconds
+        ctype = ContentType.objects.get_for_model(model)
+        scores = trending.scores(ctype, window, half_life, shards.database_for(ctype))
+        top = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        tags = self.for_content_type(ctype).in_bulk([tag_id for tag_id, score in top])
+        result = []
+        for tag_id, score in top:
+            if tag_id in tags:
+                tags[tag_id].score = score
+                result.append(tags[tag_id])
+        return result
+
+    def usage_for_model(self, model, counts=False, records=False, owners=False, approximate=False):
+        """
+        Returns the tags used on objects of ``model``. If ``counts`` is
+        true, each has the number of objects tagged with it as
+        ``count``, or the number of distinct owners who put it on them
+        if ``owners`` is true, see ``owner_counts``. If ``records`` is
+        true, the tags are read-only ``TagRecord`` instances.
+        """
+        ctype = ContentType.objects.get_for_model(model)
+        tags = self.for_content_type(ctype).filter(items__content_type=ctype).distinct()
+        if records:
+            tags = tag_records(tags)
+        else:
+            tags = list(tags)
+        if counts and owners:
+            usage = self.owner_counts(model, approximate=approximate)
+        elif counts:
+            usage = dict([(row['tag'], row['count']) for row in \
+                          TaggedItem.objects.for_content_type(ctype).filter(content_type=ctype) \
+                                    .values('tag').annotate(count=models.Count('pk'))])
+        if counts:
+            for tag in tags:
+                tag.count = usage.get(tag.pk, 0)
+        return tags
+
+    def owner_counts(self, model=None, tags=None, approximate=False):
+        """
+        Returns a dict mapping the ids of the tags used on objects of
+        ``model``, or on any object if ``model`` is ``None``, to their
+        number of distinct owners. ``tags`` (anything ``get_tag_list``
+        accepts) restricts the counts to those tags.
+
+        If ``approximate`` is true, the counts are estimated from the
+        owner sketches, see ``tagging.sketches``, with a relative
+        standard error of ``sketches.standard_error()``.
+        """
+        tag_ids = None
+        if tags is not None:
+            tag_ids = [tag.pk for tag in get_tag_list(tags)]
+            if not tag_ids:
+                return {}
+        ctype_id = model is not None and ContentType.objects.get_for_model(model).pk or None
+        if approximate:
+            return sketches.estimates(ctype_id, tag_ids)
+
+        if ctype_id is not None:
+            table, item_column, owner_column = db.m2m_table(TaggedItem, 'owners')
+            databases = [shards.database_for(ctype_id) or DEFAULT_DB_ALIAS]
+            tag_sql = 'i.%s' % qn(TaggedItem._meta.get_field('tag').column)
+            owner_sql = 'o.%s' % qn(owner_column)
+            from_sql = '%s o INNER JOIN %s i ON o.%s = i.%s WHERE i.%s = %%s' % (
+                qn(table), qn(TaggedItem._meta.db_table), qn(item_column),
+                qn(TaggedItem._meta.pk.column), qn(TaggedItem._meta.get_field('content_type').column))
+            params = [ctype_id]
+        else:
+            table, tag_column, owner_column = db.m2m_table(self.model, 'owners')
+            databases = [DEFAULT_DB_ALIAS] + shards.databases()
+            tag_sql, owner_sql = qn(tag_column), qn(owner_column)
+            from_sql = '%s WHERE 1 = 1' % qn(table)
+            params = []
+        if tag_ids is not None:
+            from_sql += ' AND %s IN (%s)' % (tag_sql, ', '.join(['%s'] * len(tag_ids)))
+            params.extend(tag_ids)
+
+        if len(databases) == 1:
+            cursor = connections[databases[0]].cursor()
+            cursor.execute('SELECT %s, COUNT(DISTINCT %s) FROM %s GROUP BY %s' % (
+                tag_sql, owner_sql, from_sql, tag_sql), params)
+            return dict(cursor.fetchall())
+        # Owners may use a tag in several databases.
+        owners = {}
+        for using in databases:
+            cursor = connections[using].cursor()
+            cursor.execute('SELECT DISTINCT %s, %s FROM %s' % (tag_sql, owner_sql, from_sql), params)
+            for tag_id, owner_id in cursor.fetchall():
+                owners.setdefault(tag_id, set()).add(owner_id)
+        return dict([(tag_id, len(ids)) for tag_id, ids in owners.items()])
 
     def get_for_owner(self, owner):
 
         return self.filter(items__owners=owner).distinct('pk')
 
+    # Non-blocking counterparts, see ``tagging.executor``.
+
+    def aupdate_tags(self, obj, tag_names, owner):
+        return executor.submit(self.update_tags, obj, tag_names, owner)
+
+    def aadd_tag(self, obj, tag_name, owner):
+        return executor.submit(self.add_tag, obj, tag_name, owner)
+
+    def aget_for_object(self, obj, owner_mark=None, *filter_args, **filter_kwargs):
+        """
+        Returns a ``Future`` resolving to the list of tags
+        ``get_for_object`` would match.
+        """
+        return executor.submit(lambda: list(self.get_for_object(obj, owner_mark,
+                                                                *filter_args, **filter_kwargs)))
+
+    def aprefetch_tags(self, objects, owner_mark=None):
+        """
+        Fetches the tags of each of the given objects concurrently.
+        Returns a ``Future`` resolving to a list of tag lists, in the
+        order the objects were given.
+        """
+        return executor.gather([self.aget_for_object(obj, owner_mark) for obj in objects])
+
 
     
 
@@ -152,6 +767,13 @@ class TaggedItemManager(models.Manager):
     """
     """
 
+    def for_content_type(self, content_type):
+        """
+        Returns this manager bound to the database holding the tagged
+        items of ``content_type``, see ``tagging.shards``.
+        """
+        return shards.manager_for(self, content_type)
+
     def _get_matching_ids(self, model, tags, filter_function=None):
         
         if filter_function is None:
@@ -159,17 +781,19 @@ class TaggedItemManager(models.Manager):
     
         assert callable(filter_function)
 
-        for tag in tags.select_related(depth=1):
-            for item in tag.items.all():
-                if item.object_id and filter_function(item):
-                    yield item.object_id
+        ctype = ContentType.objects.get_for_model(model)
+        items = self.for_content_type(ctype).filter(content_type=ctype,
+                                                    tag__in=[tag.pk for tag in tags])
+        for item in items:
+            if item.object_id and filter_function(item):
+                yield item.object_id
     
 
     def match_any(self, model, tags, user_filter_function=None):
 
         ctype = ContentType.objects.get_for_model(model)
         
-        default_filter = lambda item: item.content_type==ctype
+        default_filter = lambda item: item.content_type_id == ctype.pk
 
         if user_filter_function is not None:
             filter_function = lambda item: (user_filter_function(item) and default_filter(item))
@@ -184,7 +808,7 @@ class TaggedItemManager(models.Manager):
 
         ctype = ContentType.objects.get_for_model(model)
 
-        default_filter = lambda item: item.content_type==ctype
+        default_filter = lambda item: item.content_type_id == ctype.pk
 
         if user_filter_function is not None:
             filter_function = lambda item: (user_filter_function(item) and default_filter(item))
@@ -200,6 +824,122 @@ class TaggedItemManager(models.Manager):
 
         return model._default_manager.filter(pk__in=match_all_ids)
 
+    def get_by_model(self, queryset_or_model, tags):
+        """
+        Returns the instances of a model, or the objects of a queryset,
+        tagged with all of ``tags`` (anything ``get_tag_list``
+        accepts).
+        """
+        queryset, model = get_queryset_and_model(queryset_or_model)
+        tags = get_tag_list(tags)
+        if not tags:
+            return queryset.none()
+        ctype = ContentType.objects.get_for_model(model)
+        items = self.for_content_type(ctype).filter(content_type=ctype,
+                                                    tag__in=[tag.pk for tag in tags])
+        if len(tags) > 1:
+            rows = items.values('object_id').annotate(n=models.Count('pk')).filter(n=len(tags))
+        else:
+            rows = items.values('object_id')
+        return queryset.filter(pk__in=[row['object_id'] for row in rows])
+
+    def facets(self, model, selected_tags, owner=None, limit=None):
+        """
+        Returns ``(tag, count)`` pairs for the tags, other than
+        ``selected_tags`` (anything ``get_tag_list`` accepts), of the
+        instances of ``model`` tagged with all of ``selected_tags``,
+        ``count`` being how many of those instances have the tag. The
+        most frequent tags come first, at most ``limit`` of them.
+
+        If ``owner`` is given, only the tags it put on the instances
+        are counted.
+
+        The counts come from one grouped query, with the matching
+        instances in a subquery, and are cached for
+        ``TAGGING_FACETS_CACHE_TIMEOUT`` seconds under the sorted
+        selection, or until the tags of ``model`` change.
+        """
+        ctype = ContentType.objects.get_for_model(model)
+        selected = sorted(set([tag.pk for tag in get_tag_list(selected_tags)]))
+        # ``get_tag_list`` drops the names and ids of missing tags, which
+        # no instance can be tagged with.
+        if isinstance(selected_tags, basestring):
+            selected_tags = parse_tag_input(selected_tags)
+        if isinstance(selected_tags, (list, tuple)):
+            wanted = set([isinstance(tag, basestring) and canonicalize_tag_name(tag) or \
+                          getattr(tag, 'pk', tag) for tag in selected_tags])
+            if len(selected) < len(wanted):
+                return []
+        key = versions.make_key('facets', [versions.content_type_key(ctype.pk)], ctype.pk,
+                                selected, getattr(owner, 'pk', None), limit)
+        packed = cache.get(key)
+        if packed is None:
+            items = self.for_content_type(ctype).filter(content_type=ctype)
+            if selected:
+                opts = self.model._meta
+                qn = connections[items.db].ops.quote_name
+                object_id = qn(opts.get_field('object_id').column)
+                items = items.exclude(tag__in=selected).extra(where=[
+                    '%(items)s.%(object_id)s IN (SELECT %(object_id)s FROM %(items)s '
+                    'WHERE %(content_type)s = %%s AND %(tag)s IN (%(selected)s) '
+                    'GROUP BY %(object_id)s HAVING COUNT(*) = %%s)' % {
+                        'object_id': object_id,
+                        'items': qn(opts.db_table),
+                        'content_type': qn(opts.get_field('content_type').column),
+                        'tag': qn(opts.get_field('tag').column),
+                        'selected': ', '.join(['%s'] * len(selected))}],
+                    params=[ctype.pk] + selected + [len(selected)])
+            if owner is not None:
+                items = items.filter(owners=owner)
+            rows = items.values('tag').annotate(count=models.Count('pk')).order_by('-count', 'tag')
+            if limit is not None:
+                rows = rows[:limit]
+            counts = [(row['tag'], row['count']) for row in rows]
+            names = dict(Tag.objects.filter(pk__in=[tag_id for tag_id, count in counts]) \
+                                    .values_list('pk', 'name'))
+            packed = [(tag_id, names[tag_id], count) for tag_id, count in counts]
+            cache.set(key, packed, settings.TAGGING_FACETS_CACHE_TIMEOUT)
+        return [(Tag(id=tag_id, name=name), count) for tag_id, name, count in packed]
+
+    def feed(self, tags, owner=None, since=None, page_size=100, hints=None):
+        """
+        Yields ``(tagged_item, content_object)`` pairs for the items
+        tagged with any of ``tags`` (anything ``get_tag_list`` accepts),
+        across all content types, in the order they were created.
+
+        Items are read ``page_size`` at a time by primary key, starting
+        after the item whose id is ``since``, so a feed of any length is
+        walked in constant memory and can be resumed from the last item
+        seen. If ``owner`` is given, only items it owns are included.
+
+        The content objects of each page are fetched in bulk; ``hints``
+        is passed to ``fetch_content_objects``. Items whose object has
+        been deleted are skipped.
+        """
+        from tagging.generic import fetch_content_objects
+
+        queryset = self.filter(tag__in=[tag.pk for tag in get_tag_list(tags)])
+        if owner is not None:
+            queryset = queryset.filter(owners=owner)
+        last = since or 0
+        while True:
+            page = list(queryset.filter(pk__gt=last).order_by('pk')[:page_size])
+            if not page:
+                return
+            fetch_content_objects(page, hints=hints)
+            for item in page:
+                if item.object is not None:
+                    yield item, item.object
+            last = page[-1].pk
+
+    # Non-blocking counterparts, see ``tagging.executor``.
+
+    def amatch_any(self, model, tags, user_filter_function=None):
+        return executor.submit(lambda: list(self.match_any(model, tags, user_filter_function)))
+
+    def amatch_all(self, model, tags, user_filter_function=None):
+        return executor.submit(lambda: list(self.match_all(model, tags, user_filter_function)))
+
 
 ##########
 # Models # 
@@ -210,6 +950,8 @@ class Tag(models.Model):
     A tag.
     """
     name = models.CharField(_('name'), max_length=50, unique=True, db_index=True)
+    canonical    = models.CharField(_('canonical name'), max_length=CANONICAL_MAX_LENGTH,
+                                    unique=True, editable=False)
     owners       = models.ManyToManyField(OWNER_MODEL)
     objects = TagManager()
 
@@ -221,17 +963,33 @@ class Tag(models.Model):
     def __unicode__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.canonical = canonicalize_tag_name(self.name)
+        result = super(Tag, self).save(*args, **kwargs)
+        versions.bump_all()
+        return result
+
 class TaggedItem(models.Model):
     """
     Holds the relationship between a tag, the item being tagged and the user doing the tagging.
+
+    ``owners`` goes through ``TaggedItemOwner``, which records when each
+    owner put the tag on, so it can be read and cleared but has no
+    ``add``, ``remove`` or ``create``: use ``add_owner`` and
+    ``remove_owner``.
     """
-    owners       = models.ManyToManyField(OWNER_MODEL)
+    owners       = models.ManyToManyField(OWNER_MODEL, through='TaggedItemOwner')
     tag          = models.ForeignKey(Tag, verbose_name=_('tag'), related_name='items')
     content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
     object_id    = models.PositiveIntegerField(_('object id'), db_index=True)
     object       = generic.GenericForeignKey('content_type', 'object_id')
     popular      = models.BooleanField(_('popular'))
+    # The item's owner count relative to the mean of the object's items
+    score        = models.FloatField(_('score'), default=0)
     object_id    = models.PositiveIntegerField(_('object id'), db_index=True)
+    # NULL for items from before timestamps were recorded
+    created      = models.DateTimeField(_('created'), default=datetime.datetime.now,
+                                        null=True, editable=False)
 
     objects = TaggedItemManager()
 
@@ -254,29 +1012,184 @@ class TaggedItem(models.Model):
 
         return item
 
+    @reads_from_primary
+    def add_owner(self, owner):
+        """
+        Adds ``owner`` to the owners of this item, as ``add_tag`` does.
+        """
+        Tag.objects._tag_objects([(self.content_type_id, self.object_id, self.tag)], owner)
+        TaggedItem.refresh_popular(self.content_type_id, self.object_id)
+        routers.pin(owner)
+
+    @reads_from_primary
+    def remove_owner(self, owner):
+        """
+        Removes ``owner`` from the owners of this item, as
+        ``update_tags`` does, deleting the item if nobody owns it any
+        more.
+        """
+        Tag.objects._untag_items([self.pk], [self.tag_id], owner,
+                                 shards.database_for(self.content_type_id))
+        TaggedItem.refresh_popular(self.content_type_id, self.object_id)
+        routers.pin(owner)
+
     @staticmethod
     def refresh_popular(content_type, object_id):
+        TaggedItem.refresh_popular_many(content_type, [object_id])
+
+    @staticmethod
+    @reads_from_primary
+    def refresh_popular_many(content_type, object_ids):
+        """
+        Recomputes ``popular`` and ``score`` for the items of each of
+        ``object_ids`` in one aggregate query, plus an update for each
+        value which changed.
+
+        An item's score is its owner count over the mean owner count of
+        the object's items; it is popular if its owner count is above
+        that mean, rounded down, and ``MIN_OWNERS_COUNT_PER_TAG``.
+        """
+        items = TaggedItem.objects.for_content_type(content_type)
+        popular_changes, score_changes = TaggedItem.popularity_changes(
+            items.filter(content_type=content_type, object_id__in=object_ids))
+        for popular, ids in popular_changes.items():
+            items.filter(pk__in=ids).update(popular=popular)
+        for score, ids in score_changes.items():
+            items.filter(pk__in=ids).update(score=score)
+        versions.bump(getattr(content_type, 'pk', content_type), object_ids)
+        similarity.changed(content_type, object_ids)
 
+    @staticmethod
+    def popularity_changes(queryset):
+        """
+        Computes ``popular`` and ``score`` for the items of ``queryset``,
+        which must hold every item of the objects it covers, in one
+        aggregate query. Returns two dicts mapping each new ``popular``
+        and ``score`` value to the ids of the items it differs for.
+        """
         try:
             from .settings import MIN_OWNERS_COUNT_PER_TAG
         except ImportError:
             MIN_OWNERS_COUNT_PER_TAG = 0
-        
-        queryset = TaggedItem.objects.filter(content_type=content_type, object_id=object_id)
 
-        tag_count = queryset.count()
-        total_owners_count = queryset.aggregate(models.Count('owners'))['owners__count']
-        avg = total_owners_count/tag_count
-        
-        if avg < MIN_OWNERS_COUNT_PER_TAG:
-            avg = MIN_OWNERS_COUNT_PER_TAG
+        owner_counts = {}
+        for item in queryset.values('pk', 'object_id', 'popular', 'score') \
+                            .annotate(oc=models.Count('owners')):
+            owner_counts.setdefault(item['object_id'], []).append(item)
 
-        popular_ids = [item['pk'] for item in queryset.annotate(oc=models.Count('owners')).filter(oc__gt=avg).values('pk')]
+        popular_changes, score_changes = {}, {}
+        for counts in owner_counts.values():
+            total = sum([item['oc'] for item in counts])
+            avg = total // len(counts)
+            if avg < MIN_OWNERS_COUNT_PER_TAG:
+                avg = MIN_OWNERS_COUNT_PER_TAG
+            for item in counts:
+                popular = item['oc'] > avg
+                if popular != bool(item['popular']):
+                    popular_changes.setdefault(popular, []).append(item['pk'])
+                score = total and round(float(item['oc']) * len(counts) / total, 4) or 0.0
+                if score != item['score']:
+                    score_changes.setdefault(score, []).append(item['pk'])
+        return popular_changes, score_changes
 
-        queryset.exclude(pk__in=popular_ids).update(popular=False)
-        queryset.filter(pk__in=popular_ids).update(popular=True)
-        
-        
-        
-        
-        
+class TaggedItemOwner(models.Model):
+    """
+    Links a tagged item to one of its owners, recording when the owner
+    put the tag on the object.
+    """
+    taggeditem   = models.ForeignKey(TaggedItem)
+    owner        = models.ForeignKey(OWNER_MODEL,
+                                     db_column='%s_id' % OWNER_MODEL._meta.object_name.lower())
+    # NULL for links from before timestamps were recorded
+    created      = models.DateTimeField(_('created'), default=datetime.datetime.now,
+                                        null=True, editable=False)
+
+    class Meta:
+        # The table Django created for ``TaggedItem.owners`` before the
+        # timestamp was added.
+        db_table = 'tagging_taggeditem_owners'
+        unique_together = (('taggeditem', 'owner'),)
+
+class TrendBucket(models.Model):
+    """
+    How many times a tag was put on objects of a content type during
+    one time bucket, see ``Tag.objects.trending``.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    tag          = models.ForeignKey(Tag, verbose_name=_('tag'), related_name='trend_buckets')
+    bucket       = models.PositiveIntegerField(_('bucket'))
+    count        = models.PositiveIntegerField(_('count'), default=0)
+
+    class Meta:
+        unique_together = (('content_type', 'tag', 'bucket'),)
+        verbose_name = _('trend bucket')
+        verbose_name_plural = _('trend buckets')
+
+class TagSignature(models.Model):
+    """
+    The MinHash signature of the tags of an object, see
+    ``tagging.similarity``.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    object_id    = models.PositiveIntegerField(_('object id'))
+    # Base64 of the signature packed as big endian 32 bit values
+    minhash      = models.TextField(_('minhash'))
+
+    class Meta:
+        unique_together = (('content_type', 'object_id'),)
+        verbose_name = _('tag signature')
+        verbose_name_plural = _('tag signatures')
+
+class TagSignatureBand(models.Model):
+    """
+    The hash of one band of the signature of an object, which the
+    candidates for ``similar_to`` are looked up by.
+    """
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    band         = models.PositiveSmallIntegerField(_('band'))
+    hash         = models.IntegerField(_('hash'))
+    object_id    = models.PositiveIntegerField(_('object id'))
+
+    class Meta:
+        unique_together = (('content_type', 'band', 'hash', 'object_id'),)
+        verbose_name = _('tag signature band')
+        verbose_name_plural = _('tag signature bands')
+
+class TagEvent(models.Model):
+    """
+    A change to the tags of an object, appended to the outbox by the
+    write paths, see ``tagging.outbox``.
+    """
+    seq          = models.AutoField(primary_key=True)
+    op           = models.PositiveSmallIntegerField(_('operation'), choices=(
+                       (outbox.ADD, _('add')),
+                       (outbox.REMOVE, _('remove')),
+                       (outbox.DELETE, _('delete'))))
+    content_type = models.ForeignKey(ContentType, verbose_name=_('content type'))
+    object_id    = models.PositiveIntegerField(_('object id'))
+    # Plain ids: events outlive the tags and owners they mention.
+    tag_id       = models.IntegerField(_('tag id'))
+    owner_id     = models.IntegerField(_('owner id'), null=True)
+    created      = models.DateTimeField(_('created'), default=datetime.datetime.now, db_index=True)
+
+    class Meta:
+        verbose_name = _('tag event')
+        verbose_name_plural = _('tag events')
+
+class OwnerSketch(models.Model):
+    """
+    A HyperLogLog sketch of the owners of a tag on objects of a content
+    type, or of any content type, see ``tagging.sketches``.
+    """
+    # 0 for the sketch across content types.
+    content_type_id = models.IntegerField(_('content type id'))
+    tag             = models.ForeignKey(Tag, verbose_name=_('tag'), related_name='owner_sketches')
+    # Base64 of the compressed registers
+    registers       = models.TextField(_('registers'))
+    # Bumped by every write, which only applies if it is unchanged.
+    version         = models.PositiveIntegerField(_('version'), default=0)
+
+    class Meta:
+        unique_together = (('content_type_id', 'tag'),)
+        verbose_name = _('owner sketch')
+        verbose_name_plural = _('owner sketches')
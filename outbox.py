@@ -0,0 +1,102 @@
+"""
+An outbox of tagging change events, for consumers such as search
+indexes which follow the tags incrementally.
+
+The write paths append a ``TagEvent`` per change with the statements
+making it, on the same connection, so under a managed transaction an
+event is committed if and only if its change is:
+
+- ``ADD``: ``owner_id`` put ``tag_id`` on the object, or, with no owner,
+  a merge put it there;
+- ``REMOVE``: ``owner_id`` took ``tag_id`` off the object, which others
+  may still have on it;
+- ``DELETE``: the item linking ``tag_id`` to the object is gone.
+
+``seq`` orders the events of a database. Consumers keep the last ``seq``
+they processed and ``read`` the events after it; shards keep their own
+outbox. ``manage.py tagging_outbox_compact`` deletes the events every
+consumer is done with.
+"""
+import datetime
+
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+
+from tagging import db, settings
+
+ADD = 1
+REMOVE = 2
+DELETE = 3
+
+def append(events, using=None):
+    """
+    Appends ``(op, content_type_id, object_id, tag_id, owner_id)``
+    tuples to the outbox of the database ``using``.
+    """
+    from tagging.models import TagEvent
+
+    if not settings.TAGGING_OUTBOX:
+        return
+    using = using or router.db_for_write(TagEvent)
+    opts = TagEvent._meta
+    now = connections[using].ops.value_to_db_datetime(datetime.datetime.now())
+    db.insert_ignore(opts.db_table,
+                     [opts.get_field(name).column for name in \
+                      ('op', 'content_type', 'object_id', 'tag_id', 'owner_id', 'created')],
+                     [tuple(event) + (now,) for event in events],
+                     using=using)
+
+def append_items(op, item_ids, owner_id=None, using=None):
+    """
+    Appends an ``op`` event for each of the tagged items ``item_ids``,
+    which must still exist.
+    """
+    from tagging.models import TaggedItem
+
+    if not settings.TAGGING_OUTBOX or not item_ids:
+        return
+    items = TaggedItem._default_manager.using(using or DEFAULT_DB_ALIAS).filter(pk__in=list(item_ids))
+    append([(op, content_type_id, object_id, tag_id, owner_id) for \
+            content_type_id, object_id, tag_id in \
+            items.values_list('content_type', 'object_id', 'tag')], using)
+
+def read(after=0, limit=1000, using=None):
+    """
+    Returns up to ``limit`` events with a ``seq`` above ``after``, in
+    order.
+
+    A sequence number is taken when a write inserts its event, not when
+    it commits. A consumer may therefore see a later event before an
+    earlier one which is still uncommitted, and should re-read the
+    events of the last few seconds.
+    """
+    from tagging.models import TagEvent
+
+    return list(TagEvent._default_manager.using(using or DEFAULT_DB_ALIAS) \
+                        .filter(seq__gt=after).order_by('seq')[:limit])
+
+def compact(before=None, older_than=None, using=None):
+    """
+    Deletes the events whose ``seq`` is at most ``before`` and those
+    created more than ``older_than`` seconds ago. Returns the number of
+    events deleted.
+    """
+    from tagging.models import TagEvent
+
+    using = using or DEFAULT_DB_ALIAS
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = TagEvent._meta
+    cursor = connection.cursor()
+    deleted = 0
+    if before is not None:
+        cursor.execute('DELETE FROM %s WHERE %s <= %%s' % (
+            qn(opts.db_table), qn(opts.pk.column)), [before])
+        deleted += cursor.rowcount
+    if older_than is not None:
+        cursor.execute('DELETE FROM %s WHERE %s < %%s' % (
+            qn(opts.db_table), qn(opts.get_field('created').column)),
+            [connection.ops.value_to_db_datetime(
+                datetime.datetime.now() - datetime.timedelta(seconds=older_than))])
+        deleted += cursor.rowcount
+    transaction.commit_unless_managed(using=using)
+    return deleted
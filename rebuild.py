@@ -0,0 +1,168 @@
+"""
+Parallel recomputation of the popularity and scores of tagged items.
+
+The work is split into chunks, each the objects of one content type
+within a range of object ids holding up to a given number of tagged
+objects, however sparse the ids. A chunk is recomputed with one
+aggregate query over its items and one ``UPDATE`` per changed value, so
+its cost doesn't depend on how many objects it holds. ``run`` spreads
+the chunks over a pool of processes, each with its own database
+connections, and can append the chunks done to a state file to resume
+an interrupted run. In a dry run nothing is written and the differences
+are counted instead.
+"""
+import bisect
+import os
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import simplejson
+
+from tagging import shards, versions
+from tagging.models import TaggedItem
+
+# Items per ``UPDATE ... WHERE id IN``.
+UPDATE_BATCH_SIZE = 500
+
+def plan(chunk_size=10000, done=()):
+    """
+    Returns the chunks covering every tagged object, as
+    ``(content_type_id, low, high)`` tuples for the object ids from
+    ``low`` up to but excluding ``high``, each spanning up to
+    ``chunk_size`` tagged objects. The object ids are read by keyset,
+    ``chunk_size`` at a time.
+
+    Objects within the chunks ``done`` are left out, so that resuming
+    doesn't redo them even if objects were tagged in between.
+    """
+    content_types = set()
+    for using in [DEFAULT_DB_ALIAS] + shards.databases():
+        content_types.update(TaggedItem._default_manager.using(using) \
+                                       .values_list('content_type', flat=True).distinct())
+    covered = {}
+    for content_type_id, low, high in done:
+        covered.setdefault(content_type_id, []).append((low, high))
+    chunks = []
+    for content_type_id in sorted(content_types):
+        items = TaggedItem.objects.for_content_type(content_type_id) \
+                                  .filter(content_type=content_type_id)
+        intervals = sorted(covered.get(content_type_id, []))
+        starts = [low for low, high in intervals]
+        last = None
+        while True:
+            ids = items
+            if last is not None:
+                ids = ids.filter(object_id__gt=last)
+            ids = list(ids.order_by('object_id').values_list('object_id', flat=True) \
+                          .distinct()[:chunk_size])
+            if not ids:
+                break
+            i = bisect.bisect_right(starts, ids[0])
+            if i and ids[0] < intervals[i - 1][1]:
+                # Done already: carry on after the chunk.
+                last = intervals[i - 1][1] - 1
+                continue
+            if i < len(starts):
+                ids = [object_id for object_id in ids if object_id < starts[i]]
+            chunks.append((content_type_id, ids[0], ids[-1] + 1))
+            last = ids[-1]
+    return chunks
+
+def rebuild_chunk(chunk, dry_run=False):
+    """
+    Recomputes the popularity and scores of the items of ``chunk``.
+    Returns the numbers of items whose ``popular`` flag and whose score
+    differed, which are only corrected unless ``dry_run`` is true.
+    """
+    content_type_id, low, high = chunk
+    items = TaggedItem.objects.for_content_type(content_type_id)
+    popular_changes, score_changes = TaggedItem.popularity_changes(
+        items.filter(content_type=content_type_id, object_id__gte=low, object_id__lt=high))
+    if not dry_run:
+        changed = set()
+        for field, changes in (('popular', popular_changes), ('score', score_changes)):
+            for value, ids in changes.items():
+                for i in range(0, len(ids), UPDATE_BATCH_SIZE):
+                    items.filter(pk__in=ids[i:i + UPDATE_BATCH_SIZE]).update(**{field: value})
+                changed.update(ids)
+        if changed:
+            versions.bump(content_type_id, set(items.filter(pk__in=list(changed)) \
+                                                    .values_list('object_id', flat=True)))
+    return (sum([len(ids) for ids in popular_changes.values()]),
+            sum([len(ids) for ids in score_changes.values()]))
+
+def _close_connections():
+    for alias in connections:
+        connections[alias].close()
+
+def _run_chunk(args):
+    chunk, dry_run = args
+    return chunk, rebuild_chunk(chunk, dry_run)
+
+def _load_state(path):
+    """
+    Returns the chunks listed in the state file ``path``, one JSON
+    array per line. A line left incomplete by an interrupted run is
+    skipped.
+    """
+    if path is None or not os.path.exists(path):
+        return set()
+    done = set()
+    state = open(path)
+    try:
+        for line in state:
+            try:
+                done.add(tuple(simplejson.loads(line)))
+            except ValueError:
+                pass
+    finally:
+        state.close()
+    return done
+
+def run(processes=1, chunk_size=10000, dry_run=False, state=None, progress=None):
+    """
+    Rebuilds every chunk of ``plan(chunk_size)`` on ``processes``
+    processes, or in this one if ``processes`` is 1, and returns the
+    total numbers of items whose ``popular`` flag and score differed.
+
+    If ``state`` names a file, the chunks done are appended to it and
+    skipped when run again. If given, ``progress`` is called with the
+    number of chunks done and the total after each chunk.
+    """
+    done = _load_state(state)
+    todo = plan(chunk_size, done)
+    jobs = [(chunk, dry_run) for chunk in todo]
+
+    if processes > 1:
+        from multiprocessing import Pool
+
+        # Forked workers must not share the parent's connections; each
+        # opens its own on its first query.
+        _close_connections()
+        pool = Pool(processes)
+        results = pool.imap_unordered(_run_chunk, jobs)
+    else:
+        pool = None
+        results = ((chunk, rebuild_chunk(chunk, dry_run)) for chunk, dry_run in jobs)
+
+    popular = scores = 0
+    finished, total = len(done), len(done) + len(todo)
+    state_file = None
+    if state is not None and not dry_run:
+        state_file = open(state, 'a')
+    try:
+        for chunk, (chunk_popular, chunk_scores) in results:
+            popular += chunk_popular
+            scores += chunk_scores
+            finished += 1
+            if state_file is not None:
+                state_file.write(simplejson.dumps(list(chunk)) + '\n')
+                state_file.flush()
+            if progress is not None:
+                progress(finished, total)
+    finally:
+        if state_file is not None:
+            state_file.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return popular, scores
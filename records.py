@@ -0,0 +1,76 @@
+"""
+Lightweight read-only tags.
+
+Listing tags only needs their name and a few flags, but a ``Tag``
+instance carries its model state and a dict of attributes. A
+``TagRecord`` has fixed slots instead and is built straight from the
+rows of ``values_list``, which makes it several times smaller and
+cheaper to build. Pass ``records=True`` to ``get_for_model``,
+``get_for_object`` and ``usage_for_model`` to get records; the template
+tags render records if ``TAGGING_TEMPLATE_RECORDS`` is on. Records have
+no model methods or related managers, so templates using
+``get_absolute_url`` or ``tag.owners`` need ``Tag`` instances.
+"""
+
+class TagRecord(object):
+    """
+    A read-only tag, with the attributes templates and
+    ``calculate_cloud`` use: ``id``, ``name``, ``popular``, ``is_own``,
+    ``count`` and ``font_size``.
+    """
+    __slots__ = ('id', 'name', 'popular', 'is_own', 'count', 'font_size')
+
+    def __init__(self, id, name, popular=False, is_own=False, count=None):
+        self.id = id
+        self.name = name
+        self.popular = bool(popular)
+        self.is_own = bool(is_own)
+        self.count = count
+        self.font_size = None
+
+    def _get_pk(self):
+        return self.id
+    pk = property(_get_pk)
+
+    def __unicode__(self):
+        return self.name
+
+    def __str__(self):
+        return self.name.encode('utf-8')
+
+    def __repr__(self):
+        return '<TagRecord: %s>' % self
+
+    def __eq__(self, other):
+        return isinstance(other, TagRecord) and other.id == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.id)
+
+# The attributes of ``TagRecord`` which a queryset of tags may select.
+OPTIONAL_COLUMNS = ('popular', 'is_own', 'count')
+
+def from_queryset(queryset):
+    """
+    Returns the tags of ``queryset`` as ``TagRecord`` instances, reading
+    only the columns the records need: the id, the name, and whichever
+    of ``popular``, ``is_own`` and ``count`` the queryset selects.
+
+    A queryset marking ``is_own`` from an owner membership, see
+    ``tagging.membership``, marks the records the same way.
+    """
+    query = queryset.query
+    names = [name for name in OPTIONAL_COLUMNS \
+             if name in query.extra or name in query.aggregates]
+    # Other extra columns stay selected, as the ordering may use them.
+    others = [name for name in query.extra if name not in names]
+    records = []
+    for row in queryset.values_list('id', 'name', *(names + others)):
+        record = TagRecord(row[0], row[1], **dict(zip(names, row[2:])))
+        if getattr(queryset, 'owns', None) is not None:
+            record.is_own = queryset.owns(row[2 + len(names) + others.index('item_id')])
+        records.append(record)
+    return records
@@ -0,0 +1,77 @@
+"""
+Read-replica routing for the tagging models.
+
+Add ``tagging.routers.TaggingRouter`` to ``DATABASE_ROUTERS`` and point
+``TAGGING_READ_DATABASE`` at a replica alias to send tagging reads
+there. Writes keep going to the default database.
+
+Replicas lag, so an owner who has just tagged something would not see
+their own change. Every tagging write pins its owner to the primary for
+``TAGGING_PRIMARY_PIN_SECONDS``; with ``tagging.middleware.
+ReplicaPinningMiddleware`` installed, the tagging reads made while
+serving a pinned user's requests go to the primary too. The reads made
+by the write paths themselves always do.
+"""
+import threading
+
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from tagging import settings
+
+_state = threading.local()
+
+def _pin_key(owner):
+    return 'tagging.pinned.%s' % owner.pk
+
+def pin(owner):
+    """
+    Sends ``owner``'s tagging reads to the primary for the pin window.
+    """
+    cache.set(_pin_key(owner), True, settings.TAGGING_PRIMARY_PIN_SECONDS)
+    if getattr(_state, 'reader', None) == owner:
+        _state.pinned = True
+
+def set_current_reader(owner):
+    """
+    Declares on whose behalf this thread is reading, until called again
+    with ``None``.
+    """
+    _state.reader = owner
+    _state.pinned = owner is not None and bool(cache.get(_pin_key(owner)))
+
+def reads_from_primary(func):
+    """
+    Decorator sending the tagging reads made by ``func`` to the primary,
+    for read-modify-write code which must not see a lagging replica.
+    """
+    def wrapper(*args, **kwargs):
+        _state.primary = getattr(_state, 'primary', 0) + 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _state.primary -= 1
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class TaggingRouter(object):
+    """
+    Routes reads of the tagging models to ``TAGGING_READ_DATABASE``
+    unless the primary is called for, and has no opinion otherwise.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'tagging' or not settings.TAGGING_READ_DATABASE:
+            return None
+        if getattr(_state, 'primary', 0) or getattr(_state, 'pinned', False):
+            return DEFAULT_DB_ALIAS
+        return settings.TAGGING_READ_DATABASE
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replica rows are the same rows as on the primary.
+        if obj1._meta.app_label == 'tagging' or obj2._meta.app_label == 'tagging':
+            return True
+        return None
@@ -15,3 +15,55 @@ FORCE_LOWERCASE_TAGS = getattr(settings, 'FORCE_LOWERCASE_TAGS', False)
 from django.contrib.auth.models import User
 
 OWNER_MODEL = User
+
+# The number of worker threads used by the non-blocking manager methods
+# (``aupdate_tags``, ``aget_for_object`` and friends).
+ASYNC_TAGGING_WORKERS = getattr(settings, 'ASYNC_TAGGING_WORKERS', 4)
+
+# The database alias reads of the tagging models are sent to by
+# ``tagging.routers.TaggingRouter``, e.g. a read replica.
+TAGGING_READ_DATABASE = getattr(settings, 'TAGGING_READ_DATABASE', None)
+
+# For how many seconds after tagging something an owner's own tagging
+# reads keep going to the primary database.
+TAGGING_PRIMARY_PIN_SECONDS = getattr(settings, 'TAGGING_PRIMARY_PIN_SECONDS', 10)
+
+# Maps ``'app_label.model'`` names to the database alias holding the
+# tagged items of that content type, see ``tagging.shards``.
+TAGGING_SHARDS = getattr(settings, 'TAGGING_SHARDS', {})
+
+# The length in seconds of the time buckets tagging activity is counted
+# in for ``Tag.objects.trending``, and how long the counts are kept.
+TAGGING_TREND_BUCKET_SECONDS = getattr(settings, 'TAGGING_TREND_BUCKET_SECONDS', 300)
+TAGGING_TREND_RETENTION = getattr(settings, 'TAGGING_TREND_RETENTION', 7 * 24 * 3600)
+
+# The shape of the MinHash signatures behind ``similar_to``: signatures
+# have ``BANDS * ROWS`` values and are indexed in ``BANDS`` bands of
+# ``ROWS`` values each. More rows per band find fewer, closer candidates.
+TAGGING_MINHASH_BANDS = getattr(settings, 'TAGGING_MINHASH_BANDS', 16)
+TAGGING_MINHASH_ROWS = getattr(settings, 'TAGGING_MINHASH_ROWS', 4)
+
+# How many seconds ``TaggedItem.objects.facets`` keeps its counts cached.
+TAGGING_FACETS_CACHE_TIMEOUT = getattr(settings, 'TAGGING_FACETS_CACHE_TIMEOUT', 60)
+
+# Whether the write paths append change events to the outbox, see
+# ``tagging.outbox``, and how many seconds ``tagging_outbox_compact``
+# keeps them by default.
+TAGGING_OUTBOX = getattr(settings, 'TAGGING_OUTBOX', True)
+TAGGING_OUTBOX_RETENTION = getattr(settings, 'TAGGING_OUTBOX_RETENTION', 7 * 24 * 3600)
+
+# How many tagged items of a content type an owner may have for
+# ``tagging.membership`` to load them; beyond that, ``is_own`` is
+# computed in SQL.
+TAGGING_MEMBERSHIP_CAP = getattr(settings, 'TAGGING_MEMBERSHIP_CAP', 10000)
+
+# Whether the write paths keep HyperLogLog sketches of the owners of
+# each tag, for approximate ``owner_counts``, and their precision: a
+# sketch has ``2 ** TAGGING_SKETCH_PRECISION`` registers, see
+# ``tagging.sketches``.
+TAGGING_OWNER_SKETCHES = getattr(settings, 'TAGGING_OWNER_SKETCHES', False)
+TAGGING_SKETCH_PRECISION = getattr(settings, 'TAGGING_SKETCH_PRECISION', 10)
+
+# Whether the template tags render read-only ``TagRecord`` instances
+# rather than ``Tag`` instances, see ``tagging.records``.
+TAGGING_TEMPLATE_RECORDS = getattr(settings, 'TAGGING_TEMPLATE_RECORDS', False)
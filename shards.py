@@ -0,0 +1,178 @@
+"""
+Per content type storage of tagged items.
+
+A content type registered with ``register(model, using)``, or listed in
+``TAGGING_SHARDS``, keeps its tagged items and their owners in the
+database ``using`` rather than the default one, so the taggings of one
+very large model don't slow down the queries about every other. The
+methods of ``Tag.objects`` and ``TaggedItem.objects`` which are given an
+object, model or content type route to that database by themselves.
+
+Tags are created in the default database, which assigns their ids. A
+shard keeps a copy of the tags its items use, so that ``get_for_model``
+and friends join locally, and its own tag owner rows. It needs the full
+tagging schema (``syncdb --database``), the same content type ids as
+the default database and, where foreign keys are enforced, the owner
+rows. Items read from a shard should have their objects loaded with
+``tagging.generic.fetch_content_objects`` rather than ``item.object``,
+which would look for the object in the shard.
+
+``TaggedItem.objects.feed`` and ``Tag.objects.get_for_owner`` only see
+the default database.
+
+Existing items are moved with ``move_items``, also available as
+``manage.py tagging_move_items``. Move a content type's items before
+registering it and run the move again afterwards to pick up the items
+written in between.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, connections, router
+
+from tagging import db, outbox, settings, trending
+
+_registry = dict(settings.TAGGING_SHARDS)
+
+def _label(model):
+    opts = model._meta
+    return '%s.%s' % (opts.app_label, opts.object_name.lower())
+
+def register(model, using):
+    """
+    Keeps the tagged items of ``model`` in the database ``using``.
+    """
+    _registry[_label(model)] = using
+
+def unregister(model):
+    _registry.pop(_label(model), None)
+
+def database_for(content_type):
+    """
+    Returns the alias of the database holding the tagged items of
+    ``content_type`` (a ``ContentType``, its id, a model or an
+    instance), or ``None`` if they are in the default place.
+    """
+    if not _registry:
+        return None
+    if isinstance(content_type, ContentType):
+        label = '%s.%s' % (content_type.app_label, content_type.model)
+    elif hasattr(content_type, '_meta'):
+        label = _label(content_type)
+    else:
+        content_type = ContentType.objects.get_for_id(content_type)
+        label = '%s.%s' % (content_type.app_label, content_type.model)
+    return _registry.get(label)
+
+def databases():
+    """
+    Returns the aliases of the shard databases in use.
+    """
+    return sorted(set(_registry.values()))
+
+def manager_for(manager, content_type):
+    """
+    Returns ``manager`` bound to the database holding the tagged items of
+    ``content_type``.
+    """
+    using = database_for(content_type)
+    if using is None:
+        return manager
+    return manager.db_manager(using)
+
+def copy_tags(tags, using):
+    """
+    Copies ``tags`` into the database ``using``, unless they are there
+    already.
+    """
+    from tagging.models import Tag
+
+    opts = Tag._meta
+    db.insert_ignore(opts.db_table,
+                     [opts.get_field(name).column for name in ('id', 'name', 'canonical')],
+                     set([(tag.pk, tag.name, tag.canonical) for tag in tags]),
+                     using=using)
+
+def move_items(model, target, source=None, batch_size=1000, progress=None):
+    """
+    Moves the tagged items of ``model`` and their owners from the
+    database ``source`` (the default one unless given) to ``target``,
+    ``batch_size`` items at a time. Each batch is copied, skipping rows
+    the target already has, before it is deleted from the source, so an
+    interrupted move can simply be run again.
+
+    The owners' tag owner rows are copied too; those left behind in the
+    source are removed by ``tagging.cleanup.collect_garbage``. If given,
+    ``progress`` is called with the number of items moved so far after
+    each batch. Returns the number of items moved.
+    """
+    from tagging.cleanup import delete_items
+    from tagging.models import Tag, TaggedItem, TaggedItemOwner, TrendBucket
+
+    source = source or DEFAULT_DB_ALIAS
+    ctype = ContentType.objects.get_for_model(model)
+    opts = TaggedItem._meta
+    item_columns = [opts.get_field(name).column for name in \
+                    ('tag', 'content_type', 'object_id', 'popular', 'score', 'created')]
+    item_owners, item_column, item_owner_column = db.m2m_table(TaggedItem, 'owners')
+    created_column = TaggedItemOwner._meta.get_field('created').column
+    tag_owners, tag_column, tag_owner_column = db.m2m_table(Tag, 'owners')
+    source_cursor = connections[source].cursor()
+    qn = connections[source].ops.quote_name
+
+    tag_database = router.db_for_write(Tag)
+
+    # Trend counts first; there are few of them.
+    buckets = TrendBucket._default_manager.using(source).filter(content_type=ctype)
+    counts = dict([((ctype.pk, tag_id, bucket), n) for tag_id, bucket, n in \
+                   buckets.values_list('tag', 'bucket', 'count')])
+    if counts and target != tag_database:
+        copy_tags(Tag._default_manager.using(tag_database) \
+                      .filter(pk__in=list(set([key[1] for key in counts]))), target)
+    trending.add(counts, target)
+    buckets.delete()
+
+    moved = 0
+    while True:
+        # Moved items are deleted, so the first batch left is the next.
+        rows = list(TaggedItem._default_manager.using(source).filter(content_type=ctype) \
+                        .order_by('pk').values_list('pk', 'tag', 'object_id', 'popular',
+                                                    'score', 'created')[:batch_size])
+        if not rows:
+            return moved
+        item_ids = [row[0] for row in rows]
+        tag_ids = set([row[1] for row in rows])
+
+        if target != tag_database:
+            copy_tags(Tag._default_manager.using(tag_database).filter(pk__in=list(tag_ids)), target)
+        db.insert_ignore(opts.db_table, item_columns,
+                         [(tag_id, ctype.pk, object_id, popular, score, created) for \
+                          item_id, tag_id, object_id, popular, score, created in rows], using=target)
+
+        source_cursor.execute('SELECT %s, %s, %s FROM %s WHERE %s IN (%s)' % (
+            qn(item_column), qn(item_owner_column), qn(created_column), qn(item_owners),
+            qn(item_column), ', '.join(['%s'] * len(item_ids))), item_ids)
+        owners = {}
+        for item_id, owner_id, created in source_cursor.fetchall():
+            owners.setdefault(item_id, []).append((owner_id, created))
+
+        target_ids = {}
+        for item_id, tag_id, object_id in TaggedItem._default_manager.using(target) \
+                .filter(content_type=ctype, tag__in=list(tag_ids),
+                        object_id__in=list(set([row[2] for row in rows]))) \
+                .values_list('pk', 'tag', 'object_id'):
+            target_ids[(tag_id, object_id)] = item_id
+        item_rows, tag_rows, events = [], set(), []
+        for item_id, tag_id, object_id, popular, score, created in rows:
+            for owner_id, owner_created in owners.get(item_id, []):
+                item_rows.append((target_ids[(tag_id, object_id)], owner_id, owner_created))
+                tag_rows.add((tag_id, owner_id))
+                events.append((outbox.ADD, ctype.pk, object_id, tag_id, owner_id))
+        db.insert_ignore(item_owners, (item_column, item_owner_column, created_column),
+                         item_rows, using=target)
+        db.insert_ignore(tag_owners, (tag_column, tag_owner_column), tag_rows, using=target)
+        # The source outbox gets the deletions, the target's the additions.
+        outbox.append(events, using=target)
+
+        delete_items(item_ids, using=source)
+        moved += len(item_ids)
+        if progress is not None:
+            progress(moved)
@@ -0,0 +1,192 @@
+"""
+Similar objects by tag overlap, using MinHash signatures and LSH.
+
+The signature of an object is, for each of ``TAGGING_MINHASH_BANDS *
+TAGGING_MINHASH_ROWS`` hash functions, the smallest hash of the ids of
+its tags. The share of positions two signatures agree on estimates the
+Jaccard similarity of the tag sets. Signatures are stored as fixed-width
+arrays of 32 bit values, and each band of ``TAGGING_MINHASH_ROWS``
+values is indexed by its hash, so the candidates for ``similar_to`` are
+the objects sharing at least one band hash with the object, found by
+index lookups rather than a scan.
+
+Signatures are kept up to date for the models given to ``register``,
+whenever the popularity of their objects is refreshed, which every
+tagging write ends with. ``manage.py tagging_similarity`` builds them in
+bulk for any model.
+"""
+import base64
+import random
+import struct
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections, router, transaction
+from django.db.models import Count, Q
+from django.utils.hashcompat import md5_constructor
+
+from tagging import db, settings, shards
+
+# A Mersenne prime above every tag id, for the universal hash functions.
+PRIME = (1 << 31) - 1
+
+# How many candidates, per result asked for, are compared by signature.
+CANDIDATES_PER_RESULT = 10
+
+def _hash_functions():
+    size = settings.TAGGING_MINHASH_BANDS * settings.TAGGING_MINHASH_ROWS
+    rng = random.Random(size)
+    return [(rng.randint(1, PRIME - 1), rng.randint(0, PRIME - 1)) for i in range(size)]
+
+_functions = _hash_functions()
+
+def signature(tag_ids):
+    """
+    Returns the MinHash signature of a set of tag ids as a tuple.
+    """
+    return tuple([min([(a * tag_id + b) % PRIME for tag_id in tag_ids]) \
+                  for a, b in _functions])
+
+def encode(sig):
+    return base64.b64encode(struct.pack('>%dI' % len(sig), *sig))
+
+def decode(data):
+    data = base64.b64decode(data)
+    return struct.unpack('>%dI' % (len(data) // 4), data)
+
+def band_hashes(sig):
+    """
+    Returns the hash of each band of ``sig``, as a signed 32 bit value.
+    """
+    rows = settings.TAGGING_MINHASH_ROWS
+    hashes = []
+    for band in range(settings.TAGGING_MINHASH_BANDS):
+        digest = md5_constructor(struct.pack('>%dI' % rows, *sig[band * rows:(band + 1) * rows]))
+        hashes.append(struct.unpack('>i', digest.digest()[:4])[0])
+    return hashes
+
+def estimate(sig1, sig2):
+    """
+    Estimates the Jaccard similarity of the tag sets behind two
+    signatures.
+    """
+    return sum([1 for x, y in zip(sig1, sig2) if x == y]) / float(len(sig1))
+
+_registry = set()
+
+def register(model):
+    """
+    Keeps the signatures of the objects of ``model`` up to date.
+    """
+    _registry.add(ContentType.objects.get_for_model(model).pk)
+
+def changed(content_type, object_ids):
+    """
+    Called when the tags of ``object_ids`` changed; updates their
+    signatures if their model is registered.
+    """
+    content_type = getattr(content_type, 'pk', content_type)
+    if content_type in _registry:
+        update(content_type, object_ids)
+
+def update(content_type, object_ids):
+    """
+    Recomputes the signatures of ``object_ids`` from their tags, and
+    deletes those of objects left without tags.
+    """
+    from tagging.models import TaggedItem, TagSignature, TagSignatureBand
+
+    content_type = getattr(content_type, 'pk', content_type)
+    object_ids = list(object_ids)
+    if not object_ids:
+        return
+    using = shards.database_for(content_type) or router.db_for_write(TagSignature)
+    tag_ids = {}
+    for object_id, tag_id in TaggedItem._default_manager.db_manager(using) \
+            .filter(content_type=content_type, object_id__in=object_ids) \
+            .values_list('object_id', 'tag'):
+        tag_ids.setdefault(object_id, []).append(tag_id)
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for model in (TagSignature, TagSignatureBand):
+        opts = model._meta
+        cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s IN (%s)' % (
+            qn(opts.db_table), qn(opts.get_field('content_type').column),
+            qn(opts.get_field('object_id').column), ', '.join(['%s'] * len(object_ids))),
+            [content_type] + object_ids)
+    transaction.commit_unless_managed(using=using)
+
+    signatures, bands = [], []
+    for object_id, ids in tag_ids.items():
+        sig = signature(ids)
+        signatures.append((content_type, object_id, encode(sig)))
+        for band, band_hash in enumerate(band_hashes(sig)):
+            bands.append((content_type, band, band_hash, object_id))
+    for model, rows in ((TagSignature, signatures), (TagSignatureBand, bands)):
+        opts = model._meta
+        db.insert_ignore(opts.db_table,
+                         [field.column for field in opts.fields if not field.primary_key],
+                         rows, using=using)
+
+def rebuild(model, batch_size=500, progress=None):
+    """
+    Builds the signatures of every tagged object of ``model``,
+    ``batch_size`` objects at a time. If given, ``progress`` is called
+    with the number of objects done after each batch. Returns that
+    number.
+    """
+    from tagging.models import TaggedItem
+
+    ctype = ContentType.objects.get_for_model(model)
+    items = TaggedItem.objects.for_content_type(ctype).filter(content_type=ctype)
+    done, last = 0, 0
+    while True:
+        ids = list(items.filter(object_id__gt=last).order_by('object_id') \
+                        .values_list('object_id', flat=True).distinct()[:batch_size])
+        if not ids:
+            return done
+        update(ctype, ids)
+        done += len(ids)
+        last = ids[-1]
+        if progress is not None:
+            progress(done)
+
+def similar_to(obj, k=10):
+    """
+    Returns up to ``k`` objects of the same model as ``obj`` whose tags
+    are most like its own, the most similar first, each with the
+    estimated Jaccard similarity of the tag sets as ``similarity``.
+    Returns an empty list if ``obj`` has no signature.
+    """
+    from tagging.models import TagSignature, TagSignatureBand
+
+    ctype = ContentType.objects.get_for_model(obj)
+    using = shards.database_for(ctype)
+    signatures = TagSignature._default_manager.db_manager(using).filter(content_type=ctype)
+    try:
+        sig = decode(signatures.get(object_id=obj.pk).minhash)
+    except TagSignature.DoesNotExist:
+        return []
+
+    bands = Q()
+    for band, band_hash in enumerate(band_hashes(sig)):
+        bands |= Q(band=band, hash=band_hash)
+    # The objects sharing the most bands are the likeliest to be close.
+    candidates = TagSignatureBand._default_manager.db_manager(using) \
+                     .filter(bands, content_type=ctype).exclude(object_id=obj.pk) \
+                     .values('object_id').annotate(n=Count('pk')) \
+                     .order_by('-n', 'object_id')[:k * CANDIDATES_PER_RESULT]
+    scores = [(estimate(sig, decode(minhash)), object_id) for object_id, minhash in \
+              signatures.filter(object_id__in=[row['object_id'] for row in candidates]) \
+                        .values_list('object_id', 'minhash')]
+    scores.sort(key=lambda score: (-score[0], score[1]))
+    scores = scores[:k]
+
+    objects = obj.__class__._default_manager.in_bulk([object_id for score, object_id in scores])
+    result = []
+    for score, object_id in scores:
+        if object_id in objects:
+            objects[object_id].similarity = score
+            result.append(objects[object_id])
+    return result
@@ -0,0 +1,344 @@
+"""
+Approximate counts of the distinct owners of tags, with HyperLogLog.
+
+Counting the distinct owners of every tag with ``COUNT(DISTINCT ...)``
+over the owner tables reads every owner row. With
+``TAGGING_OWNER_SKETCHES`` on, the write paths also add each owner to a
+HyperLogLog sketch of the tag, one across content types and one per
+content type, and ``Tag.objects.owner_counts(..., approximate=True)``
+reads the sketches instead: one small row per tag whatever its number of
+owners.
+
+A sketch has ``2 ** TAGGING_SKETCH_PRECISION`` one byte registers,
+stored compressed and base64 encoded. The estimates have a relative
+standard error of ``1.04 / sqrt(2 ** TAGGING_SKETCH_PRECISION)``, 3.25%
+at the default precision of 10, and are within three times that of the
+exact count in 99.7% of cases; small counts are nearly exact. Sketches
+can't forget, so owners who stop using a tag are still counted until
+``manage.py tagging_sketches`` rebuilds them from the owner tables,
+which is also how sketches are first built, and needed after changing
+the precision. Concurrent writes to a sketch retry until they apply;
+only a write inside a transaction whose reads can't see the write it
+lost to is dropped, with a warning logged, and its owners are then
+undercounted until the sketches are rebuilt.
+
+Sketches are kept in the database of the items they count, see
+``tagging.shards``; the counts across content types merge the sketches
+of every database.
+"""
+import base64
+import logging
+import math
+import struct
+import zlib
+
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.utils.hashcompat import md5_constructor
+
+from tagging import db, settings, shards
+
+logger = logging.getLogger('tagging.sketches')
+
+# The ``content_type_id`` of the sketches of tags across content types.
+ALL_CONTENT_TYPES = 0
+
+# Tags per statement.
+BATCH_SIZE = 500
+
+class HyperLogLog(object):
+    """
+    A HyperLogLog sketch of a set of values, with ``2 ** precision``
+    registers.
+    """
+    def __init__(self, precision=None, registers=None):
+        if precision is None:
+            precision = settings.TAGGING_SKETCH_PRECISION
+        if not 4 <= precision <= 16:
+            raise ValueError('The precision of a sketch must be between 4 and 16.')
+        self.precision = precision
+        if registers is None:
+            registers = bytearray(1 << precision)
+        self.registers = registers
+
+    def add(self, value):
+        """
+        Adds ``value`` to the set. Returns whether the sketch changed.
+        """
+        hash, = struct.unpack('>Q', md5_constructor(str(value)).digest()[:8])
+        index = hash >> (64 - self.precision)
+        rest = hash & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def update(self, other):
+        """
+        Adds the values of ``other`` to the set. Returns whether the
+        sketch changed.
+        """
+        if other.precision != self.precision:
+            raise ValueError('Sketches of different precisions can\'t be merged.')
+        changed = False
+        for index, rank in enumerate(other.registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+                changed = True
+        return changed
+
+    def count(self):
+        """
+        Returns the estimated number of distinct values in the set.
+        """
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / sum([2.0 ** -rank for rank in self.registers])
+        zeros = len([rank for rank in self.registers if not rank])
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small sets.
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def encode(self):
+        return base64.b64encode(zlib.compress(bytes(self.registers)))
+
+    def decode(cls, data, precision=None):
+        """
+        Returns the sketch ``encode`` returned ``data`` for, or an empty
+        sketch if ``data`` is empty.
+        """
+        if not data:
+            return cls(precision)
+        registers = bytearray(zlib.decompress(base64.b64decode(data)))
+        return cls(int(math.log(len(registers), 2)), registers)
+    decode = classmethod(decode)
+
+def standard_error(precision=None):
+    """
+    Returns the relative standard error of the estimates of sketches of
+    ``precision``.
+    """
+    if precision is None:
+        precision = settings.TAGGING_SKETCH_PRECISION
+    return 1.04 / math.sqrt(1 << precision)
+
+def add(owners, using=None):
+    """
+    Adds each ``(content_type_id, tag_id, owner_id)`` in ``owners`` to
+    the sketches of the tag, if ``TAGGING_OWNER_SKETCHES`` is on.
+    """
+    if not settings.TAGGING_OWNER_SKETCHES or not owners:
+        return
+    sketches = {}
+    for content_type_id, tag_id, owner_id in owners:
+        for key in ((content_type_id, tag_id), (ALL_CONTENT_TYPES, tag_id)):
+            if key not in sketches:
+                sketches[key] = HyperLogLog()
+            sketches[key].add(owner_id)
+    merge(sketches, using)
+
+def _read(keys, using):
+    """
+    Returns the ``(id, registers, version)`` of the stored sketches of
+    the ``(content_type_id, tag_id)`` pairs ``keys``.
+    """
+    from tagging.models import OwnerSketch
+
+    qn = connections[using].ops.quote_name
+    cursor = connections[using].cursor()
+    opts = OwnerSketch._meta
+    tag_ids = {}
+    for content_type_id, tag_id in keys:
+        tag_ids.setdefault(content_type_id, []).append(tag_id)
+    rows = {}
+    for content_type_id, ids in tag_ids.items():
+        for i in range(0, len(ids), BATCH_SIZE):
+            batch = ids[i:i + BATCH_SIZE]
+            cursor.execute('SELECT %s, %s, %s, %s FROM %s WHERE %s = %%s AND %s IN (%s)' % (
+                qn(opts.pk.column), qn(opts.get_field('tag').column),
+                qn(opts.get_field('registers').column), qn(opts.get_field('version').column),
+                qn(opts.db_table), qn(opts.get_field('content_type_id').column),
+                qn(opts.get_field('tag').column), ', '.join(['%s'] * len(batch))),
+                [content_type_id] + batch)
+            for pk, tag_id, registers, version in cursor.fetchall():
+                rows[(content_type_id, tag_id)] = (pk, registers, version)
+    return rows
+
+def merge(sketches, using=None):
+    """
+    Merges the sketches of the dict ``sketches``, keyed by
+    ``(content_type_id, tag_id)``, into the stored ones, creating those
+    missing.
+
+    Each stored sketch is replaced only if nobody changed it since it
+    was read, going by its version, and otherwise read again, until the
+    merge applies. Only if a read still shows the version the replace
+    failed against, as happens in a transaction whose reads see a
+    snapshot, is the merge given up on, with a warning logged.
+    """
+    from tagging.models import OwnerSketch
+
+    if not sketches:
+        return
+    using = using or router.db_for_write(OwnerSketch)
+    opts = OwnerSketch._meta
+    db.insert_ignore(opts.db_table,
+                     [opts.get_field(name).column for name in \
+                      ('content_type_id', 'tag', 'registers', 'version')],
+                     [key + ('', 0) for key in sketches], using=using)
+    cursor = connections[using].cursor()
+    qn = connections[using].ops.quote_name
+    pending = sketches
+    failed = {}
+    while pending:
+        conflicts = {}
+        for key, (pk, registers, version) in _read(pending.keys(), using).items():
+            if failed.get(key) == version:
+                # Retrying can't see the winning write.
+                logger.warning('Gave up adding to the owner sketch of tag %s, content type %s, '
+                               'in %s; rebuild the sketches with tagging_sketches.',
+                               key[1], key[0], using)
+                continue
+            stored = HyperLogLog.decode(registers)
+            if stored.precision != pending[key].precision:
+                # Built at another precision: start over until rebuilt.
+                stored = HyperLogLog(pending[key].precision)
+            if not stored.update(pending[key]) and registers:
+                continue
+            cursor.execute('UPDATE %s SET %s = %%s, %s = %s + 1 WHERE %s = %%s AND %s = %%s' % (
+                qn(opts.db_table), qn(opts.get_field('registers').column),
+                qn(opts.get_field('version').column), qn(opts.get_field('version').column),
+                qn(opts.pk.column), qn(opts.get_field('version').column)),
+                [stored.encode(), pk, version])
+            if not cursor.rowcount:
+                conflicts[key] = pending[key]
+                failed[key] = version
+        pending = conflicts
+    transaction.commit_unless_managed(using=using)
+
+def merge_tags(mapping, using=None):
+    """
+    Merges the sketches of the tags whose ids are the keys of
+    ``mapping`` into those of the tags whose ids are the values, and
+    deletes them, for ``Tag.objects.merge``.
+    """
+    from tagging.models import OwnerSketch
+
+    using = using or router.db_for_write(OwnerSketch)
+    source_ids = list(mapping.keys())
+    sketches = {}
+    for i in range(0, len(source_ids), BATCH_SIZE):
+        for content_type_id, tag_id, registers in OwnerSketch._default_manager.using(using) \
+                .filter(tag__in=source_ids[i:i + BATCH_SIZE]) \
+                .values_list('content_type_id', 'tag', 'registers'):
+            key = (content_type_id, mapping[tag_id])
+            sketch = HyperLogLog.decode(registers)
+            if key not in sketches:
+                sketches[key] = sketch
+            elif sketches[key].precision == sketch.precision:
+                sketches[key].update(sketch)
+    merge(sketches, using)
+    delete(source_ids, using)
+
+def delete(tag_ids, using=None):
+    """
+    Deletes the sketches of the tags ``tag_ids``.
+    """
+    from tagging.models import OwnerSketch
+
+    using = using or router.db_for_write(OwnerSketch)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = OwnerSketch._meta
+    cursor = connection.cursor()
+    tag_ids = list(tag_ids)
+    for i in range(0, len(tag_ids), BATCH_SIZE):
+        batch = tag_ids[i:i + BATCH_SIZE]
+        cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+            qn(opts.db_table), qn(opts.get_field('tag').column), ', '.join(['%s'] * len(batch))),
+            batch)
+    transaction.commit_unless_managed(using=using)
+
+def estimates(content_type_id=None, tag_ids=None):
+    """
+    Returns a dict mapping the ids of tags with a sketch, or of those of
+    ``tag_ids``, to the estimated number of their distinct owners on
+    objects of ``content_type_id``, or of any content type if ``None``.
+    """
+    from tagging.models import OwnerSketch
+
+    if content_type_id is None:
+        databases = [DEFAULT_DB_ALIAS] + shards.databases()
+        content_type_id = ALL_CONTENT_TYPES
+    else:
+        databases = [shards.database_for(content_type_id) or DEFAULT_DB_ALIAS]
+    merged = {}
+    for using in databases:
+        sketches = OwnerSketch._default_manager.using(using).filter(content_type_id=content_type_id)
+        if tag_ids is not None:
+            sketches = sketches.filter(tag__in=list(tag_ids))
+        for tag_id, registers in sketches.values_list('tag', 'registers'):
+            sketch = HyperLogLog.decode(registers)
+            if tag_id not in merged:
+                merged[tag_id] = sketch
+            else:
+                merged[tag_id].update(sketch)
+    return dict([(tag_id, sketch.count()) for tag_id, sketch in merged.items()])
+
+def rebuild(batch_size=1000, progress=None):
+    """
+    Rebuilds the sketches of every tag from the owner tables of every
+    database, ``batch_size`` tags at a time. If given, ``progress`` is
+    called with the number of tags done after each batch. Returns the
+    number of sketches written.
+    """
+    from tagging.models import OwnerSketch, Tag, TaggedItem
+
+    opts = OwnerSketch._meta
+    items = TaggedItem._meta
+    tag_owners, tag_column, tag_owner_column = db.m2m_table(Tag, 'owners')
+    item_owners, item_column, item_owner_column = db.m2m_table(TaggedItem, 'owners')
+    written = done = 0
+    for using in [DEFAULT_DB_ALIAS] + shards.databases():
+        connection = connections[using]
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        last = 0
+        while True:
+            tag_ids = list(Tag._default_manager.using(using).filter(pk__gt=last) \
+                              .order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not tag_ids:
+                break
+            last = tag_ids[-1]
+            sketches = {}
+            for i in range(0, len(tag_ids), BATCH_SIZE):
+                batch = tag_ids[i:i + BATCH_SIZE]
+                placeholders = ', '.join(['%s'] * len(batch))
+                cursor.execute('SELECT %s, %s, %s FROM %s WHERE %s IN (%s)' % (
+                    ALL_CONTENT_TYPES, qn(tag_column), qn(tag_owner_column), qn(tag_owners),
+                    qn(tag_column), placeholders), batch)
+                rows = cursor.fetchall()
+                cursor.execute('SELECT i.%s, i.%s, o.%s FROM %s o INNER JOIN %s i ON o.%s = i.%s '
+                               'WHERE i.%s IN (%s)' % (
+                    qn(items.get_field('content_type').column), qn(items.get_field('tag').column),
+                    qn(item_owner_column), qn(item_owners), qn(items.db_table), qn(item_column),
+                    qn(items.pk.column), qn(items.get_field('tag').column), placeholders), batch)
+                rows.extend(cursor.fetchall())
+                for content_type_id, tag_id, owner_id in rows:
+                    key = (content_type_id, tag_id)
+                    if key not in sketches:
+                        sketches[key] = HyperLogLog()
+                    sketches[key].add(owner_id)
+            delete(tag_ids, using)
+            db.insert_ignore(opts.db_table,
+                             [opts.get_field(name).column for name in \
+                              ('content_type_id', 'tag', 'registers', 'version')],
+                             [key + (sketch.encode(), 0) for key, sketch in sketches.items()],
+                             using=using)
+            transaction.commit_unless_managed(using=using)
+            written += len(sketches)
+            done += len(tag_ids)
+            if progress is not None:
+                progress(done)
+    return written
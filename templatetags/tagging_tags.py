@@ -1,78 +1,217 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.db.models import get_model, Q
 from django.template import Library, Node, TemplateSyntaxError, Variable, resolve_variable
 from django.utils.translation import ugettext as _
 
+from tagging import settings, versions
 from tagging.models import Tag, TaggedItem
-from tagging.utils import LINEAR, LOGARITHMIC
+from tagging.records import TagRecord
+from tagging.utils import LINEAR, LOGARITHMIC, get_tag_list
 
 register = Library()
 
-class TagsForModelNode(Node):
-    def __init__(self, model, context_var, counts):
-        self.model = model
+# Flags of the tags kept in the cache by ``pack_tags``.
+POPULAR = 1
+OWN = 2
+
+def pack_tags(tags):
+    """
+    Returns ``tags`` as a list of ``(id, name, flags)`` tuples, with the
+    ``count`` of each tag appended if it has one.
+    """
+    packed = []
+    for tag in tags:
+        flags = 0
+        if getattr(tag, 'popular', False):
+            flags |= POPULAR
+        if getattr(tag, 'is_own', False):
+            flags |= OWN
+        row = (tag.pk, tag.name, flags)
+        if getattr(tag, 'count', None) is not None:
+            row += (tag.count,)
+        packed.append(row)
+    return packed
+
+def unpack_tags(packed, records=False):
+    """
+    Turns the tuples made by ``pack_tags`` back into tags, as
+    ``TagRecord`` instances if ``records`` is true.
+    """
+    tags = []
+    for row in packed:
+        if records:
+            tag = TagRecord(row[0], row[1], row[2] & POPULAR, row[2] & OWN)
+        else:
+            tag = Tag(id=row[0], name=row[1])
+            tag.popular = bool(row[2] & POPULAR)
+            tag.is_own = bool(row[2] & OWN)
+        if len(row) > 3:
+            tag.count = row[3]
+        tags.append(tag)
+    return tags
+
+class CachedResultNode(Node):
+    """
+    Stores what ``get_result`` returns in a context variable.
+
+    With a ``cache_timeout``, the result is kept in the cache for that
+    many seconds, in the compact form made by ``pack``. The key comes
+    from the ``(version_keys, parts)`` returned by ``cache_key``, so a
+    write to the tags the result depends on changes it.
+    """
+    prefix = None
+
+    def __init__(self, context_var, cache_timeout=None):
         self.context_var = context_var
-        self.counts = counts
+        self.cache_timeout = cache_timeout is not None and Variable(cache_timeout) or None
 
     def render(self, context):
+        if self.cache_timeout is None:
+            context[self.context_var] = self.get_result(context)
+            return ''
+        version_keys, parts = self.cache_key(context)
+        key = versions.make_key(self.prefix, version_keys, *parts)
+        packed = cache.get(key)
+        if packed is None:
+            packed = self.pack(self.get_result(context))
+            cache.set(key, packed, int(self.cache_timeout.resolve(context)))
+        context[self.context_var] = self.unpack(packed, context)
+        return ''
+
+    def pack(self, result):
+        return pack_tags(result)
+
+    def unpack(self, packed, context):
+        return unpack_tags(packed, settings.TAGGING_TEMPLATE_RECORDS)
+
+class TagsForModelNode(CachedResultNode):
+    prefix = 'tags_for_model'
+
+    def __init__(self, model, context_var, counts, cache_timeout=None):
+        super(TagsForModelNode, self).__init__(context_var, cache_timeout)
+        self.model = model
+        self.counts = counts
+
+    def get_model(self):
         model = get_model(*self.model.split('.'))
         if model is None:
             raise TemplateSyntaxError(_('tags_for_model tag was given an invalid model: %s') % self.model)
-        context[self.context_var] = Tag.objects.usage_for_model(model, counts=self.counts)
-        return ''
+        return model
+
+    def get_result(self, context):
+        return Tag.objects.usage_for_model(self.get_model(), counts=self.counts,
+                                          records=settings.TAGGING_TEMPLATE_RECORDS)
 
-class TagsForObjectNode(Node):
-    def __init__(self, obj, context_var):
+    def cache_key(self, context):
+        ctype = ContentType.objects.get_for_model(self.get_model())
+        return [versions.content_type_key(ctype.pk)], (ctype.pk, self.counts)
+
+def _top(limit, context):
+    """
+    Returns the ``top`` argument for ``get_for_object`` given by the
+    ``limit`` variable of a tag, if any.
+    """
+    if limit is None:
+        return {}
+    return {'top': int(limit.resolve(context))}
+
+class TagsForObjectNode(CachedResultNode):
+    prefix = 'tags_for_object'
+
+    def __init__(self, obj, context_var, limit=None, cache_timeout=None):
+        super(TagsForObjectNode, self).__init__(context_var, cache_timeout)
         self.obj = Variable(obj)
-        self.context_var = context_var
+        self.limit = limit is not None and Variable(limit) or None
 
-    def render(self, context):
-        context[self.context_var] = \
-                Tag.objects.get_for_object(self.obj.resolve(context))
-        return ''
+    def get_result(self, context):
+        return Tag.objects.get_for_object(self.obj.resolve(context),
+                                          records=settings.TAGGING_TEMPLATE_RECORDS,
+                                          **_top(self.limit, context))
+
+    def cache_key(self, context):
+        obj = self.obj.resolve(context)
+        ctype = ContentType.objects.get_for_model(obj)
+        return [versions.object_key(ctype.pk, obj.pk)], \
+               (ctype.pk, obj.pk, _top(self.limit, context).get('top'))
 
 class PopularTagsForObjectNode(TagsForObjectNode):
+    prefix = 'popular_tags_for_object'
 
-    def render(self, context):
-        context[self.context_var] = \
-                Tag.objects.get_for_object(self.obj.resolve(context), None, items__popular=True)
-        return ''
+    def get_result(self, context):
+        return Tag.objects.get_for_object(self.obj.resolve(context), None, items__popular=True,
+                                          records=settings.TAGGING_TEMPLATE_RECORDS,
+                                          **_top(self.limit, context))
 
-class TagsForObjectOwner(Node):
-    def __init__(self, obj, owner, context_var):
-        self.obj = Variable(obj)
+class TagsForObjectOwner(TagsForObjectNode):
+    prefix = 'tags_for_object_owner'
+
+    def __init__(self, obj, owner, context_var, limit=None, cache_timeout=None):
+        super(TagsForObjectOwner, self).__init__(obj, context_var, limit, cache_timeout)
         self.owner = Variable(owner)
-        self.context_var = context_var
 
-    def render(self, context):
+    def get_result(self, context):
+        return Tag.objects.get_for_object_owner(self.obj.resolve(context), self.owner.resolve(context),
+                                                records=settings.TAGGING_TEMPLATE_RECORDS)
 
-        context[self.context_var] = \
-                Tag.objects.get_for_object_owner(self.obj.resolve(context), self.owner.resolve(context))
-        return ''
+    def cache_key(self, context):
+        version_keys, parts = super(TagsForObjectOwner, self).cache_key(context)
+        return version_keys, parts + (self.owner.resolve(context).pk,)
 
 
 class MixedTags(TagsForObjectOwner):
+    prefix = 'mixed_tags_for_object'
 
-    def render(self, context):
+    def get_result(self, context):
         owner = self.owner.resolve(context)
         obj = self.obj.resolve(context)
-        context[self.context_var] = \
-                Tag.objects.get_for_object(obj, owner, Q(items__popular=True) | Q(owners=owner))
-        return ''
+        return Tag.objects.get_for_object(obj, owner, Q(items__popular=True) | Q(owners=owner),
+                                          records=settings.TAGGING_TEMPLATE_RECORDS,
+                                          **_top(self.limit, context))
 
 
-class TaggedObjectsNode(Node):
-    def __init__(self, tag, model, context_var):
+class TaggedObjectsNode(CachedResultNode):
+    prefix = 'tagged_objects'
+
+    def __init__(self, tag, model, context_var, cache_timeout=None):
+        super(TaggedObjectsNode, self).__init__(context_var, cache_timeout)
         self.tag = Variable(tag)
-        self.context_var = context_var
         self.model = model
 
-    def render(self, context):
+    def get_model(self):
         model = get_model(*self.model.split('.'))
         if model is None:
             raise TemplateSyntaxError(_('tagged_objects tag was given an invalid model: %s') % self.model)
-        context[self.context_var] = \
-            TaggedItem.objects.get_by_model(model, self.tag.resolve(context))
-        return ''
+        return model
+
+    def get_result(self, context):
+        return TaggedItem.objects.get_by_model(self.get_model(), self.tag.resolve(context))
+
+    def cache_key(self, context):
+        ctype = ContentType.objects.get_for_model(self.get_model())
+        tag_ids = sorted([tag.pk for tag in get_tag_list(self.tag.resolve(context))])
+        return [versions.content_type_key(ctype.pk)], (ctype.pk, tag_ids)
+
+    def pack(self, result):
+        return list(result.values_list('pk', flat=True))
+
+    def unpack(self, packed, context):
+        return self.get_model()._default_manager.filter(pk__in=packed)
+
+def _parse_clauses(tag_name, bits, clauses):
+    """
+    Parses the optional ``[keyword] [value]`` pairs ending a tag, each
+    keyword being one of ``clauses``, into a dict.
+    """
+    if len(bits) % 2:
+        raise TemplateSyntaxError(_('%s tag was given an incomplete clause') % tag_name)
+    options = {}
+    for keyword, value in zip(bits[::2], bits[1::2]):
+        if keyword not in clauses or keyword in options:
+            raise TemplateSyntaxError(_("%(tag)s tag was given an unexpected clause: '%(clause)s'") % {
+                'tag': tag_name, 'clause': keyword})
+        options[keyword] = value
+    return options
 
 def do_tags_for_model(parser, token):
     """
@@ -93,27 +232,27 @@ def do_tags_for_model(parser, token):
     a ``count`` attribute to each tag containing the number of
     instances of the given model which have been tagged with it.
 
+    Any of the tags of this library can be given ``cache [seconds]``
+    last, to keep its result in the cache for that many seconds or
+    until the tags it depends on change.
+
     Examples::
 
        {% tags_for_model products.Widget as widget_tags %}
        {% tags_for_model products.Widget as widget_tags with counts %}
+       {% tags_for_model products.Widget as widget_tags with counts cache 600 %}
 
     """
     bits = token.contents.split()
-    len_bits = len(bits)
-    if len_bits not in (4, 6):
-        raise TemplateSyntaxError(_('%s tag requires either three or five arguments') % bits[0])
+    if len(bits) < 4:
+        raise TemplateSyntaxError(_('%s tag requires at least three arguments') % bits[0])
     if bits[2] != 'as':
         raise TemplateSyntaxError(_("second argument to %s tag must be 'as'") % bits[0])
-    if len_bits == 6:
-        if bits[4] != 'with':
-            raise TemplateSyntaxError(_("if given, fourth argument to %s tag must be 'with'") % bits[0])
-        if bits[5] != 'counts':
-            raise TemplateSyntaxError(_("if given, fifth argument to %s tag must be 'counts'") % bits[0])
-    if len_bits == 4:
-        return TagsForModelNode(bits[1], bits[3], counts=False)
-    else:
-        return TagsForModelNode(bits[1], bits[3], counts=True)
+    options = _parse_clauses(bits[0], bits[4:], ('with', 'cache'))
+    if options.get('with', 'counts') != 'counts':
+        raise TemplateSyntaxError(_("if given, fifth argument to %s tag must be 'counts'") % bits[0])
+    return TagsForModelNode(bits[1], bits[3], counts='with' in options,
+                            cache_timeout=options.get('cache'))
 
 def do_tags_for_object(parser, token, node=None):
     """
@@ -124,20 +263,30 @@ def do_tags_for_object(parser, token, node=None):
 
        {% tags_for_object [object] as [varname] %}
 
-    Example::
+    Extended usage::
+
+       {% tags_for_object [object] as [varname] limit [count] cache [seconds] %}
+
+    If a limit is given, only that many tags are retrieved, those with
+    the highest score first.
+
+    Examples::
 
         {% tags_for_object foo_object as tag_list %}
+        {% popular_tags_for_object foo_object as tag_list limit 10 %}
+        {% popular_tags_for_object foo_object as tag_list cache 300 %}
     """
 
     if node is None:
         node = TagsForObjectNode
-    
+
     bits = token.contents.split()
-    if len(bits) != 4:
-        raise TemplateSyntaxError(_('%s tag requires exactly three arguments') % bits[0])
+    if len(bits) < 4:
+        raise TemplateSyntaxError(_('%s tag requires at least three arguments') % bits[0])
     if bits[2] != 'as':
         raise TemplateSyntaxError(_("second argument to %s tag must be 'as'") % bits[0])
-    return node(bits[1], bits[3])
+    options = _parse_clauses(bits[0], bits[4:], ('limit', 'cache'))
+    return node(bits[1], bits[3], options.get('limit'), options.get('cache'))
 
 def do_popular_tags_for_object(parser, token, node=None):
 
@@ -151,18 +300,21 @@ def do_mixed_tags_for_object(parser, token):
     Usage::
 
        {% mixed_tags_for_object [object] [owner] as [varname] %}
+       {% mixed_tags_for_object [object] [owner] as [varname] limit [count] cache [seconds] %}
 
     Example::
 
         {% mixed_tags_for_object foo_object foo_owner as tag_list %}
+        {% mixed_tags_for_object foo_object foo_owner as tag_list limit 10 %}
     """
-    
+
     bits = token.contents.split()
-    if len(bits) != 5:
-        raise TemplateSyntaxError(_('%s tag requires exactly four arguments') % bits[0])
+    if len(bits) < 5:
+        raise TemplateSyntaxError(_('%s tag requires at least four arguments') % bits[0])
     if bits[3] != 'as':
         raise TemplateSyntaxError(_("second argument to %s tag must be 'as'") % bits[0])
-    return MixedTags(bits[1], bits[2], bits[4])
+    options = _parse_clauses(bits[0], bits[5:], ('limit', 'cache'))
+    return MixedTags(bits[1], bits[2], bits[4], options.get('limit'), options.get('cache'))
 
 
 def do_tagged_objects(parser, token):
@@ -173,6 +325,7 @@ def do_tagged_objects(parser, token):
     Usage::
 
        {% tagged_objects [tag] in [model] as [varname] %}
+       {% tagged_objects [tag] in [model] as [varname] cache [seconds] %}
 
     The model is specified in ``[appname].[modelname]`` format.
 
@@ -184,13 +337,14 @@ def do_tagged_objects(parser, token):
 
     """
     bits = token.contents.split()
-    if len(bits) != 6:
-        raise TemplateSyntaxError(_('%s tag requires exactly five arguments') % bits[0])
+    if len(bits) < 6:
+        raise TemplateSyntaxError(_('%s tag requires at least five arguments') % bits[0])
     if bits[2] != 'in':
         raise TemplateSyntaxError(_("second argument to %s tag must be 'in'") % bits[0])
     if bits[4] != 'as':
         raise TemplateSyntaxError(_("fourth argument to %s tag must be 'as'") % bits[0])
-    return TaggedObjectsNode(bits[1], bits[3], bits[5])
+    options = _parse_clauses(bits[0], bits[6:], ('cache',))
+    return TaggedObjectsNode(bits[1], bits[3], bits[5], options.get('cache'))
 
 register.tag('tags_for_model', do_tags_for_model)
 register.tag('popular_tags_for_object', do_popular_tags_for_object)
@@ -1,6 +1,7 @@
 from django.db import models
 
-from tagging.managers import ModelTaggedItemManager, ModelTagManager
+from tagging.fields import TagField
+from tagging.managers import ModelTaggedItemManager, ModelTagManager, TagDescriptor
 
 class Perch(models.Model):
     size = models.IntegerField()
@@ -30,6 +31,7 @@ class Link(models.Model):
 
 class Article(models.Model):
     name = models.CharField(max_length=50)
+    tags = TagDescriptor()
 
     def __unicode__(self):
         return self.name
@@ -37,3 +39,9 @@ class Article(models.Model):
     class Meta:
         ordering = ['name']
 
+class Note(models.Model):
+    text = models.CharField(max_length=50)
+    tags = TagField()
+
+    def __unicode__(self):
+        return self.text
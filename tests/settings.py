@@ -3,24 +3,46 @@ DIRNAME = os.path.dirname(__file__)
 
 DEFAULT_CHARSET = 'utf-8'
 
-#DATABASE_ENGINE = 'sqlite3'
-#DATABASE_NAME = os.path.join(DIRNAME, 'tagging_test.db')
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': 'tagging_test',
+        'USER': 'postgres',
+        'PASSWORD': '',
+        'HOST': 'localhost',
+        'PORT': '5432',
+    },
+    # A database of its own which nothing replicates to, playing a
+    # lagging read replica for ReplicaRoutingTest.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(DIRNAME, 'tagging_replica.db'),
+        'TEST_NAME': os.path.join(DIRNAME, 'tagging_test_replica.db'),
+    },
+    # Holds the tagged items of the models ShardingTest registers.
+    'shard': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(DIRNAME, 'tagging_shard.db'),
+        'TEST_NAME': os.path.join(DIRNAME, 'tagging_test_shard.db'),
+    },
+}
 
-#DATABASE_ENGINE = 'mysql'
-#DATABASE_NAME = 'tagging_test'
-#DATABASE_USER = 'root'
-#DATABASE_PASSWORD = ''
-#DATABASE_HOST = 'localhost'
-#DATABASE_PORT = '3306'
+#DATABASES['default'] = {
+#    'ENGINE': 'django.db.backends.sqlite3',
+#    'NAME': os.path.join(DIRNAME, 'tagging_test.db'),
+#}
 
-DATABASE_ENGINE = 'postgresql_psycopg2'
-DATABASE_NAME = 'tagging_test'
-DATABASE_USER = 'postgres'
-DATABASE_PASSWORD = ''
-DATABASE_HOST = 'localhost'
-DATABASE_PORT = '5432'
+#DATABASES['default'] = {
+#    'ENGINE': 'django.db.backends.mysql',
+#    'NAME': 'tagging_test',
+#    'USER': 'root',
+#    'PASSWORD': '',
+#    'HOST': 'localhost',
+#    'PORT': '3306',
+#}
 
 INSTALLED_APPS = (
+    'django.contrib.auth',
     'django.contrib.contenttypes',
     'tagging',
     'tagging.tests',
@@ -3,11 +3,12 @@ r"""
 >>> import os
 >>> from django import forms
 >>> from django.db.models import Q
+>>> from django.contrib.contenttypes.models import ContentType
 >>> from django.contrib.auth.models import User
 >>> from tagging.forms import TagField
 >>> from tagging import settings
 >>> from tagging.models import Tag, TaggedItem
->>> from tagging.tests.models import Article, Link, Perch, Parrot
+>>> from tagging.tests.models import Article, Link, Note, Perch, Parrot
 >>> from tagging.utils import calculate_cloud, get_tag_list, get_tag, parse_tag_input
 >>> from tagging.utils import LINEAR
 
@@ -209,6 +210,21 @@ AttributeError: Multiple tags were given: "one two".
 >>> Tag.objects.get_for_object(alive, u2, Q(items__popular=True) | Q(owners=u2))
 [<Tag: bar>, <Tag: ololo>, <Tag: rar>, <Tag: xxx>, <Tag: zip>]
 
+Tags ranked by score: owner count over the mean of the object's items.
+
+>>> Tag.objects.get_for_object(alive, top=2)
+[<Tag: zip>, <Tag: bar>]
+>>> [(t.name, t.score) for t in Tag.objects.get_for_object(alive, None, items__popular=True, top=5)]
+[(u'zip', 1.8462), (u'bar', 1.3846), (u'rar', 1.3846)]
+
+>>> from django.template import Context, Template
+>>> Template('{% load tagging_tags %}{% popular_tags_for_object obj as tags limit 2 %}'
+...          '{{ tags|join:" " }}').render(Context({'obj': alive}))
+u'zip bar'
+>>> Template('{% load tagging_tags %}{% mixed_tags_for_object obj owner as tags limit n %}'
+...          '{{ tags|join:" " }}').render(Context({'obj': alive, 'owner': u2, 'n': 4}))
+u'zip bar rar ololo'
+
 ###############
 # TaggedItems #
 ###############
@@ -229,6 +245,1004 @@ AttributeError: Multiple tags were given: "one two".
 >>> Parrot.objects.with_all(Tag.objects.filter(name__in=('bar', 'zip')), lambda i: i.popular)
 [<Parrot: alive>]
 
+###################
+# Canonical names #
+###################
+
+>>> from django.core.management import call_command
+>>> from tagging.utils import canonicalize_tag_name
+>>> canonicalize_tag_name(u'  Foo   Bar ')
+u'foo bar'
+>>> canonicalize_tag_name(u'\uff26\uff4f\uff4f')
+u'foo'
+>>> get_tag('BAR')
+<Tag: bar>
+>>> get_tag_list('Bar ZIP')
+[<Tag: bar>, <Tag: zip>]
+
+>>> pining = Parrot.objects.create(state='pining')
+>>> Tag.objects.update_tags(pining, 'Bar zip', u1)
+>>> Tag.objects.get_for_object(pining)
+[<Tag: bar>, <Tag: zip>]
+>>> Tag.objects.add_tag(pining, 'ZIP', u2)
+>>> Tag.objects.get_for_object_owner(pining, u2)
+[<Tag: zip>]
+
+# Tags left over from before canonical names are merged by the command
+>>> Tag.objects.update_tags(pining, 'bar zip fjords', u2)
+>>> Tag.objects.filter(name='fjords').update(name='Bar', canonical='stale')
+1
+>>> call_command('tagging_canonicalize', verbosity=0)
+>>> Tag.objects.get_for_object(pining)
+[<Tag: bar>, <Tag: zip>]
+>>> Tag.objects.get_for_object_owner(pining, u2)
+[<Tag: bar>, <Tag: zip>]
+>>> Tag.objects.filter(name='Bar')
+[]
+
+A name held by a tag with a stale canonical form can't be created, and
+says so rather than tagging nothing.
+
+>>> clash = Tag.objects.create(name='clash')
+>>> Tag.objects.filter(pk=clash.pk).update(canonical='stale')
+1
+>>> Tag.objects.add_tag(pining, 'clash', u2)
+Traceback (most recent call last):
+    ...
+IntegrityError: The tag "clash" could not be created or found.
+>>> Tag.objects.update_tags(pining, 'bar clash', u2)
+Traceback (most recent call last):
+    ...
+IntegrityError: The tag "clash" could not be created or found.
+>>> Tag.objects.get_for_object_owner(pining, u2)
+[<Tag: bar>, <Tag: zip>]
+>>> clash.delete()
+
+###########
+# Merging #
+###########
+
+>>> link = Link.objects.create(name='python.org')
+>>> Tag.objects.update_tags(link, 'js python', u1)
+>>> Tag.objects.update_tags(link, 'javascript', u2)
+>>> Tag.objects.update_tags(pining, 'js ecmascript', u3)
+>>> progress = []
+>>> Tag.objects.merge('js ecmascript', 'javascript', progress=lambda done, total: progress.append((done, total)))
+<Tag: javascript>
+>>> Tag.objects.get_for_object(link)
+[<Tag: javascript>, <Tag: python>]
+>>> Tag.objects.get_for_object_owner(link, u1)
+[<Tag: javascript>, <Tag: python>]
+>>> Tag.objects.get_for_object_owner(pining, u3)
+[<Tag: javascript>]
+>>> TaggedItem.objects.get(tag__name='javascript', content_type=ContentType.objects.get_for_model(Link),
+...                        object_id=link.pk).owners.count()
+2
+>>> sorted(progress)
+[(1, 2), (2, 2)]
+>>> get_tag_list('js ecmascript')
+[]
+
+>>> Tag.objects.rename('python', 'Python')
+<Tag: Python>
+>>> Tag.objects.rename('Python', 'javascript')
+<Tag: javascript>
+>>> Tag.objects.get_for_object(link)
+[<Tag: javascript>]
+
+############
+# TagField #
+############
+
+>>> from django.conf import settings as django_settings
+>>> from django.db import connection, reset_queries
+>>> from tagging.context import tagging_owner
+>>> with tagging_owner(u1):
+...     note = Note.objects.create(text='groceries', tags='milk eggs')
+>>> Tag.objects.get_for_object_owner(note, u1)
+[<Tag: eggs>, <Tag: milk>]
+>>> Note.objects.get(pk=note.pk).tags
+u'milk eggs'
+
+# Tags are not written without an owner...
+>>> note.tags = 'milk bread'
+>>> note.save()
+Traceback (most recent call last):
+    ...
+AttributeError: Saving changed tags requires an owner; use tagging_owner().
+
+# ...or when the set of tags hasn't changed
+>>> Note.objects.create(text='empty').tags
+''
+>>> django_settings.DEBUG = True
+>>> reset_queries()
+>>> for note in Note.objects.all():
+...     note.text = note.text.upper()
+...     note.tags = note.tags.replace('milk eggs', 'eggs Milk')
+...     note.save()
+>>> [query for query in connection.queries if 'tagging_' in query['sql']]
+[]
+>>> django_settings.DEBUG = False
+
+>>> note = Note.objects.get(text='GROCERIES')
+>>> with tagging_owner(u2):
+...     note.tags = 'milk, bread'
+...     note.save()
+>>> Tag.objects.get_for_object_owner(note, u2)
+[<Tag: bread>, <Tag: milk>]
+
+# Rows without a stored string look their tags up on first access
+>>> Note.objects.filter(pk=note.pk).update(tags=None)
+1
+>>> Note.objects.get(pk=note.pk).tags
+u'bread eggs milk'
+
+#################
+# TagDescriptor #
+#################
+
+>>> one = Article.objects.create(name='one')
+>>> two = Article.objects.create(name='two')
+>>> one.tags = 'python'
+Traceback (most recent call last):
+    ...
+AttributeError: Assigning tags requires an owner; use tagging_owner().
+>>> with tagging_owner(u1):
+...     one.tags = 'python'
+...     two.tags = 'python'
+...     one.tags = 'python django'
+>>> one.tags
+[<Tag: django>, <Tag: python>]
+>>> with tagging_owner(u2):
+...     two.tags = 'django'
+>>> with tagging_owner(u1):
+...     del two.tags
+>>> Tag.objects.get_for_object_owner(two, u1)
+[]
+
+# Prefetched tags are used without further queries
+>>> articles = Tag.objects.prefetch_tags(Article.objects.all())
+>>> django_settings.DEBUG = True
+>>> reset_queries()
+>>> [article.tags for article in articles]
+[[<Tag: django>, <Tag: python>], [<Tag: django>]]
+>>> len(connection.queries)
+0
+>>> django_settings.DEBUG = False
+
+# Tags of objects of several models at once
+>>> def key(obj):
+...     return (ContentType.objects.get_for_model(obj).pk, obj.pk)
+>>> tags = Tag.objects.get_for_objects([one, link, alive, pining])
+>>> [tags[key(obj)] for obj in (alive, pining, link, one)]
+[[<Tag: bar>, <Tag: ololo>, <Tag: rar>, <Tag: xxx>, <Tag: zip>, <Tag: zip2>], [<Tag: bar>, <Tag: javascript>, <Tag: zip>], [<Tag: javascript>], [<Tag: django>, <Tag: python>]]
+>>> tags = Tag.objects.get_for_objects([one, alive], owner_mark=u2, popular=True)
+>>> [[(tag.name, bool(tag.is_own)) for tag in tags[key(obj)]] for obj in (alive, one)]
+[[(u'bar', False), (u'rar', False), (u'zip', True)], []]
+
+########
+# Feed #
+########
+
+>>> gone = Link.objects.create(name='gone')
+>>> Tag.objects.add_tag(gone, 'python', u1)
+>>> gone.delete()
+>>> [obj for item, obj in TaggedItem.objects.feed('javascript python', page_size=1)]
+[<Link: python.org>, <Parrot: pining>, <Article: one>]
+>>> [obj for item, obj in TaggedItem.objects.feed('javascript python', owner=u3)]
+[<Parrot: pining>]
+>>> first = TaggedItem.objects.feed('javascript python').next()[0]
+>>> [obj for item, obj in TaggedItem.objects.feed('javascript python', since=first.pk,
+...                                               hints={'article': {'only': ['name']}})]
+[<Parrot: pining>, <Article: one>]
+
+######################
+# Garbage collection #
+######################
+
+>>> from tagging import cleanup
+>>> Tag.objects.add_tag(alive, 'lonely', u1)
+>>> TaggedItem.objects.get(tag__name='lonely').owners.clear()
+>>> Tag.objects.create(name='unused')
+<Tag: unused>
+>>> result = cleanup.collect_garbage(batch_size=1)
+>>> [(name, result[name]) for name in sorted(result)]
+[('expired_buckets', 0), ('orphaned_items', 1), ('ownerless_items', 1), ('stale_tag_owners', 1), ('unused_tags', 7)]
+>>> get_tag_list('unused lonely ter')
+[]
+
+>>> cleanup.register(Link)
+>>> doomed = Link.objects.create(name='doomed')
+>>> Tag.objects.add_tag(doomed, 'python', u1)
+>>> ctype = ContentType.objects.get_for_model(Link)
+>>> TaggedItem.objects.filter(content_type=ctype, object_id=doomed.pk).count()
+1
+>>> doomed.delete()
+>>> TaggedItem.objects.filter(content_type=ctype, object_id=doomed.pk).count()
+0
+
+####################
+# Non-blocking API #
+####################
+
+>>> from tagging import executor
+>>> executor.gather([executor.submit(len, 'ab'), executor.submit(len, 'abc')]).result()
+[2, 3]
+>>> executor.gather([]).result()
+[]
+
+#########################
+# Template tag caching #
+#########################
+
+>>> cached = Template('{% load tagging_tags %}{% tags_for_object obj as tags cache 60 %}'
+...                   '{% for tag in tags %}{{ tag.name }}{% if tag.popular %}*{% endif %} {% endfor %}')
+>>> cached.render(Context({'obj': alive}))
+u'bar* ololo rar* xxx zip* zip2 '
+>>> django_settings.DEBUG = True
+>>> reset_queries()
+>>> cached.render(Context({'obj': alive}))
+u'bar* ololo rar* xxx zip* zip2 '
+>>> len(connection.queries)
+0
+>>> django_settings.DEBUG = False
+
+A write to the object's tags changes the key.
+
+>>> Tag.objects.add_tag(alive, 'fresh', u1)
+>>> cached.render(Context({'obj': alive}))
+u'bar* fresh ololo rar* xxx zip* zip2 '
+
+The tags are ``Tag`` instances, cached or not, unless
+``TAGGING_TEMPLATE_RECORDS`` is on.
+
+>>> context = Context({'obj': alive})
+>>> for source in ('{% tags_for_object obj as tags %}', '{% tags_for_object obj as tags cache 60 %}'):
+...     rendered = Template('{% load tagging_tags %}' + source).render(context)
+...     context['tags'][0], context['tags'][0].popular
+(<Tag: bar>, True)
+(<Tag: bar>, True)
+>>> tagging_settings.TAGGING_TEMPLATE_RECORDS = True
+>>> for source in ('{% tags_for_object obj as tags %}', '{% tags_for_object obj as tags cache 60 %}'):
+...     rendered = Template('{% load tagging_tags %}' + source).render(context)
+...     context['tags'][0], context['tags'][0].popular
+(<TagRecord: bar>, True)
+(<TagRecord: bar>, True)
+>>> tagging_settings.TAGGING_TEMPLATE_RECORDS = False
+
+>>> Template('{% load tagging_tags %}{% tags_for_model tests.Parrot as tags with counts cache 60 %}'
+...          '{% for tag in tags %}{{ tag.name }}:{{ tag.count }} {% endfor %}').render(Context())
+u'bar:3 bar2:1 fresh:1 javascript:1 ololo:1 rar:1 rar2:1 xxx:1 xxxx:1 zip:3 zip2:2 '
+>>> tagged = Template('{% load tagging_tags %}{% tagged_objects tag in tests.Parrot as parrots cache 60 %}'
+...                   '{{ parrots|join:" " }}')
+>>> tagged.render(Context({'tag': Tag.objects.get(name='zip2')}))
+u'alive dead'
+>>> Tag.objects.update_tags(dead, 'bar2', u3)
+>>> tagged.render(Context({'tag': Tag.objects.get(name='zip2')}))
+u'alive dead'
+>>> Tag.objects.update_tags(dead, 'bar2', u1)
+>>> Tag.objects.update_tags(dead, 'bar2', u4)
+>>> tagged.render(Context({'tag': Tag.objects.get(name='zip2')}))
+u'alive'
+>>> tagged.render(Context({'tag': 'zip2'}))
+u'alive'
+>>> tagged.render(Context({'tag': ['zip', 'bar']}))
+u'alive pining'
+
+>>> Template('{% load tagging_tags %}{% tags_for_object obj as tags cache %}')
+Traceback (most recent call last):
+...
+TemplateSyntaxError: tags_for_object tag was given an incomplete clause
+
+############
+# Trending #
+############
+
+>>> from tagging import trending
+>>> from tagging.models import TrendBucket
+>>> TrendBucket.objects.all().delete()
+>>> hot = Link.objects.create(name='hot')
+>>> Tag.objects.update_tags(hot, 'fire smoke', u1)
+>>> Tag.objects.update_tags(hot, 'fire smoke', u1)
+>>> Tag.objects.add_tag(hot, 'fire', u2)
+>>> [(tag.name, tag.score) for tag in Tag.objects.trending(Link, 3600)]
+[(u'fire', 2.0), (u'smoke', 1.0)]
+>>> TaggedItem.objects.get(tag__name='fire', content_type=ContentType.objects.get_for_model(Link),
+...                        object_id=hot.pk).created is not None
+True
+
+Older buckets count for less, and drop out of the window.
+
+>>> old = trending.bucket_for() - 3600 // tagging_settings.TAGGING_TREND_BUCKET_SECONDS
+>>> trending.add({(ContentType.objects.get_for_model(Link).pk, Tag.objects.get(name='smoke').pk, old): 4})
+>>> [(tag.name, round(tag.score, 6)) for tag in Tag.objects.trending(Link, 2 * 3600, half_life=3600)]
+[(u'smoke', 3.0), (u'fire', 2.0)]
+>>> [(tag.name, tag.score) for tag in Tag.objects.trending(Link, 1800, limit=1)]
+[(u'fire', 2.0)]
+
+Owner links record when they were made, so ``owners`` has no ``add``
+or ``remove``; items have ``add_owner`` and ``remove_owner`` instead.
+
+>>> owned = Link.objects.create(name='owned')
+>>> Tag.objects.add_tag(owned, 'held', u1)
+>>> item = TaggedItem.objects.get(content_type=ContentType.objects.get_for_model(Link),
+...                               object_id=owned.pk)
+>>> item.owners.add(u2)
+Traceback (most recent call last):
+...
+AttributeError: 'ManyRelatedManager' object has no attribute 'add'
+>>> item.add_owner(u2)
+>>> sorted(item.owners.values_list('pk', flat=True)) == sorted([u1.pk, u2.pk])
+True
+>>> Tag.objects.get_for_object_owner(owned, u2)
+[<Tag: held>]
+>>> item.remove_owner(u1)
+>>> list(item.owners.values_list('pk', flat=True)) == [u2.pk]
+True
+>>> item.remove_owner(u2)
+>>> TaggedItem.objects.filter(pk=item.pk).count()
+0
+>>> owned.delete()
+
+###################
+# Similar objects #
+###################
+
+>>> from tagging import similarity
+>>> similarity.register(Parrot)
+>>> p1 = Parrot.objects.create(state='similar 1')
+>>> p2 = Parrot.objects.create(state='similar 2')
+>>> p3 = Parrot.objects.create(state='similar 3')
+>>> p4 = Parrot.objects.create(state='similar 4')
+>>> Tag.objects.update_tags(p1, 'sim-a sim-b sim-c sim-d', u1)
+>>> Tag.objects.update_tags(p2, 'sim-a sim-b sim-c sim-d', u1)
+>>> Tag.objects.update_tags(p3, 'sim-a sim-b sim-c sim-d sim-e', u1)
+>>> Tag.objects.update_tags(p4, 'sim-x sim-y', u1)
+>>> similar = [(parrot.state, parrot.similarity) for parrot in Parrot.objects.similar_to(p1)]
+>>> [state for state, estimate in similar], similar[0][1]
+([u'similar 2', u'similar 3'], 1.0)
+
+The estimate for ``p3`` depends on the ids of the tags, but is within
+four standard errors of the exact similarity, 4/5.
+
+>>> import math
+>>> size = tagging_settings.TAGGING_MINHASH_BANDS * tagging_settings.TAGGING_MINHASH_ROWS
+>>> abs(similar[1][1] - 0.8) <= 4 * math.sqrt(0.8 * 0.2 / size)
+True
+>>> [parrot.state for parrot in Parrot.objects.similar_to(p1, 1)]
+[u'similar 2']
+
+Signatures follow the tags of their objects.
+
+>>> Tag.objects.update_tags(p2, 'sim-x sim-y', u1)
+>>> [parrot.state for parrot in Parrot.objects.similar_to(p4)]
+[u'similar 2']
+>>> Tag.objects.update_tags(p4, '', u1)
+>>> Parrot.objects.similar_to(p4)
+[]
+>>> similarity.rebuild(Parrot) >= 3
+True
+>>> similarity._registry.clear()
+
+##########
+# Facets #
+##########
+
+>>> f1 = Link.objects.create(name='facet 1')
+>>> f2 = Link.objects.create(name='facet 2')
+>>> f3 = Link.objects.create(name='facet 3')
+>>> Tag.objects.update_tags(f1, 'fa fb fc', u1)
+>>> Tag.objects.update_tags(f2, 'fa fb fd', u1)
+>>> Tag.objects.update_tags(f3, 'fa fc', u2)
+>>> [(tag.name, count) for tag, count in TaggedItem.objects.facets(Link, 'fa fb')]
+[(u'fc', 1), (u'fd', 1)]
+>>> [(tag.name, count) for tag, count in TaggedItem.objects.facets(Link, 'fa', limit=1)]
+[(u'fb', 2)]
+>>> [(tag.name, count) for tag, count in TaggedItem.objects.facets(Link, 'fa', owner=u2)]
+[(u'fc', 1)]
+
+A selected tag which doesn't exist matches nothing.
+
+>>> TaggedItem.objects.facets(Link, ['nonexistent'])
+[]
+>>> TaggedItem.objects.facets(Link, 'fa nonexistent')
+[]
+
+Counts are cached until the tags of the model change.
+
+>>> Tag.objects.add_tag(f3, 'fb', u2)
+>>> [(tag.name, count) for tag, count in TaggedItem.objects.facets(Link, 'fa', limit=1)]
+[(u'fb', 3)]
+
+###########
+# Records #
+###########
+
+>>> records = Tag.objects.get_for_object(alive, u2, records=True)
+>>> [(tag.name, tag.popular, tag.is_own) for tag in records]
+[(u'bar', True, False), (u'fresh', False, False), (u'ololo', False, True), (u'rar', True, False), (u'xxx', False, True), (u'zip', True, True), (u'zip2', False, False)]
+>>> records[0]
+<TagRecord: bar>
+>>> records[0].pk == Tag.objects.get(name='bar').pk
+True
+>>> Tag.objects.get_for_object(alive, None, items__popular=True, top=2, records=True)
+[<TagRecord: zip>, <TagRecord: bar>]
+>>> [tag.name for tag in Tag.objects.get_for_object_owner(alive, u2, records=True)]
+[u'ololo', u'xxx', u'zip']
+>>> cloud = calculate_cloud(Tag.objects.usage_for_model(Parrot, counts=True, records=True), steps=2)
+>>> [(tag.name, tag.count, tag.font_size) for tag in cloud if tag.name in ('bar', 'zip2', 'xxx')]
+[(u'bar', 2, 1), (u'xxx', 1, 1), (u'zip2', 1, 1)]
+>>> records[0].name = 'baz'
+>>> records[0].slug = 'baz'
+Traceback (most recent call last):
+    ...
+AttributeError: 'TagRecord' object has no attribute 'slug'
+
+#########
+# Admin #
+#########
+
+>>> from django.contrib.admin.sites import AdminSite
+>>> from tagging.admin import TagAdmin, TaggedItemAdmin
+>>> tag = TagAdmin(Tag, AdminSite()).queryset(None).get(name='fa')
+>>> (tag.item_count, tag.owner_count)
+(3, 2)
+>>> item = TaggedItemAdmin(TaggedItem, AdminSite()).queryset(None).get(
+...     tag=tag, content_type=ContentType.objects.get_for_model(f3), object_id=f3.pk)
+>>> item.owner_count
+1
+
+Deleting tags removes their items and refreshes the objects they were on.
+
+>>> from tagging.cleanup import delete_tags
+>>> delete_tags('fa fb')
+6
+>>> Tag.objects.filter(name__in=['fa', 'fb']).count()
+0
+>>> [tag.name for tag in Tag.objects.get_for_object(f1)]
+[u'fc']
+
+##########
+# Outbox #
+##########
+
+>>> from tagging import outbox
+>>> last = outbox.read(after=0, limit=100000)[-1].seq
+>>> box = Link.objects.create(name='outbox')
+>>> Tag.objects.add_tag(box, 'ob1', u1)
+>>> Tag.objects.add_tag(box, 'ob1', u2)
+>>> Tag.objects.add_tag(box, 'ob2', u1)
+>>> Tag.objects.update_tags(box, 'ob2', u1)
+>>> Tag.objects.update_tags(box, 'ob2', u2)
+>>> Tag.objects.merge(['ob2'], Tag.objects.create(name='ob3'))
+<Tag: ob3>
+>>> names = dict(Tag.objects.values_list('pk', 'name'))
+>>> users = {u1.pk: 'u1', u2.pk: 'u2', None: None}
+>>> events = outbox.read(after=last)
+>>> [(event.get_op_display(), names.get(event.tag_id, 'gone'), users[event.owner_id]) for event in events]
+[(u'add', u'ob1', 'u1'), (u'add', u'ob1', 'u2'), (u'add', 'gone', 'u1'), (u'remove', u'ob1', 'u1'), (u'remove', u'ob1', 'u2'), (u'delete', u'ob1', None), (u'add', 'gone', 'u2'), (u'add', u'ob3', None), (u'delete', 'gone', None)]
+>>> set([(event.content_type_id, event.object_id) for event in events]) == set([(ContentType.objects.get_for_model(Link).pk, box.pk)])
+True
+>>> outbox.read(after=events[-1].seq)
+[]
+>>> outbox.compact(before=events[-2].seq) > len(events)
+True
+>>> [event.seq for event in outbox.read()] == [events[-1].seq]
+True
+
+###################
+# Export / import #
+###################
+
+>>> from StringIO import StringIO
+>>> from tagging import transfer
+>>> dump = StringIO()
+>>> counts = transfer.export(dump, batch_size=7)
+>>> counts == (Tag.objects.count(), TaggedItem.objects.count())
+True
+>>> lines = dump.getvalue().splitlines()
+>>> '{"name":"bar","type":"tag"}' in lines
+True
+>>> from django.utils import simplejson
+>>> record = simplejson.loads([line for line in lines if '"item"' in line and '"python"' in line][0])
+>>> (record['content_type'], record['object_id'], [owner for owner, created in record['owners']]) == \
+...     (u'tests.article', one.pk, [u1.pk])
+True
+
+Loading into a database without the tags recreates them, with the
+owners and popularity.
+
+>>> before = sorted([(tag.name, tag.popular) for tag in Tag.objects.get_for_object(alive)])
+>>> TaggedItem.objects.all().delete()
+>>> Tag.objects.all().delete()
+>>> last = outbox.read(after=0, limit=100000)[-1].seq
+>>> transfer.load(StringIO(dump.getvalue()), batch_size=7) == counts
+True
+
+The owner links loaded are in the outbox.
+
+>>> names = dict(Tag.objects.values_list('pk', 'name'))
+>>> sorted([names[event.tag_id] for event in outbox.read(after=last, limit=100000) \
+...         if event.op == outbox.ADD and event.owner_id == u2.pk and event.object_id == alive.pk \
+...         and event.content_type_id == ContentType.objects.get_for_model(Parrot).pk])
+[u'ololo', u'xxx', u'zip']
+>>> sorted([(tag.name, tag.popular) for tag in Tag.objects.get_for_object(alive)]) == before
+True
+>>> [tag.name for tag in Tag.objects.get_for_object_owner(alive, u2)]
+[u'ololo', u'xxx', u'zip']
+
+###########
+# Rebuild #
+###########
+
+>>> from tagging import rebuild
+>>> rebuild.run(chunk_size=2, dry_run=True)
+(0, 0)
+>>> alive_items = TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Parrot),
+...                                         object_id=alive.pk)
+>>> alive_items.filter(tag__name='zip').update(popular=False, score=0)
+1
+>>> rebuild.run(chunk_size=2, dry_run=True)
+(1, 1)
+>>> Tag.objects.get_for_object(alive, None, items__popular=True)
+[<Tag: bar>, <Tag: rar>]
+
+Chunks recorded in the state file are skipped when run again.
+
+>>> import os, tempfile
+>>> state = os.path.join(tempfile.mkdtemp(), 'rebuild.json')
+>>> rebuild.run(chunk_size=2, state=state)
+(1, 1)
+>>> Tag.objects.get_for_object(alive, None, items__popular=True)
+[<Tag: bar>, <Tag: rar>, <Tag: zip>]
+>>> alive_items.filter(tag__name='zip').update(popular=False)
+1
+>>> rebuild.run(chunk_size=2, state=state)
+(0, 0)
+>>> os.remove(state)
+>>> rebuild.run(chunk_size=2, state=state)
+(1, 0)
+
+Chunks span a number of tagged objects, however sparse their ids.
+
+>>> parrot_type = ContentType.objects.get_for_model(Parrot).pk
+>>> far = Parrot.objects.create(pk=2000000000, state='far away')
+>>> Tag.objects.add_tag(far, 'zip', u1)
+>>> parrot_chunks = [chunk for chunk in rebuild.plan(chunk_size=2) if chunk[0] == parrot_type]
+>>> len(parrot_chunks) == (TaggedItem.objects.filter(content_type=parrot_type) \
+...                        .values('object_id').distinct().count() + 1) // 2
+True
+>>> parrot_chunks[-1][2]
+2000000001
+
+The state file gets a line per chunk done, and resuming skips the
+objects of those chunks, even with new objects among them.
+
+>>> len(open(state).readlines()) == len(rebuild._load_state(state))
+True
+>>> [chunk for chunk in rebuild.plan(2, rebuild._load_state(state)) \
+...  if chunk[0] == parrot_type] == [(parrot_type, 2000000000, 2000000001)]
+True
+>>> changes = rebuild.run(chunk_size=2, state=state)
+>>> [chunk for chunk in rebuild.plan(2, rebuild._load_state(state)) if chunk[0] == parrot_type]
+[]
+>>> os.remove(state)
+
+##############
+# Membership #
+##############
+
+>>> from tagging import membership
+>>> membership.activate(u2)
+>>> [(tag.name, tag.is_own) for tag in Tag.objects.get_for_object(alive, u2)]
+[(u'bar', False), (u'fresh', False), (u'ololo', True), (u'rar', False), (u'xxx', True), (u'zip', True), (u'zip2', False)]
+
+Once loaded, the owner's items are marked without querying them again.
+
+>>> django_settings.DEBUG = True
+>>> reset_queries()
+>>> [(tag.name, tag.is_own) for tag in Tag.objects.get_for_object(alive, u2, records=True)][2:5]
+[(u'ololo', True), (u'rar', False), (u'xxx', True)]
+>>> [query['sql'] for query in connection.queries if 'tagging_taggeditem_owners' in query['sql']]
+[]
+>>> django_settings.DEBUG = False
+>>> [[(tag.name, tag.is_own) for tag in tags] for tags in Tag.objects.get_for_objects([alive], u2).values()][0][-2:]
+[(u'zip', True), (u'zip2', False)]
+
+Tagging as the owner drops what was loaded.
+
+>>> Tag.objects.add_tag(alive, 'fresh', u2)
+>>> [tag.name for tag in Tag.objects.get_for_object(alive, u2) if tag.is_own]
+[u'fresh', u'ololo', u'xxx', u'zip']
+
+Past the cap, ``is_own`` is computed in SQL.
+
+>>> membership.activate(u2)
+>>> membership._state.membership.cap = 1
+>>> membership.lookup(u2, ContentType.objects.get_for_model(Parrot).pk) is None
+True
+>>> [tag.name for tag in Tag.objects.get_for_object(alive, u2) if tag.is_own]
+[u'fresh', u'ololo', u'xxx', u'zip']
+>>> membership.deactivate()
+
+#############
+# Load test #
+#############
+
+>>> import random
+>>> from tagging import loadtest
+>>> zipf, rng = loadtest.Zipf(10), random.Random(0)
+>>> draws = [zipf.draw(rng) for i in range(1000)]
+>>> draws.count(0) > draws.count(1) > draws.count(9) > 0
+True
+>>> workload = loadtest.Workload(Parrot, [alive.pk], ['loadtest1', 'loadtest2'], [u2.pk])
+>>> stats, elapsed = loadtest.run(workload, workers=1, duration=None, operations=30, seed=1)
+>>> summary = loadtest.summarize(stats, elapsed)
+>>> sum([row['count'] for row in summary.values()])
+30
+>>> sorted(summary['get_for_object'])
+['count', 'errors', 'p50', 'p95', 'p99', 'retries', 'throughput']
+>>> summary['get_for_object']['p50'] <= summary['get_for_object']['p99']
+True
+>>> loadtest.percentile([1, 2, 3, 4], 50), loadtest.percentile([1, 2, 3, 4], 99)
+(2, 4)
+
+##################
+# Owner sketches #
+##################
+
+>>> from tagging import sketches
+>>> from tagging.models import OwnerSketch
+>>> sketches.standard_error()
+0.0325
+>>> def within_error(estimate, exact):
+...     return abs(estimate - exact) <= 3 * sketches.standard_error() * exact
+>>> big = sketches.HyperLogLog()
+>>> changed = [big.add(i) for i in range(20000)]
+>>> within_error(big.count(), 20000)
+True
+>>> other = sketches.HyperLogLog()
+>>> changed = [other.add(i) for i in range(10000, 30000)]
+>>> big.update(other)
+True
+>>> within_error(big.count(), 30000)
+True
+>>> small = sketches.HyperLogLog()
+>>> changed = [small.add(i) for i in range(100)]
+>>> abs(small.count() - 100) <= 2
+True
+>>> len(small.encode()) < 600, sketches.HyperLogLog.decode(small.encode()).registers == small.registers
+(True, True)
+
+Sketches of the existing owners are built from the owner tables, and
+kept up to date by the write paths when enabled.
+
+>>> tagging_settings.TAGGING_OWNER_SKETCHES = True
+>>> sketches.rebuild(batch_size=5) > 0
+True
+>>> exact = Tag.objects.owner_counts()
+>>> approximate = Tag.objects.owner_counts(approximate=True)
+>>> sorted(approximate) == sorted(exact), [within_error(approximate[k], exact[k]) for k in exact].count(False)
+(True, 0)
+>>> for i in range(300):
+...     Tag.objects.add_tag(alive, 'crowd', User.objects.create(username='crowd%d' % i))
+>>> crowd = Tag.objects.get(name='crowd')
+>>> Tag.objects.owner_counts(Parrot, 'crowd')[crowd.pk]
+300
+>>> within_error(Tag.objects.owner_counts(Parrot, 'crowd', approximate=True)[crowd.pk], 300)
+True
+>>> within_error(Tag.objects.owner_counts(tags=[crowd], approximate=True)[crowd.pk], 300)
+True
+>>> cloud = Tag.objects.usage_for_model(Parrot, counts=True, owners=True, approximate=True)
+>>> [within_error(tag.count, 300) for tag in cloud if tag.name == 'crowd']
+[True]
+
+Merged tags merge their sketches.
+
+>>> Tag.objects.add_tag(alive, 'throng', u1)
+>>> Tag.objects.merge(['crowd'], Tag.objects.get(name='throng'))
+<Tag: throng>
+>>> throng = Tag.objects.get(name='throng')
+>>> Tag.objects.owner_counts(Parrot, [throng])[throng.pk]
+301
+>>> within_error(Tag.objects.owner_counts(Parrot, [throng], approximate=True)[throng.pk], 301)
+True
+>>> OwnerSketch.objects.filter(tag__name='crowd').count()
+0
+>>> tagging_settings.TAGGING_OWNER_SKETCHES = False
+
 """
 
+import sys
+import threading
+import time
+
+from django.conf import settings as django_settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.db import connection, router as db_router
+from django.db.models import get_app, get_models
+from django.test import TestCase, TransactionTestCase
+
+from tagging import db, outbox, routers, settings as tagging_settings, shards
+from tagging.cleanup import collect_garbage
+from tagging.models import Tag, TaggedItem
+from tagging.tests.models import Link, Parrot
+from tagging.utils import get_tag_list
+
+def delete_committed(objects, databases=('default',)):
+    """
+    Deletes ``objects`` and every tagging row of ``databases``, which
+    the transaction test cases commit, so that the tests after them on
+    the same database don't see them.
+    """
+    for obj in objects:
+        obj.delete()
+    for using in databases:
+        for model in get_models(get_app('tagging')):
+            model._default_manager.using(using).all().delete()
+
+class ConcurrentTaggingTest(TransactionTestCase):
+    """
+    Tags the same objects from several threads at once and checks that
+    no tagging is lost. Threads need a database they can share, so this
+    is skipped on in-memory SQLite.
+    """
+    threads = 8
+    rounds = 10
+    max_latency = 5.0
+
+    def setUp(self):
+        if connection.settings_dict['NAME'] in ('', ':memory:'):
+            self.skipTest('concurrent tagging needs a shared database')
+        self.created = []
+
+    def tearDown(self):
+        delete_committed(self.created)
+
+    def test_no_lost_taggings(self):
+        parrot = Parrot.objects.create(state='busy')
+        other = Parrot.objects.create(state='busier')
+        users = [User.objects.create(username='worker%d' % i) for i in range(self.threads)]
+        self.created.extend([parrot, other] + users)
+        errors, latencies = [], []
+
+        def work(user):
+            try:
+                for i in range(self.rounds):
+                    start = time.time()
+                    Tag.objects.add_tag(parrot, 'shared%d' % (i % 3), user)
+                    Tag.objects.update_tags(other, 'common own%d' % i, user)
+                    latencies.append(time.time() - start)
+            except Exception:
+                errors.append(sys.exc_info()[1])
+            connection.close()
+
+        workers = [threading.Thread(target=work, args=(user,)) for user in users]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        self.assertEqual(errors, [])
+        for user in users:
+            self.assertEqual([t.name for t in Tag.objects.get_for_object_owner(parrot, user)],
+                             [u'shared0', u'shared1', u'shared2'])
+            self.assertEqual([t.name for t in Tag.objects.get_for_object_owner(other, user)],
+                             [u'common', u'own%d' % (self.rounds - 1)])
+        self.assert_(max(latencies) < self.max_latency)
+
+class NonBlockingApiTest(TransactionTestCase):
+    """
+    Checks the futures of the non-blocking manager methods resolve to
+    what the blocking ones return. Pool threads need a database they
+    can share, so this is skipped on in-memory SQLite.
+    """
+    def setUp(self):
+        if connection.settings_dict['NAME'] in ('', ':memory:'):
+            self.skipTest('the thread pool needs a shared database')
+        self.first = Link.objects.create(name='first')
+        self.second = Link.objects.create(name='second')
+        self.owner = User.objects.create(username='async')
+
+    def tearDown(self):
+        delete_committed([self.first, self.second, self.owner])
+
+    def names(self, tags):
+        return [(tag.name, bool(getattr(tag, 'is_own', False))) for tag in tags]
+
+    def test_futures_match_blocking_calls(self):
+        self.assertEqual(Tag.objects.aupdate_tags(self.first, 'one two', self.owner).result(), None)
+        self.assertEqual(Tag.objects.aadd_tag(self.second, 'two', self.owner).result(), None)
+        self.assertEqual([tag.name for tag in Tag.objects.get_for_object(self.first)],
+                         [u'one', u'two'])
+        self.assertEqual([tag.name for tag in Tag.objects.get_for_object(self.second)], [u'two'])
+
+        self.assertEqual(self.names(Tag.objects.aget_for_object(self.first, self.owner).result()),
+                         self.names(Tag.objects.get_for_object(self.first, self.owner)))
+        self.assertEqual([self.names(tags) for tags in \
+                          Tag.objects.aprefetch_tags([self.first, self.second], self.owner).result()],
+                         [self.names(Tag.objects.get_for_object(obj, self.owner)) for \
+                          obj in (self.first, self.second)])
+
+        tags = list(get_tag_list('one two'))
+        self.assertEqual(TaggedItem.objects.amatch_all(Link, tags).result(),
+                         list(TaggedItem.objects.match_all(Link, tags)))
+        # Other links may carry the same tags on a shared database.
+        matched = [link.pk for link in TaggedItem.objects.amatch_all(Link, tags).result()]
+        self.assert_(self.first.pk in matched and self.second.pk not in matched)
+        self.assertEqual(sorted([link.pk for link in TaggedItem.objects.amatch_any(Link, tags).result()]),
+                         sorted([link.pk for link in TaggedItem.objects.match_any(Link, tags)]))
+        matched = [link.pk for link in TaggedItem.objects.amatch_any(Link, tags).result()]
+        self.assert_(self.first.pk in matched and self.second.pk in matched)
+
+class IndexUsageTest(TestCase):
+    """
+    Checks the query plans of the hot tagging queries use the indexes
+    from ``tagging.indexes`` rather than scanning the table.
+    """
+    def setUp(self):
+        self.vendor = db.get_vendor()
+        if self.vendor not in ('sqlite', 'postgresql'):
+            self.skipTest('no EXPLAIN parser for %s' % self.vendor)
+        self.cursor = connection.cursor()
+        if self.vendor == 'postgresql':
+            # The test tables are tiny; make the planner show its hand.
+            self.cursor.execute('SET enable_seqscan = off')
+        self.ctype = ContentType.objects.get_for_model(Parrot)
+
+    def tearDown(self):
+        if self.vendor == 'postgresql':
+            self.cursor.execute('SET enable_seqscan = on')
+
+    def assertUsesIndex(self, index, sql, params):
+        if self.vendor == 'sqlite':
+            self.cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            lines = [row[-1] for row in self.cursor.fetchall()]
+            plan = '\n'.join(lines)
+            self.failIf([line for line in lines if 'INDEX' not in line], plan)
+        else:
+            self.cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join([row[0] for row in self.cursor.fetchall()])
+            self.assert_('Index' in plan, plan)
+        self.assert_(index in plan, plan)
+
+    def assertQuerySetUsesIndex(self, index, queryset):
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+        self.assertUsesIndex(index, sql, params)
+
+    def test_items_for_object(self):
+        self.assertQuerySetUsesIndex('tagging_taggeditem_object', TaggedItem.objects.filter(
+            content_type=self.ctype, object_id=1).values_list('tag', 'popular'))
+
+    def test_popular_items_for_tag(self):
+        self.assertQuerySetUsesIndex('tagging_taggeditem_popular', TaggedItem.objects.filter(
+            content_type=self.ctype, tag=1, popular=True).values_list('object_id', flat=True))
+
+    def test_items_owned_by_user(self):
+        table, item_column, owner_column = db.m2m_table(TaggedItem, 'owners')
+        qn = connection.ops.quote_name
+        self.assertUsesIndex('tagging_taggeditem_owners_owner', 'SELECT %s FROM %s WHERE %s = %%s' % (
+            qn(item_column), qn(table), qn(owner_column)), [1])
+
+class ReplicaRoutingTest(TestCase):
+    """
+    Sends tagging reads to a ``replica`` database alias, which must be
+    configured as a database of its own (another SQLite file will do).
+    Since nothing replicates to it, it plays a replica lagging behind.
+    """
+    multi_db = True
+
+    def setUp(self):
+        if 'replica' not in django_settings.DATABASES:
+            self.skipTest('needs a replica database')
+        self.router = routers.TaggingRouter()
+        db_router.routers.insert(0, self.router)
+        self.read_database = tagging_settings.TAGGING_READ_DATABASE
+        tagging_settings.TAGGING_READ_DATABASE = 'replica'
+
+    def tearDown(self):
+        db_router.routers.remove(self.router)
+        tagging_settings.TAGGING_READ_DATABASE = self.read_database
+        routers.set_current_reader(None)
+
+    def test_reads_stick_to_primary_after_own_write(self):
+        writer = User.objects.create(username='writer')
+        reader = User.objects.create(username='reader')
+        parrot = Parrot.objects.create(state='replicated')
+        Tag.objects.add_tag(parrot, 'fresh', writer)
+
+        routers.set_current_reader(reader)
+        self.assertEqual(list(Tag.objects.get_for_object(parrot)), [])
+        routers.set_current_reader(writer)
+        self.assertEqual([tag.name for tag in Tag.objects.get_for_object(parrot)], [u'fresh'])
+        routers.set_current_reader(None)
+        self.assertEqual(list(Tag.objects.get_for_object(parrot)), [])
+
+    def test_write_paths_read_from_primary(self):
+        owner = User.objects.create(username='owner')
+        parrot = Parrot.objects.create(state='rewritten')
+        Tag.objects.update_tags(parrot, 'one two', owner)
+        Tag.objects.update_tags(parrot, 'two three', owner)
+        routers.set_current_reader(owner)
+        self.assertEqual([tag.name for tag in Tag.objects.get_for_object(parrot)],
+                         [u'three', u'two'])
+
+
+class ShardingTest(TestCase):
+    """
+    Keeps the tagged items of ``Parrot`` in a ``shard`` database alias,
+    which must be configured as a database of its own.
+    """
+    multi_db = True
+
+    def setUp(self):
+        if 'shard' not in django_settings.DATABASES:
+            self.skipTest('needs a shard database')
+        shards.register(Parrot, 'shard')
+        self.owner = User.objects.create(username='sharded')
+
+    def tearDown(self):
+        shards.unregister(Parrot)
+        shards.unregister(Link)
+
+    def test_writes_and_reads_go_to_shard(self):
+        parrot = Parrot.objects.create(state='sharded')
+        Tag.objects.update_tags(parrot, 'wing beak', self.owner)
+        self.assertEqual(TaggedItem.objects.using('default').count(), 0)
+        self.assertEqual(TaggedItem.objects.using('shard').count(), 2)
+        self.assertEqual([tag.name for tag in Tag.objects.get_for_object(parrot)],
+                         [u'beak', u'wing'])
+        self.assertEqual(list(Parrot.objects.with_any(Tag.objects.filter(name='wing'))), [parrot])
+
+        Tag.objects.update_tags(parrot, 'wing', self.owner)
+        self.assertEqual([tag.name for tag in Tag.objects.get_for_object(parrot)], [u'wing'])
+        # The default database keeps the tag the shard still uses.
+        deleted = collect_garbage()
+        self.assertEqual(deleted['unused_tags'], 2)
+        self.assertEqual([tag.name for tag in Tag.objects.using('default')], [u'wing'])
+
+    def test_move_items(self):
+        link = Link.objects.create(name='moved')
+        Tag.objects.update_tags(link, 'far away', self.owner)
+        last = outbox.read(after=0, limit=100000, using='shard')
+        last = last and last[-1].seq or 0
+        self.assertEqual(shards.move_items(Link, 'shard', batch_size=1), 2)
+        # The shard's outbox gets the moved owner links.
+        self.assertEqual(sorted([(event.op, event.object_id, event.owner_id) for event in \
+                                 outbox.read(after=last, using='shard')]),
+                         [(outbox.ADD, link.pk, self.owner.pk)] * 2)
+        shards.register(Link, 'shard')
+        self.assertEqual(TaggedItem.objects.using('default').count(), 0)
+        self.assertEqual([tag.name for tag in Tag.objects.get_for_object_owner(link, self.owner)],
+                         [u'away', u'far'])
+
+class ShardCanonicalizeTest(TransactionTestCase):
+    """
+    Runs ``tagging_canonicalize`` with the tagged items of ``Parrot``
+    in a ``shard`` database alias. Merging tags creates a temporary
+    table, which commits on SQLite, so this is a transaction test case.
+    """
+    multi_db = True
+
+    def setUp(self):
+        if 'shard' not in django_settings.DATABASES:
+            self.skipTest('needs a shard database')
+        shards.register(Parrot, 'shard')
+        self.owner = User.objects.create(username='canonical')
+        self.parrot = Parrot.objects.create(state='duplicated')
+
+    def tearDown(self):
+        shards.unregister(Parrot)
+        delete_committed([self.parrot, self.owner], ('default', 'shard'))
 
+    def test_merges_in_shards(self):
+        Tag.objects.update_tags(self.parrot, 'wing fjords', self.owner)
+        for using in ('default', 'shard'):
+            Tag.objects.using(using).filter(name='fjords').update(name='Wing', canonical='stale')
+        call_command('tagging_canonicalize', verbosity=0)
+        self.assertEqual([tag.name for tag in Tag.objects.get_for_object(self.parrot)], [u'wing'])
+        self.assertEqual(TaggedItem.objects.using('shard').count(), 1)
+        for using in ('default', 'shard'):
+            self.assertEqual(Tag.objects.using(using).filter(name='Wing').count(), 0)
@@ -0,0 +1,227 @@
+"""
+Export and import of the whole tagging graph as NDJSON.
+
+``dumpdata`` and ``loaddata`` build an ORM instance for every tag, item
+and owner row, and hold them all in memory. ``export`` writes one JSON
+object per line instead, reading the tables by primary key a batch at a
+time, and ``load`` reads them back a batch at a time with bulk inserts,
+so both run in constant memory whatever the size of the data:
+
+    {"type": "tag", "name": "django"}
+    {"type": "item", "content_type": "blog.entry", "object_id": 42,
+     "tag": "django", "created": "2010-05-01T12:00:00",
+     "owners": [[7, "2010-05-01T12:00:00"]]}
+
+Items refer to their tag by name and to their content type by natural
+key, so both are remapped to the ids of the target database; owners are
+kept by id. Popularity and scores aren't exported: ``load`` recomputes
+them once everything is in.
+"""
+import datetime
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils import simplejson
+
+from tagging import db, outbox, shards, sketches, versions
+from tagging.models import Tag, TaggedItem, TaggedItemOwner
+from tagging.utils import canonicalize_tag_name
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+def _format_datetime(value):
+    if value is None:
+        return None
+    return value.strftime(DATETIME_FORMAT)
+
+def _parse_datetime(value):
+    if value is None:
+        return None
+    return datetime.datetime.strptime(value[:19], DATETIME_FORMAT)
+
+def _write(stream, record):
+    stream.write(simplejson.dumps(record, separators=(',', ':'), sort_keys=True))
+    stream.write('\n')
+
+def _keyset(queryset, fields, batch_size):
+    """
+    Yields the rows of ``queryset.values_list(*fields)`` in batches of
+    ``batch_size``, the first field being the primary key.
+    """
+    last = 0
+    while True:
+        rows = list(queryset.filter(pk__gt=last).order_by('pk').values_list(*fields)[:batch_size])
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+def export(stream, batch_size=1000, progress=None):
+    """
+    Writes every tag, then every tagged item of the default database
+    and the shards with its owners, to ``stream``. If given,
+    ``progress`` is called with the numbers of tags and items written
+    after each batch. Returns those numbers.
+    """
+    tags = items = 0
+    for rows in _keyset(Tag._default_manager.using(DEFAULT_DB_ALIAS), ('pk', 'name'), batch_size):
+        for pk, name in rows:
+            _write(stream, {'type': 'tag', 'name': name})
+        tags += len(rows)
+        if progress is not None:
+            progress(tags, items)
+
+    content_types = {}
+    for using in [DEFAULT_DB_ALIAS] + shards.databases():
+        queryset = TaggedItem._default_manager.using(using)
+        for rows in _keyset(queryset, ('pk', 'tag__name', 'content_type', 'object_id', 'created'),
+                            batch_size):
+            owners = {}
+            for item_id, owner_id, created in TaggedItemOwner._default_manager.using(using) \
+                    .filter(taggeditem__in=[row[0] for row in rows]) \
+                    .values_list('taggeditem', 'owner', 'created'):
+                owners.setdefault(item_id, []).append([owner_id, _format_datetime(created)])
+            for pk, tag_name, content_type_id, object_id, created in rows:
+                if content_type_id not in content_types:
+                    content_types[content_type_id] = '.'.join(
+                        ContentType.objects.get_for_id(content_type_id).natural_key())
+                _write(stream, {'type': 'item', 'content_type': content_types[content_type_id],
+                                'object_id': object_id, 'tag': tag_name,
+                                'created': _format_datetime(created),
+                                'owners': owners.get(pk, [])})
+            items += len(rows)
+            if progress is not None:
+                progress(tags, items)
+    return tags, items
+
+class _Loader(object):
+    """
+    Collects the records read by ``load`` and inserts them a batch at a
+    time.
+    """
+    def __init__(self, batch_size, progress):
+        self.batch_size = batch_size
+        self.progress = progress
+        self.tag_names = []
+        self.items = []
+        self.content_types = {}
+        self.tags = self.loaded_items = 0
+
+    def add(self, record):
+        if record['type'] == 'tag':
+            self.tag_names.append(record['name'])
+            if len(self.tag_names) >= self.batch_size:
+                self.flush_tags()
+        elif record['type'] == 'item':
+            self.items.append(record)
+            if len(self.items) >= self.batch_size:
+                self.flush_items()
+
+    def flush(self):
+        self.flush_tags()
+        self.flush_items()
+
+    def flush_tags(self):
+        if self.tag_names:
+            Tag.objects._get_or_create_tags(self.tag_names)
+            self.tags += len(self.tag_names)
+            self.tag_names = []
+            self.report()
+
+    def content_type(self, natural_key):
+        if natural_key not in self.content_types:
+            app_label, model = natural_key.split('.')
+            self.content_types[natural_key] = \
+                ContentType.objects.get_by_natural_key(app_label, model).pk
+        return self.content_types[natural_key]
+
+    def flush_items(self):
+        if not self.items:
+            return
+        tags = dict([(tag.canonical, tag.pk) for tag in Tag.objects._get_or_create_tags(
+            [record['tag'] for record in self.items])])
+        by_database = {}
+        for record in self.items:
+            content_type_id = self.content_type(record['content_type'])
+            by_database.setdefault(shards.database_for(content_type_id) or DEFAULT_DB_ALIAS, []) \
+                       .append((content_type_id, tags[canonicalize_tag_name(record['tag'])], record))
+        for using, rows in by_database.items():
+            if using != DEFAULT_DB_ALIAS:
+                shards.copy_tags(Tag.objects.filter(pk__in=set([row[1] for row in rows])), using)
+            self.insert_items(rows, using)
+        self.loaded_items += len(self.items)
+        self.items = []
+        self.report()
+
+    def insert_items(self, rows, using):
+        ops = connections[using].ops
+        opts = TaggedItem._meta
+        db.insert_ignore(opts.db_table,
+                         [opts.get_field(name).column for name in \
+                          ('tag', 'content_type', 'object_id', 'popular', 'score', 'created')],
+                         [(tag_id, content_type_id, record['object_id'], False, 0,
+                           ops.value_to_db_datetime(_parse_datetime(record['created']))) \
+                          for content_type_id, tag_id, record in rows],
+                         using=using)
+
+        object_ids, tag_ids = {}, set()
+        for content_type_id, tag_id, record in rows:
+            object_ids.setdefault(content_type_id, set()).add(record['object_id'])
+            tag_ids.add(tag_id)
+        item_ids = {}
+        for content_type_id, ids in object_ids.items():
+            for item_id, object_id, tag_id in TaggedItem._default_manager.using(using) \
+                    .filter(content_type=content_type_id, object_id__in=list(ids),
+                            tag__in=list(tag_ids)).values_list('pk', 'object_id', 'tag'):
+                item_ids[(content_type_id, object_id, tag_id)] = item_id
+
+        item_owners, tag_owners, owners, events = [], set(), [], []
+        for content_type_id, tag_id, record in rows:
+            item_id = item_ids[(content_type_id, record['object_id'], tag_id)]
+            for owner_id, created in record['owners']:
+                item_owners.append((item_id, owner_id,
+                                    ops.value_to_db_datetime(_parse_datetime(created))))
+                tag_owners.add((tag_id, owner_id))
+                owners.append((content_type_id, tag_id, owner_id))
+                events.append((outbox.ADD, content_type_id, record['object_id'], tag_id, owner_id))
+        table, item_column, owner_column = db.m2m_table(TaggedItem, 'owners')
+        db.insert_ignore(table, (item_column, owner_column,
+                                 TaggedItemOwner._meta.get_field('created').column),
+                         item_owners, using=using)
+        table, tag_column, owner_column = db.m2m_table(Tag, 'owners')
+        db.insert_ignore(table, (tag_column, owner_column), tag_owners, using=using)
+        sketches.add(owners, using)
+        outbox.append(events, using)
+
+    def report(self):
+        if self.progress is not None:
+            self.progress(self.tags, self.loaded_items)
+
+def load(stream, batch_size=1000, progress=None):
+    """
+    Reads the records written by ``export`` from ``stream`` and adds
+    them to the tagging data, keeping what is already there. Then
+    recomputes the popularity of every object of the content types
+    loaded. If given, ``progress`` is called with the numbers of tags
+    and items loaded after each batch. Returns those numbers.
+    """
+    loader = _Loader(batch_size, progress)
+    for line in stream:
+        line = line.strip()
+        if line:
+            loader.add(simplejson.loads(line))
+    loader.flush()
+
+    for content_type_id in loader.content_types.values():
+        items = TaggedItem.objects.for_content_type(content_type_id) \
+                                  .filter(content_type=content_type_id)
+        last = 0
+        while True:
+            ids = list(items.filter(object_id__gt=last).order_by('object_id') \
+                            .values_list('object_id', flat=True).distinct()[:batch_size])
+            if not ids:
+                break
+            TaggedItem.refresh_popular_many(content_type_id, ids)
+            last = ids[-1]
+    versions.bump_all()
+    return loader.tags, loader.loaded_items
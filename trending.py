@@ -0,0 +1,89 @@
+"""
+Counters behind ``Tag.objects.trending``.
+
+Every time an owner puts a tag on an object, the count of that tag and
+the object's content type in the current time bucket goes up by one.
+Buckets are ``TAGGING_TREND_BUCKET_SECONDS`` long and kept for
+``TAGGING_TREND_RETENTION`` seconds, so the trends of a content type
+over any window are read from a few rows per tag, however many items
+there are.
+"""
+import math
+import time
+
+from django.db import connections, router, transaction
+
+from tagging import db, settings
+
+def bucket_for(timestamp=None):
+    """
+    Returns the number of the bucket the Unix ``timestamp`` (now unless
+    given) falls in.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    return int(timestamp) // settings.TAGGING_TREND_BUCKET_SECONDS
+
+def count(events, using=None):
+    """
+    Adds one to the current bucket for each ``(content_type_id,
+    tag_id)`` in ``events``.
+    """
+    bucket = bucket_for()
+    counts = {}
+    for content_type_id, tag_id in events:
+        key = (content_type_id, tag_id, bucket)
+        counts[key] = counts.get(key, 0) + 1
+    add(counts, using)
+
+def add(counts, using=None):
+    """
+    Adds to the bucket counts, given as a dict mapping
+    ``(content_type_id, tag_id, bucket)`` to the number to add, creating
+    the missing buckets.
+    """
+    from tagging.models import TrendBucket
+
+    if not counts:
+        return
+    opts = TrendBucket._meta
+    columns = [opts.get_field(name).column for name in ('content_type', 'tag', 'bucket', 'count')]
+    db.insert_ignore(opts.db_table, columns,
+                     [key + (0,) for key in counts], using=using)
+
+    # One statement per content type, bucket and increment.
+    increments = {}
+    for (content_type_id, tag_id, bucket), n in counts.items():
+        increments.setdefault((content_type_id, bucket, n), []).append(tag_id)
+    using = using or router.db_for_write(TrendBucket)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    for (content_type_id, bucket, n), tag_ids in increments.items():
+        cursor.execute('UPDATE %s SET %s = %s + %%s WHERE %s = %%s AND %s = %%s AND %s IN (%s)' % (
+            qn(opts.db_table), qn(columns[3]), qn(columns[3]), qn(columns[0]), qn(columns[2]),
+            qn(columns[1]), ', '.join(['%s'] * len(tag_ids))),
+            [n, content_type_id, bucket] + tag_ids)
+    transaction.commit_unless_managed(using=using)
+
+def scores(content_type, window, half_life=None, using=None):
+    """
+    Returns a dict mapping the ids of the tags put on objects of
+    ``content_type`` during the last ``window`` seconds to their trend
+    score: the sum of their bucket counts, each decayed exponentially
+    with the bucket's age so that it halves every ``half_life`` seconds
+    (half the window unless given).
+    """
+    from tagging.models import TrendBucket
+
+    if half_life is None:
+        half_life = window / 2.0
+    now = bucket_for()
+    first = bucket_for(time.time() - window)
+    rate = math.log(2) * settings.TAGGING_TREND_BUCKET_SECONDS / half_life
+    result = {}
+    for tag_id, bucket, n in TrendBucket._default_manager.db_manager(using) \
+            .filter(content_type=content_type, bucket__gt=first) \
+            .values_list('tag', 'bucket', 'count'):
+        result[tag_id] = result.get(tag_id, 0) + n * math.exp(-rate * (now - bucket))
+    return result
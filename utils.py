@@ -4,6 +4,7 @@ calculation.
 """
 import math
 import types
+import unicodedata
 
 from django.db.models.query import QuerySet
 from django.utils.encoding import force_unicode
@@ -96,6 +97,34 @@ def split_strip(input, delimiter=u','):
     words = [w.strip() for w in input.split(delimiter)]
     return [w for w in words if w]
 
+# The canonical form of a tag name is what lookups and the uniqueness
+# constraint on ``Tag.canonical`` go by.
+CANONICAL_MAX_LENGTH = 255
+CANONICAL_CACHE_SIZE = 10000
+_canonical_cache = {}
+
+def canonicalize_tag_name(name):
+    """
+    Returns the canonical form of a tag name: NFKC normalized, case
+    folded and with runs of whitespace collapsed to a single space, so
+    that ``u'Foo  Bar'`` and ``u'\uff26oo bar'`` are the same tag.
+
+    Results are memoized; the memo is dropped wholesale once it holds
+    ``CANONICAL_CACHE_SIZE`` names.
+    """
+    try:
+        return _canonical_cache[name]
+    except KeyError:
+        pass
+    canonical = unicodedata.normalize('NFKC', force_unicode(name))
+    canonical = getattr(canonical, 'casefold', canonical.lower)()
+    canonical = unicodedata.normalize('NFKC', u' '.join(canonical.split()))
+    canonical = canonical[:CANONICAL_MAX_LENGTH]
+    if len(_canonical_cache) >= CANONICAL_CACHE_SIZE:
+        _canonical_cache.clear()
+    _canonical_cache[name] = canonical
+    return canonical
+
 def edit_string_for_tags(tags):
     """
     Given list of ``Tag`` instances, creates a string representation of
@@ -165,7 +194,8 @@ def get_tag_list(tags):
     elif isinstance(tags, QuerySet) and tags.model is Tag:
         return tags
     elif isinstance(tags, types.StringTypes):
-        return Tag.objects.filter(name__in=parse_tag_input(tags))
+        return Tag.objects.filter(canonical__in=[canonicalize_tag_name(tag) \
+                                                 for tag in parse_tag_input(tags)])
     elif isinstance(tags, (types.ListType, types.TupleType)):
         if len(tags) == 0:
             return tags
@@ -179,8 +209,8 @@ def get_tag_list(tags):
                 contents.add('int')
         if len(contents) == 1:
             if 'string' in contents:
-                return Tag.objects.filter(name__in=[force_unicode(tag) \
-                                                    for tag in tags])
+                return Tag.objects.filter(canonical__in=[canonicalize_tag_name(tag) \
+                                                         for tag in tags])
             elif 'tag' in contents:
                 return tags
             elif 'int' in contents:
@@ -207,7 +237,7 @@ def get_tag(tag):
 
     try:
         if isinstance(tag, types.StringTypes):
-            return Tag.objects.get(name=tag)
+            return Tag.objects.get(canonical=canonicalize_tag_name(tag))
         elif isinstance(tag, (types.IntType, types.LongType)):
             return Tag.objects.get(id=tag)
     except Tag.DoesNotExist:
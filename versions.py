@@ -0,0 +1,66 @@
+"""
+Version counters for caching the results of tagging reads.
+
+Refreshing the popularity of objects, which every write to their tags
+ends with, bumps the version of those objects and of their content type;
+renaming and merging tags and collecting garbage bump a global version.
+A key built by ``make_key`` from the versions a result depends on
+changes as soon as any of them is bumped, so a stale entry is never read
+again and is left to expire.
+
+A version missing from the cache starts from the current time, so one
+evicted and recreated doesn't repeat a value it had before.
+"""
+import time
+
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor
+
+GLOBAL_KEY = 'tagging.v'
+
+def content_type_key(content_type_id):
+    return 'tagging.v.ct.%s' % content_type_id
+
+def object_key(content_type_id, object_id):
+    return 'tagging.v.obj.%s.%s' % (content_type_id, object_id)
+
+def _initial():
+    return int(time.time() * 1000)
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _initial())
+
+def bump(content_type_id, object_ids=()):
+    """
+    Invalidates the cached results about objects of ``content_type_id``,
+    in particular about the objects ``object_ids``.
+    """
+    _bump(content_type_key(content_type_id))
+    for object_id in object_ids:
+        _bump(object_key(content_type_id, object_id))
+
+def bump_all():
+    """
+    Invalidates every cached tagging result.
+    """
+    _bump(GLOBAL_KEY)
+
+def make_key(prefix, version_keys, *parts):
+    """
+    Returns a cache key for a result identified by ``prefix`` and
+    ``parts`` which depends on the versions under ``version_keys``, and
+    on the global version.
+    """
+    version_keys = [GLOBAL_KEY] + list(version_keys)
+    found = cache.get_many(version_keys)
+    versions = []
+    for key in version_keys:
+        if key not in found:
+            cache.add(key, _initial())
+            found[key] = cache.get(key)
+        versions.append(found[key])
+    digest = md5_constructor(repr((parts, versions))).hexdigest()
+    return 'tagging.%s.%s' % (prefix, digest)